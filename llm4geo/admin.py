@@ -1,3 +1,21 @@
 from django.contrib import admin
 
-# Register your models here.
+from llm4geo.models import ChatSession, ChatTurn, RequestLog
+
+
+class ChatTurnInline(admin.TabularInline):
+    model = ChatTurn
+    extra = 0
+
+
+@admin.register(ChatSession)
+class ChatSessionAdmin(admin.ModelAdmin):
+    list_display = ["id", "created", "updated", "summarized_turns"]
+    inlines = [ChatTurnInline]
+
+
+@admin.register(RequestLog)
+class RequestLogAdmin(admin.ModelAdmin):
+    list_display = ["created", "request_id", "view", "function_name", "status", "seconds", "retries"]
+    list_filter = ["view", "function_name", "status", "model"]
+    search_fields = ["request_id", "text_input"]
@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class Llm4GeoConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "llm4geo"
+
+    def ready(self):
+        from llm4geo.llm import prebuild_chains
+
+        if settings.LLM_PREBUILD_CHAINS:
+            prebuild_chains()
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import logging
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from llm4geo.cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+ndjson_content_types = ["application/x-ndjson", "application/jsonl", "application/ndjson"]
+
+
+def parse_ndjson(content):
+    """
+    Returns the text inputs of NDJSON lines, each either {"text_input": ...} or a JSON string.
+    """
+    text_inputs = []
+    for line in content.decode().splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        text_inputs.append(item.get("text_input") if isinstance(item, dict) else item)
+    return text_inputs
+
+
+def get_batch_data(request):
+    """
+    Reads the batch from a JSON body, an NDJSON body or an uploaded NDJSON "file".
+    Raises ValueError for invalid NDJSON.
+    """
+    if request.content_type.split(";")[0].strip() in ndjson_content_types:
+        data = {"text_inputs": parse_ndjson(request.body)}
+        if request.query_params.get("batch_id"):
+            data["batch_id"] = request.query_params["batch_id"]
+        return data
+    if "file" in request.FILES:
+        data = {"text_inputs": parse_ndjson(request.FILES["file"].read())}
+        if request.data.get("batch_id"):
+            data["batch_id"] = request.data["batch_id"]
+        return data
+    return request.data
+
+
+def new_batch_id():
+    return uuid.uuid4().hex
+
+
+def unique_inputs(text_inputs):
+    """
+    Returns the normalized key of each input and the unique inputs by key, in the order they first appear.
+    """
+    keys = [normalize_text(text) for text in text_inputs]
+    unique = {}
+    for key, text in zip(keys, text_inputs):
+        unique.setdefault(key, text)
+    return keys, unique
+
+
+def checkpoint_key(batch_id, key):
+    return f"{batch_id}:{hashlib.sha256(key.encode()).hexdigest()[:32]}"
+
+
+def get_checkpoints(batch_id, keys):
+    """
+    Returns the checkpointed responses of a batch by key, read in one query.
+    """
+    checkpoint_keys = {checkpoint_key(batch_id, key): key for key in keys}
+    checkpoints = caches[settings.BATCH_CHECKPOINTS].get_many(list(checkpoint_keys))
+    return {checkpoint_keys[key]: response for key, response in checkpoints.items()}
+
+
+def store_checkpoint(batch_id, key, response):
+    # A failed checkpoint only means the item is answered again if the batch is resumed.
+    try:
+        caches[settings.BATCH_CHECKPOINTS].set(checkpoint_key(batch_id, key), response, settings.BATCH_CHECKPOINT_TTL)
+    except Exception as e:
+        logger.warning(f"Failed to checkpoint batch {batch_id}: {e}")
+
+
+def result_line(index, text_input, response=None, error=None):
+    result = {"index": index, "text_input": text_input}
+    if error is not None:
+        result["error"] = error
+    else:
+        result["response"] = response
+    return json.dumps(result) + "\n"
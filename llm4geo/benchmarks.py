@@ -0,0 +1,115 @@
+import json
+import random
+import timeit
+
+from django.http import JsonResponse
+from django.test import override_settings
+from jsonschema import Draft7Validator, validate
+
+from llm4geo.fake_llm import FakeChatModel, example_instance
+from llm4geo.llm import chat_prompt
+from llm4geo.schemas.supported_functions import get_function_call_schema, get_specialized_function_call, \
+    get_supported_functions
+from llm4geo.serializers import QGISSerializer
+
+words = ["roads", "rivers", "parcels", "buildings", "trails", "rail", "water", "zoning", "census", "landuse",
+         "soils", "wells", "bridges", "airports", "parks", "schools", "hospitals", "boundaries", "contours", "imagery"]
+
+
+def generate_layer(index, rng):
+    name = f"{rng.choice(words)}_{index}"
+    renderer = rng.choice(["categories", "ranges", "rules", None])
+    layer = {
+        "name": name,
+        "id": f"{name}_{rng.getrandbits(64):016x}",
+        "type": 0,
+        "crs": "EPSG:4326",
+        "extent": f"{rng.uniform(-180, 0):.6f},{rng.uniform(-90, 0):.6f} : {rng.uniform(0, 180):.6f},{rng.uniform(0, 90):.6f}",
+        "feature_count": rng.randint(0, 1000000),
+        "geometry_type": rng.randint(0, 2),
+        "fields": ["fid"] + rng.sample(words, 8),
+        "categories": [],
+        "ranges": [],
+        "rules": [],
+    }
+    if renderer:
+        layer[renderer] = [f"{rng.choice(words)} {value}" for value in range(rng.randint(2, 12))]
+    return layer
+
+
+def generate_project(layer_count, seed=0):
+    """
+    A synthetic project description with layer_count layers, the same for the same arguments.
+    """
+    rng = random.Random(seed)
+    return {
+        "title": f"Synthetic project with {layer_count} layers",
+        "crs": "EPSG:3857",
+        "layers": [generate_layer(index, rng) for index in range(layer_count)],
+    }
+
+
+def time_call(function, repeat=3, min_time=0.2):
+    """
+    Returns the best time per call in seconds, running function enough times for each measurement to take min_time.
+    """
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    if elapsed < min_time:
+        number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def get_benchmarks(layer_count):
+    """
+    Returns (name, function) pairs covering the server's request path without the LLM for a project of layer_count.
+    """
+    from llm4geo.views.qgis_chat import QGISChatView
+
+    project_description = generate_project(layer_count)
+    request_data = {"text_input": "color the rivers blue", "project_description": project_description, "chat_history": []}
+    view = QGISChatView()
+    supported_functions = get_supported_functions()
+    function_call_schema = get_function_call_schema(project_description)
+    function_call = example_instance(function_call_schema)
+    function_prompt = view.function_prompt("color_category", "color the rivers blue", project_description)
+
+    def serializer():
+        QGISSerializer(data=request_data).is_valid(raise_exception=True)
+
+    def chat_response():
+        view.get_chat_response("color the rivers blue", project_description)
+
+    return [
+        ("serializer", serializer),
+        ("function_name_prompt", lambda: view.function_name_prompt("color the rivers blue")),
+        ("function_prompt", lambda: view.function_prompt("color_category", "color the rivers blue", project_description)),
+        ("chat_prompt_template", lambda: chat_prompt.invoke(function_prompt)),
+        ("json_dumps_supported_functions", lambda: json.dumps(supported_functions)),
+        ("jsonschema_validate", lambda: validate(function_call, function_call_schema, cls=Draft7Validator)),
+        ("jsonschema_cached_validator", lambda: get_specialized_function_call(project_description)[1].validate(function_call)),
+        ("json_response", lambda: JsonResponse({**function_call["function_call"], "project_hash": "0" * 64}).content),
+        ("chat_response_fake_llm", chat_response),
+    ]
+
+
+def run(layer_counts, repeat=3, min_time=0.2, only=None):
+    results = {}
+    # Overridden once around the runs, overriding settings clears the chains and would be timed with each call.
+    with override_settings(LLM_MODEL=FakeChatModel, LLM_CACHE_ENABLED=False, SPECULATIVE_PARAMETERS=False):
+        for layer_count in layer_counts:
+            for name, function in get_benchmarks(layer_count):
+                if only and name not in only:
+                    continue
+                results[f"{name}[{layer_count}]"] = time_call(function, repeat, min_time)
+    return results
+
+
+def compare(results, baseline):
+    """
+    Returns (name, seconds, baseline seconds, ratio) for the benchmarks in both results.
+    """
+    return [
+        (name, seconds, baseline[name], seconds / baseline[name])
+        for name, seconds in results.items() if baseline.get(name)
+    ]
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from llm4geo import single_flight
+
+logger = logging.getLogger(__name__)
+
+# Hit/miss counters for this worker, keyed like "local_hit", "shared_hit", "miss" and "shared_error".
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def normalize_text(text):
+    return " ".join(text.lower().split())
+
+
+def response_cache_key(namespace, text, chat_history=None, project_description=None, schema=None, model_name=None):
+    """
+    Builds a cache key from the normalized input, the chat history and project, the model (OPENAI_MODEL unless given)
+    and the schema.
+    Each part is hashed separately so keys stay short and can be compared when debugging.
+    """
+    parts = [
+        namespace,
+        model_name or settings.OPENAI_MODEL,
+        _hash(schema)[:16],
+        _hash([chat_history or [], project_description or {}])[:16],
+        _hash(normalize_text(text))[:32],
+    ]
+    return ":".join(parts)
+
+
+def _record(event):
+    with _stats_lock:
+        _stats[event] += 1
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def _lookup(key):
+    local_cache = caches[settings.LLM_CACHE_LOCAL]
+    response = local_cache.get(key)
+    if response is not None:
+        _record("local_hit")
+        return response
+    if settings.LLM_CACHE_SHARED:
+        try:
+            response = caches[settings.LLM_CACHE_SHARED].get(key)
+        except Exception as e:
+            # The shared tier is an optimization, a miss is better than failing the request.
+            logger.warning(f"Failed to read the shared LLM cache: {e}")
+            _record("shared_error")
+            response = None
+        if response is not None:
+            _record("shared_hit")
+            local_cache.set(key, response, settings.LLM_CACHE_TTL)
+            return response
+    _record("miss")
+    return None
+
+
+def _store(key, response):
+    caches[settings.LLM_CACHE_LOCAL].set(key, response, settings.LLM_CACHE_TTL)
+    if settings.LLM_CACHE_SHARED:
+        try:
+            caches[settings.LLM_CACHE_SHARED].set(key, response, settings.LLM_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Failed to write the shared LLM cache: {e}")
+            _record("shared_error")
+
+
+def get_or_compute(key, compute):
+    """
+    Returns the cached response for key, checking the in-process tier before the shared tier.
+    On a miss compute() is called and its result is stored in both tiers, concurrent misses for the same key share
+    a single call.
+    """
+    if not settings.LLM_CACHE_ENABLED:
+        return single_flight.do(key, compute)
+    response = _lookup(key)
+    if response is None:
+        response = single_flight.do(key, lambda: _compute_and_store(key, compute))
+    return response
+
+
+def _compute_and_store(key, compute):
+    response = compute()
+    if response is not None:
+        _store(key, response)
+    return response
+
+
+def get_cached(key):
+    """
+    Returns the cached response for key or None, for callers that can't compute the response in a single call.
+    """
+    if not settings.LLM_CACHE_ENABLED:
+        return None
+    return _lookup(key)
+
+
+def set_cached(key, response):
+    if settings.LLM_CACHE_ENABLED and response is not None:
+        _store(key, response)
+
+
+async def aget_cached(key):
+    return await sync_to_async(get_cached)(key)
+
+
+async def aset_cached(key, response):
+    await sync_to_async(set_cached)(key, response)
+
+
+async def aget_or_compute(key, acompute):
+    if not settings.LLM_CACHE_ENABLED:
+        return await single_flight.ado(key, acompute)
+    response = await sync_to_async(_lookup)(key)
+    if response is None:
+        response = await single_flight.ado(key, lambda: _acompute_and_store(key, acompute))
+    return response
+
+
+async def _acompute_and_store(key, acompute):
+    response = await acompute()
+    if response is not None:
+        await sync_to_async(_store)(key, response)
+    return response
@@ -0,0 +1,167 @@
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from llm4geo import metrics
+from llm4geo.llm import get_chain, get_model_name
+from llm4geo.models import ChatSession, ChatTurn
+from llm4geo.prompts import PromptBuilder
+from llm4geo.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# The chat history message type of each role, see langchain_core.messages.convert_to_messages.
+message_types = {ChatTurn.USER: "human", ChatTurn.ASSISTANT: "ai"}
+
+summary_schema = {
+    "title": "ConversationSummary",
+    "description": "A summary of the earlier turns of a conversation between a QGIS user and an assistant.",
+    "type": "object",
+    "properties": {
+        "summary": {
+            "type": "string",
+            "description": "A short summary that keeps the layers, places, values and preferences the user referred to.",
+        },
+    },
+    "required": ["summary"],
+}
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+# Sessions with a summary being written, so each session has at most one at a time.
+_summarizing = set()
+_summarizing_lock = threading.Lock()
+
+
+def _record(event):
+    with _stats_lock:
+        _stats[event] += 1
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+# Registered here rather than in llm4geo.metrics, which is imported by the logging config before the models are ready.
+metrics.register_stats("llm4geo_chat_session_total", "Chat sessions created, resumed and summarized.", "event", get_stats)
+
+
+@lru_cache(maxsize=None)
+def get_executor():
+    return ThreadPoolExecutor(max_workers=settings.CHAT_SESSION_SUMMARY_WORKERS, thread_name_prefix="summary")
+
+
+def get_window(session, budget=None):
+    """
+    Returns the role-tagged chat history for the next prompt of the session and the index of its first turn.
+    The history is the summary of the older turns followed by the most recent turns that fit in budget tokens, the
+    summary isn't counted so a long summary can't crowd out the recent turns.
+    """
+    budget = budget or settings.CHAT_SESSION_TOKEN_BUDGET
+    history = []
+    if session.summary:
+        history.append(("system", f"A summary of the earlier conversation:\n{session.summary}"))
+    turns = session.turns.filter(index__gte=session.summarized_turns).order_by("-index")
+    window, start = [], None
+    for turn in turns[:settings.CHAT_SESSION_MAX_TURNS]:
+        budget -= count_tokens(turn.content)
+        if budget < 0:
+            break
+        window.append((message_types[turn.role], turn.content))
+        start = turn.index
+    if start is None:
+        start = session.turns.aggregate(last=Max("index"))["last"]
+        start = session.summarized_turns if start is None else start + 1
+    return history + window[::-1], start
+
+
+def load_conversation(session_id):
+    """
+    Returns the session, created on its first request, and the chat history to prompt with.
+    """
+    session, created = ChatSession.objects.get_or_create(id=session_id)
+    _record("created" if created else "resumed")
+    history, _ = get_window(session)
+    return session, history
+
+
+def add_turns(session, text, response):
+    """
+    Stores the user's text and the chat of the response as the next turns of the session.
+    """
+    with transaction.atomic():
+        # Locking the session keeps concurrent requests in one session from taking the same turn index.
+        ChatSession.objects.select_for_update().filter(id=session.id).update(updated=timezone.now())
+        last = session.turns.aggregate(last=Max("index"))["last"]
+        index = 0 if last is None else last + 1
+        ChatTurn.objects.bulk_create([
+            ChatTurn(session=session, index=index, role=ChatTurn.USER, content=text),
+            ChatTurn(session=session, index=index + 1, role=ChatTurn.ASSISTANT, content=(response or {}).get("chat") or ""),
+        ])
+    schedule_summary(session.id)
+
+
+def summary_prompt(session, turns):
+    prompt = PromptBuilder("summary")
+    prompt.add("instructions", "Summarize the conversation between a QGIS user and an assistant that calls functions in QGIS for them.  Keep the layers, places, values and preferences the user referred to so later requests can refer back to them.")
+    if session.summary:
+        prompt.add("summary", f"Extend this summary of the conversation before these turns:\n{session.summary}")
+    return prompt.build("\n".join(f"{turn.role}: {turn.content}" for turn in turns))
+
+
+def summarize(session_id):
+    """
+    Folds the turns that no longer fit in the session's window into its summary, returns whether it was updated.
+    """
+    session = ChatSession.objects.get(id=session_id)
+    _, start = get_window(session)
+    turns = list(session.turns.filter(index__gte=session.summarized_turns, index__lt=start))
+    if len(turns) < settings.CHAT_SESSION_SUMMARY_MIN_TURNS:
+        return False
+    response = get_chain(summary_schema, get_model_name("summary")).invoke(summary_prompt(session, turns))
+    # Only the summary this one extends is replaced, in case another worker summarized the session meanwhile.
+    updated = ChatSession.objects.filter(id=session.id, summarized_turns=session.summarized_turns).update(
+        summary=response["summary"], summarized_turns=start
+    )
+    _record("summarized" if updated else "summary_skipped")
+    return bool(updated)
+
+
+def schedule_summary(session_id):
+    """
+    Summarizes the session in the background, off the request path, unless it is already being summarized.
+    """
+    if not settings.CHAT_SESSION_SUMMARIES:
+        return None
+    with _summarizing_lock:
+        if session_id in _summarizing:
+            return None
+        _summarizing.add(session_id)
+    return get_executor().submit(_summarize_in_background, session_id)
+
+
+def _summarize_in_background(session_id):
+    try:
+        return summarize(session_id)
+    except Exception as e:
+        _record("summary_failed")
+        logger.exception(f"Failed to summarize chat session {session_id}: {e}")
+        return False
+    finally:
+        with _summarizing_lock:
+            _summarizing.discard(session_id)
+        # Threads outside the request cycle have to close their own database connections.
+        connections.close_all()
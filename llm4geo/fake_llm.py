@@ -0,0 +1,121 @@
+import json
+import time
+from copy import deepcopy
+from functools import lru_cache
+
+from django.conf import settings
+from langchain_core.runnables import RunnableLambda
+
+from llm4geo.cache import normalize_text
+
+
+def example_instance(schema):
+    """
+    Returns the simplest instance of a JSON schema, e.g. the first enum value or the minimum of a number.
+    """
+    if "const" in schema:
+        return schema["const"]
+    if "default" in schema:
+        return schema["default"]
+    if schema.get("enum"):
+        return schema["enum"][0]
+    for combinator in ["oneOf", "anyOf"]:
+        if schema.get(combinator):
+            return example_instance(schema[combinator][0])
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        properties = schema.get("properties", {})
+        return {name: example_instance(properties.get(name, {})) for name in schema.get("required", [])}
+    if schema_type == "array":
+        return [example_instance(schema.get("items", {})) for _ in range(max(schema.get("minItems", 1), 1))]
+    if schema_type in ["integer", "number"]:
+        value = max(schema.get("minimum", 0), min(schema.get("maximum", 0), 0))
+        return int(value) if schema_type == "integer" else float(value)
+    if schema_type == "boolean":
+        return False
+    return "example"
+
+
+class FakeChatModel:
+    """
+    A deterministic stand-in for the chat model that needs no network, selected with LLM_MODEL=fake.
+    Structured output is the canned response for the schema title or else the simplest valid instance of the schema.
+    """
+    responses = {}
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    @classmethod
+    def with_responses(cls, responses):
+        return type(cls.__name__, (cls,), {"responses": {**cls.responses, **responses}})
+
+    def with_structured_output(self, schema):
+        response = self.responses.get(schema.get("title")) or example_instance(schema)
+        return RunnableLambda(lambda prompt: deepcopy(response))
+
+
+@lru_cache(maxsize=8)
+def load_recordings(path):
+    """
+    Returns the responses recorded in a request log export (see export_request_log) by their normalized text_input.
+    """
+    recordings = {}
+    with open(path) as lines:
+        for line in lines:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry.get("text_input") and entry.get("response") and not entry.get("error"):
+                recordings[normalize_text(entry["text_input"])] = entry["response"]
+    return recordings
+
+
+def recorded_output(schema, response):
+    """
+    Returns the structured output that would have produced a recorded API response, or None if it can't have.
+    """
+    title = schema.get("title")
+    if title == "GetFunctionCall":
+        if "function_name" not in response:
+            return None
+        return {"function_call": {key: response[key] for key in ["chat", "function_name", "parameters"] if key in response}}
+    if title == response.get("function_name") and "parameters" in response:
+        return response["parameters"]
+    properties = schema.get("properties", {})
+    if properties and all(key in response for key in schema.get("required", [])):
+        return {key: value for key, value in response.items() if key in properties}
+    return None
+
+
+class ReplayChatModel(FakeChatModel):
+    """
+    Answers an input with the output that produced its recorded response after LLM_REPLAY_LATENCY seconds, selected with
+    LLM_MODEL=replay and LLM_REPLAY_RECORDINGS.  Inputs that weren't recorded get FakeChatModel's output.
+    """
+    recordings = None
+    latency = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.recordings is None:
+            path = settings.LLM_REPLAY_RECORDINGS
+            self.recordings = load_recordings(str(path)) if path else {}
+        if self.latency is None:
+            self.latency = settings.LLM_REPLAY_LATENCY
+
+    @classmethod
+    def with_recordings(cls, recordings, latency=None):
+        return type(cls.__name__, (cls,), {"recordings": recordings, "latency": latency})
+
+    def with_structured_output(self, schema):
+        fallback = super().with_structured_output(schema)
+
+        def respond(prompt):
+            if self.latency:
+                time.sleep(self.latency)
+            response = self.recordings.get(normalize_text(prompt.to_messages()[-1].content))
+            output = recorded_output(schema, response) if response else None
+            return deepcopy(output) if output is not None else fallback.invoke(prompt)
+
+        return RunnableLambda(respond)
@@ -0,0 +1,243 @@
+import bisect
+import difflib
+import re
+import threading
+import unicodedata
+from collections import Counter
+from functools import lru_cache
+
+from django.conf import settings
+
+# Countries are preferred over regions over cities with the same name, e.g. Georgia.
+importance = {"country": 3, "region": 2, "city": 1}
+
+# Words that can precede a place name without being part of it, e.g. "zoom to the city of Denver".
+location_cues = {"to", "in", "at", "on", "over", "around", "near", "into"}
+filler_words = {"the", "city", "town", "state", "country", "province", "region", "of", "downtown", "central", "please"}
+
+# Counters for this worker, keyed like "exact", "fuzzy" and "miss".
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+_non_word = re.compile(r"[^a-z0-9]+")
+# Abbreviations in capitals, with or without dots, e.g. "US" and "U.S.".
+_uppercase_word = re.compile(r"\b(?:[A-Z]\.){2,}|\b[A-Z]{2,}\b")
+
+
+def _record(event):
+    with _stats_lock:
+        _stats[event] += 1
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def normalize(name):
+    """
+    Lowercases a name and strips its accents and punctuation, so "Zürich" and "St. Louis" match "zurich" and "st louis".
+    """
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    words = _non_word.sub(" ", name.lower().replace("'", "")).split()
+    return " ".join("saint" if word == "st" else word for word in words)
+
+
+def bbox(place):
+    return {"west": place["west"], "south": place["south"], "east": place["east"], "north": place["north"]}
+
+
+def contains(outer, inner):
+    longitude = (inner["west"] + inner["east"]) / 2
+    latitude = (inner["south"] + inner["north"]) / 2
+    return outer["west"] <= longitude <= outer["east"] and outer["south"] <= latitude <= outer["north"]
+
+
+class Gazetteer:
+    """
+    An in-memory index of place names and their bounding boxes with exact, prefix and fuzzy lookup.
+    """
+
+    def __init__(self, places):
+        self.places = places
+        self.names = {}
+        spelled_out = set()
+        uppercase = set()
+        for place in places:
+            for name in [place["name"], *place["alternate_names"]]:
+                self.names.setdefault(normalize(name), []).append(place)
+                (uppercase if name.isupper() else spelled_out).add(normalize(name))
+        # Abbreviations like "ACT" and "LA" are also common words, so free text only matches them when written in
+        # capitals and they are never matched fuzzily.
+        self.abbreviations = uppercase - spelled_out
+        for matches in self.names.values():
+            matches.sort(key=lambda place: -importance[place["kind"]])
+        self.sorted_names = sorted(self.names)
+        # Fuzzy matching only compares names with the same first letter.
+        self.names_by_initial = {}
+        for name in self.sorted_names:
+            if name in self.abbreviations:
+                continue
+            self.names_by_initial.setdefault(name[0], []).append(name)
+        self.max_words = max((len(name.split()) for name in self.names), default=0)
+
+    @classmethod
+    def load(cls, path):
+        places = []
+        with open(path, encoding="utf-8") as lines:
+            for line in lines:
+                if line.startswith("#") or not line.strip():
+                    continue
+                name, alternate_names, kind, country, west, south, east, north = line.rstrip("\n").split("\t")
+                places.append({
+                    "name": name,
+                    "alternate_names": [alternate for alternate in alternate_names.split(";") if alternate],
+                    "kind": kind,
+                    "country": country,
+                    "west": float(west),
+                    "south": float(south),
+                    "east": float(east),
+                    "north": float(north),
+                })
+        return cls(places)
+
+    def exact(self, name):
+        """
+        Returns the places with a name, ignoring a leading "the" as in "the US" unless it is part of the name.
+        """
+        name = normalize(name)
+        if name not in self.names and name.startswith("the "):
+            name = name[len("the "):]
+        return self.names.get(name, [])
+
+    def prefix(self, prefix, limit=10):
+        """
+        Returns places whose names start with prefix, most important first.
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        matches = []
+        for name in self.sorted_names[bisect.bisect_left(self.sorted_names, prefix):]:
+            if not name.startswith(prefix):
+                break
+            matches.extend(place for place in self.names[name] if place not in matches)
+        matches.sort(key=lambda place: -importance[place["kind"]])
+        return matches[:limit]
+
+    def fuzzy(self, name, limit=5, cutoff=None):
+        name = normalize(name)
+        if not name:
+            return []
+        cutoff = settings.GAZETTEER_FUZZY_CUTOFF if cutoff is None else cutoff
+        close_names = difflib.get_close_matches(name, self.names_by_initial.get(name[0], []), limit, cutoff)
+        return [self.names[close_name][0] for close_name in close_names]
+
+    def lookup(self, name):
+        """
+        Returns the best place for a name, trying an exact match, then a unique prefix and then a fuzzy match.
+        """
+        matches = self.exact(name)
+        if not matches:
+            prefixed = self.prefix(name)
+            if len({place["name"] for place in prefixed}) == 1:
+                matches = prefixed
+        if not matches:
+            matches = self.fuzzy(name, limit=1)
+        return matches[0] if matches else None
+
+    def find(self, text):
+        """
+        Returns the place named in free text, or None. The longest name wins, and of names the same length the most
+        specific, e.g. the city for "Denver Colorado". A misspelled name is only matched fuzzily after a cue like "to".
+        Returns None when the text also names a region or country that does not contain the place, e.g. "Paris Texas".
+        """
+        words = normalize(text).split()
+        capitals = {normalize(word) for word in _uppercase_word.findall(text)}
+        cue = next((index for index, word in enumerate(words) if word in location_cues), None)
+        cued = words[cue + 1:] if cue is not None else []
+        for candidate_words in [cued, words]:
+            found, place = self.find_exact(candidate_words, capitals)
+            if found:
+                _record("exact" if place is not None else "miss")
+                return place
+        while cued and (cued[0] in filler_words or cued[0] in location_cues):
+            cued = cued[1:]
+        if cued:
+            matches = self.fuzzy(" ".join(cued), limit=1) or self.fuzzy(cued[0], limit=1)
+            if matches:
+                _record("fuzzy")
+                return matches[0]
+        _record("miss")
+        return None
+
+    def find_exact(self, words, capitals=()):
+        """
+        Returns whether words name a place and the place, which is None when a qualifier rules every match out.
+        """
+        spans = self.spans(words, capitals)
+        for length in range(min(self.max_words, len(words)), 0, -1):
+            matches = [(start, end) for start, end in spans if end - start == length]
+            if matches:
+                return True, self.choose(matches, spans, words)
+        return False, None
+
+    def spans(self, words, capitals=()):
+        spans = []
+        for length in range(1, min(self.max_words, len(words)) + 1):
+            for start in range(len(words) - length + 1):
+                name = " ".join(words[start:start + length])
+                if name in self.names and (name not in self.abbreviations or name in capitals):
+                    spans.append((start, start + length))
+        return spans
+
+    def choose(self, matches, spans, words):
+        """
+        Picks the most specific of several matched names. Less specific names elsewhere in the words qualify it, e.g.
+        "Colorado" in "Denver Colorado", and the place must lie in each of them.
+        """
+        def name(span):
+            return " ".join(words[span[0]:span[1]])
+
+        def specificity(span):
+            return min(importance[place["kind"]] for place in self.names[name(span)])
+
+        match = min(matches, key=specificity)
+        places = self.names[name(match)]
+        for span in spans:
+            if span[1] <= match[0] or span[0] >= match[1]:
+                qualifiers = [
+                    place for place in self.names[name(span)] if importance[place["kind"]] > specificity(match)
+                ]
+                if qualifiers:
+                    places = [
+                        place for place in places if any(contains(bbox(qualifier), place) for qualifier in qualifiers)
+                    ]
+        return places[0] if places else None
+
+
+@lru_cache(maxsize=2)
+def load_gazetteer(path):
+    return Gazetteer.load(path)
+
+
+def get_gazetteer():
+    """
+    Returns the gazetteer in GAZETTEER_PATH, loaded on first use.
+    """
+    return load_gazetteer(str(settings.GAZETTEER_PATH))
+
+
+def find_location(text):
+    """
+    Returns the go_to_location parameters for the place named in text, or None when no place is found.
+    """
+    if not settings.GAZETTEER_ENABLED:
+        return None
+    place = get_gazetteer().find(text)
+    return bbox(place) if place else None
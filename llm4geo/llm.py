@@ -0,0 +1,144 @@
+import asyncio
+import json
+from functools import lru_cache
+from weakref import WeakKeyDictionary
+
+import httpx
+from django.conf import settings
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+# Every chain shares this prompt, the system message and chat history are sent with each payload.
+chat_prompt = ChatPromptTemplate.from_messages(
+    [MessagesPlaceholder("system"), MessagesPlaceholder("chat_history", optional=True), ("human", "{input}")]
+)
+
+
+@lru_cache(maxsize=None)
+def get_model(model_name=None):
+    """
+    Returns the chat model for this worker, created once so its HTTP connection pool is kept alive between requests.
+    """
+    limits = httpx.Limits(
+        max_connections=settings.LLM_MAX_CONNECTIONS, max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS
+    )
+    return settings.LLM_MODEL(
+        model=model_name or settings.OPENAI_MODEL,
+        openai_api_key=settings.OPENAI_API_KEY,
+        http_client=httpx.Client(limits=limits),
+        http_async_client=httpx.AsyncClient(limits=limits),
+    )
+
+
+@lru_cache(maxsize=256)
+def _get_chain(model_name, schema_json):
+    structured_llm = get_model(model_name).with_structured_output(json.loads(schema_json))
+    return chat_prompt | structured_llm
+
+
+def get_model_name(stage, function_name=None):
+    """
+    Returns the model for a stage, configured in LLM_STAGE_MODELS by "<stage>:<function_name>" or "<stage>", and
+    OPENAI_MODEL otherwise.
+    """
+    models = settings.LLM_STAGE_MODELS
+    if function_name and f"{stage}:{function_name}" in models:
+        return models[f"{stage}:{function_name}"]
+    return models.get(stage) or settings.OPENAI_MODEL
+
+
+def get_escalation_model(model_name):
+    """
+    Returns the model to try once more with when model_name's responses are still invalid after the retries, or None.
+    """
+    if settings.LLM_ESCALATION_MODEL and settings.LLM_ESCALATION_MODEL != model_name:
+        return settings.LLM_ESCALATION_MODEL
+    return None
+
+
+def get_chain(schema, model_name=None):
+    """
+    Returns the memoized prompt | structured output chain for the (model, schema) pair.
+    """
+    return _get_chain(model_name or settings.OPENAI_MODEL, json.dumps(schema, sort_keys=True))
+
+
+# Limits in-flight LLM calls per event loop, which is one per ASGI worker.
+_semaphores = WeakKeyDictionary()
+
+
+def get_semaphore():
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(settings.LLM_MAX_CONCURRENCY)
+    return _semaphores[loop]
+
+
+async def ainvoke(chain, payload):
+    async with get_semaphore():
+        return await chain.ainvoke(payload)
+
+
+async def astream(chain, payload):
+    async with get_semaphore():
+        async for chunk in chain.astream(payload):
+            yield chunk
+
+
+def run_steps(steps):
+    """
+    Runs a generator that yields the (chain, payload) LLM calls it needs and is sent their responses, or thrown their
+    errors, so the same logic serves the sync and async views. Returns the value the generator returns.
+    """
+    response, error = None, None
+    while True:
+        try:
+            chain, payload = steps.throw(error) if error is not None else steps.send(response)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            response, error = chain.invoke(payload), None
+        except Exception as e:
+            response, error = None, e
+
+
+async def arun_steps(steps):
+    """
+    The same as run_steps but awaits each LLM call with ainvoke.
+    """
+    response, error = None, None
+    while True:
+        try:
+            chain, payload = steps.throw(error) if error is not None else steps.send(response)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            response, error = await ainvoke(chain, payload), None
+        except Exception as e:
+            response, error = None, e
+
+
+def prebuild_chains():
+    from llm4geo.schemas.supported_functions import get_function_call_schema, get_function_name_schema, \
+        get_plan_schema, get_supported_functions
+    from llm4geo.views.data_chat import DataChatView
+
+    get_chain(DataChatView.json_schema, get_model_name("data_chat"))
+    get_chain(get_function_name_schema(), get_model_name("function_name"))
+    get_chain(get_function_call_schema(), get_model_name("function_call"))
+    get_chain(get_plan_schema(), get_model_name("plan"))
+    for function_name, function_schema in get_supported_functions().items():
+        if "properties" in function_schema:
+            get_chain(function_schema, get_model_name("parameters", function_name))
+
+
+def clear_chains():
+    _get_chain.cache_clear()
+    get_model.cache_clear()
+
+
+@receiver(setting_changed)
+def clear_chains_on_setting_changed(setting, **kwargs):
+    if setting in ("LLM_MODEL", "OPENAI_MODEL", "OPENAI_API_KEY"):
+        clear_chains()
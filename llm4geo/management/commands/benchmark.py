@@ -0,0 +1,51 @@
+import json
+import platform
+import subprocess
+from datetime import datetime, timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from llm4geo import benchmarks
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=settings.BASE_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class Command(BaseCommand):
+    help = "Times the request pipeline without the LLM using synthetic projects and a fake chat model."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--layers", type=int, nargs="+", default=[10, 100, 1000, 10000])
+        parser.add_argument("--only", nargs="+", help="Only run these benchmarks.")
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--min-time", type=float, default=0.2, help="Seconds each measurement runs for.")
+        parser.add_argument("--output", help="Where to save the results, defaults to benchmarks/<commit>.json which git ignores.")
+        parser.add_argument("--compare", help="Results from an earlier run to compare with.")
+
+    def handle(self, *args, **options):
+        commit = get_commit()
+        results = benchmarks.run(options["layers"], options["repeat"], options["min_time"], options["only"])
+        for name, seconds in results.items():
+            self.stdout.write(f"{name:<50} {seconds * 1000:12.4f} ms")
+
+        output = Path(options["output"] or settings.BASE_DIR / "benchmarks" / f"{commit}.json")
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps({
+            "commit": commit,
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "results": results,
+        }, indent=2))
+        self.stdout.write(f"Saved results to {output}")
+
+        if options["compare"]:
+            baseline = json.loads(Path(options["compare"]).read_text())
+            self.stdout.write(f"Compared with {baseline['commit']}:")
+            for name, seconds, baseline_seconds, ratio in benchmarks.compare(results, baseline["results"]):
+                self.stdout.write(f"{name:<50} {baseline_seconds * 1000:12.4f} ms -> {seconds * 1000:12.4f} ms {ratio:8.2f}x")
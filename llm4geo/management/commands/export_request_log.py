@@ -0,0 +1,72 @@
+import json
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from llm4geo.models import LoggedProject, RequestLog
+
+
+def to_json(entry, project_description=None):
+    line = {
+        "request_id": entry.request_id,
+        "created": entry.created.isoformat(),
+        "view": entry.view,
+        "model": entry.model,
+        "text_input": entry.text_input,
+        **entry.request,
+        "project_hash": entry.project_hash,
+        "response": entry.response,
+        "function_name": entry.function_name,
+        "status": entry.status,
+        "error": entry.error,
+        "seconds": entry.seconds,
+        "stages": entry.stages,
+        "retries": entry.retries,
+        "tokens": {
+            "prompt": entry.prompt_tokens, "completion": entry.completion_tokens, "cached": entry.cached_tokens,
+        },
+    }
+    if project_description is not None:
+        line["project_description"] = project_description
+    return line
+
+
+class Command(BaseCommand):
+    help = "Exports the request log as JSON lines, e.g. for train_router or replay."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", help="The file to write, defaults to stdout.")
+        parser.add_argument("--since", help="Only export requests made at or after this ISO 8601 time.")
+        parser.add_argument("--view", action="append", help="Only export requests to these views, e.g. qgis_chat_api.")
+        parser.add_argument("--projects", action="store_true", help="Include each request's project description.")
+
+    def handle(self, *args, **options):
+        entries = RequestLog.objects.using(settings.REQUEST_LOG_DATABASE).all()
+        if options["since"]:
+            since = parse_datetime(options["since"])
+            if since is None:
+                raise CommandError(f"--since {options['since']} is not an ISO 8601 time.")
+            entries = entries.filter(created__gte=since)
+        if options["view"]:
+            entries = entries.filter(view__in=options["view"])
+        projects = {}
+        output = open(options["output"], "w") if options["output"] else sys.stdout
+        count = 0
+        try:
+            for entry in entries.iterator():
+                project_description = None
+                if options["projects"] and entry.project_hash:
+                    if entry.project_hash not in projects:
+                        project = LoggedProject.objects.using(settings.REQUEST_LOG_DATABASE).filter(
+                            hash=entry.project_hash
+                        ).first()
+                        projects[entry.project_hash] = project.description if project else None
+                    project_description = projects[entry.project_hash]
+                output.write(json.dumps(to_json(entry, project_description)) + "\n")
+                count += 1
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        self.stderr.write(f"Exported {count} requests.")
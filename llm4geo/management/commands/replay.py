@@ -0,0 +1,72 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from llm4geo import replay
+from llm4geo.cache import normalize_text
+from llm4geo.fake_llm import ReplayChatModel
+
+
+class Command(BaseCommand):
+    help = "Replays recorded requests (e.g. from export_request_log) against the chat API and reports how it performed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("recordings", nargs="+", help="JSON lines files of recorded requests.")
+        parser.add_argument("--url", help="The API to replay against, defaults to this process with the test client.")
+        parser.add_argument("--rate", type=float, help="Requests per second, defaults to sending them all at once.")
+        parser.add_argument("--original-timing", action="store_true", help="Send requests as far apart as recorded.")
+        parser.add_argument("--speed", type=float, default=1.0, help="How much faster than recorded to replay.")
+        parser.add_argument("--concurrency", type=int, default=8, help="The most requests in flight at once.")
+        parser.add_argument("--limit", type=int, help="Only replay this many requests.")
+        parser.add_argument(
+            "--stub", action="store_true",
+            help="Answer LLM calls with the recorded responses instead of the configured model, in process only. "
+                 "Run the API with LLM_MODEL=replay and LLM_REPLAY_RECORDINGS to stub a server given with --url.",
+        )
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds each stubbed LLM call takes.")
+        parser.add_argument("--output", help="Where to save the report as JSON.")
+
+    def handle(self, *args, **options):
+        recordings = replay.read_recordings(options["recordings"], options["limit"])
+        if not recordings:
+            raise CommandError("No recorded requests with a text_input were found.")
+        if options["stub"] and options["url"]:
+            raise CommandError("--stub only applies in process, configure the server's LLM_MODEL instead.")
+        if options["url"]:
+            target = replay.HttpTarget(options["url"])
+            report = self.replay(target, recordings, options)
+        elif options["stub"]:
+            responses = {
+                normalize_text(recording["text_input"]): recording["response"]
+                for recording in recordings if recording.get("response") and not recording.get("error")
+            }
+            with override_settings(LLM_MODEL=ReplayChatModel.with_recordings(responses, options["latency"])):
+                report = self.replay(replay.InProcessTarget(), recordings, options)
+        else:
+            report = self.replay(replay.InProcessTarget(), recordings, options)
+
+        latency = report["latency"]
+        self.stdout.write(f"Replayed {report['requests']} requests ({report['skipped']} skipped without a project) "
+                          f"in {report['seconds']:.2f} s, {report['throughput'] or 0:.2f} requests/s")
+        if latency["p50"] is not None:
+            self.stdout.write(f"Latency p50 {latency['p50'] * 1000:.1f} ms, p95 {latency['p95'] * 1000:.1f} ms, "
+                              f"p99 {latency['p99'] * 1000:.1f} ms")
+        self.stdout.write(f"Errors {report['errors']} ({report['error_rate'] or 0:.1%})")
+        if report["cache_hit_rate"] is not None:
+            self.stdout.write(f"Cache hit rate {report['cache_hit_rate']:.1%}")
+        choices = report["choices"]
+        self.stdout.write(f"Choices changed {choices['changed']} of {choices['compared']}")
+        for change, count in choices["changes"].items():
+            self.stdout.write(f"  {change:<60} {count}")
+        if options["output"]:
+            Path(options["output"]).write_text(json.dumps(report, indent=2))
+            self.stdout.write(f"Saved the report to {options['output']}")
+
+    def replay(self, target, recordings, options):
+        cache_before = target.cache_stats()
+        results, seconds = replay.replay(
+            target, recordings, options["rate"], options["original_timing"], options["speed"], options["concurrency"]
+        )
+        return replay.report(results, seconds, cache_before, target.cache_stats())
@@ -0,0 +1,49 @@
+import json
+from collections import Counter
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from llm4geo.router import supported_functions
+from llm4geo.scoring import NaiveBayes, tokenize
+
+
+def read_examples(paths):
+    """
+    Yields (tokens, function_name) from JSON lines with a text_input and a function_name, either at the top level or
+    in a "response" object. Responses the router gave itself, which have a "route", are skipped so the router isn't
+    trained on its own predictions.
+    """
+    for path in paths:
+        with open(path) as lines:
+            for line in lines:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if (entry.get("response") or {}).get("route"):
+                    continue
+                function_name = entry.get("function_name") or (entry.get("response") or {}).get("function_name")
+                if entry.get("text_input") and function_name in supported_functions:
+                    yield tokenize(entry["text_input"]), function_name
+
+
+class Command(BaseCommand):
+    help = "Trains the router's function classifier on logged requests and the functions that were chosen for them."
+
+    def add_arguments(self, parser):
+        parser.add_argument("history", nargs="+", help="JSON lines files of logged requests.")
+        parser.add_argument("--output", help="Where to save the model, defaults to ROUTER_MODEL.")
+
+    def handle(self, *args, **options):
+        examples = list(read_examples(options["history"]))
+        if not examples:
+            raise CommandError("No requests with a text_input and a supported function_name were found.")
+        classifier = NaiveBayes.train(examples)
+        correct = sum(classifier.predict(tokens)[0] == function_name for tokens, function_name in examples)
+        output = Path(options["output"] or settings.ROUTER_MODEL)
+        output.write_text(json.dumps(classifier.to_dict()))
+        for function_name, count in Counter(function_name for _, function_name in examples).most_common():
+            self.stdout.write(f"{function_name:<30} {count}")
+        self.stdout.write(f"Trained on {len(examples)} requests, {correct / len(examples):.1%} classified correctly.")
+        self.stdout.write(f"Saved the model to {output}")
@@ -0,0 +1,242 @@
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+from llm4geo import cache, gazetteer, repair, router, single_flight, speculation
+
+logger = logging.getLogger(__name__)
+
+# The id of the request being handled and the stages it ran, set by RequestMetricsMiddleware.
+request_id = ContextVar("llm4geo_request_id", default="-")
+request_stages = ContextVar("llm4geo_request_stages", default=None)
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Adds the current request id to log records so log lines can be tied to a request.
+    """
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class Metric(ABC):
+    """
+    A labelled metric kept in this worker's memory and rendered in the Prometheus text format.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self):
+        """
+        Returns the (name, labels, value) samples to render.
+        """
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name}{format_labels(labels)} {value}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = counts, total + value
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        samples = []
+        for key, (counts, total) in sorted(values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bucket, count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", {**labels, "le": bucket}, cumulative))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+class StatsCollector(Metric):
+    """
+    Exposes one of the existing get_stats() counters, read when the metrics are rendered.
+    """
+    type = "counter"
+
+    def __init__(self, name, documentation, labelname, get_stats):
+        super().__init__(name, documentation, (labelname,))
+        self.get_stats = get_stats
+
+    def samples(self):
+        return [(self.name, {self.labelnames[0]: event}, count) for event, count in sorted(self.get_stats().items())]
+
+
+registry = []
+
+request_seconds = Histogram(
+    "llm4geo_request_seconds", "Time to respond to a request.", ["view", "method", "status"]
+)
+response_bytes = Histogram(
+    "llm4geo_response_bytes", "Size of non-streaming response bodies.", ["view"],
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576),
+)
+stage_seconds = Histogram(
+    "llm4geo_stage_seconds", "Time spent in each stage of answering a request.", ["stage", "function"]
+)
+tokens = Counter(
+    "llm4geo_tokens_total", "LLM tokens used per stage, kind is prompt, completion or cached.", ["stage", "function", "kind"]
+)
+retries = Counter("llm4geo_retries_total", "LLM calls repeated because of an invalid response.", ["stage", "function"])
+escalations = Counter(
+    "llm4geo_escalations_total", "LLM calls repeated with LLM_ESCALATION_MODEL after the retries were used up.",
+    ["stage", "function"],
+)
+validation_failures = Counter(
+    "llm4geo_validation_failures_total", "LLM responses that didn't match the schema.", ["stage", "function"]
+)
+prompt_tokens = Histogram(
+    "llm4geo_prompt_section_tokens", "Estimated tokens of each prompt section when it was built.", ["prompt", "section"],
+    buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000),
+)
+
+
+def register_stats(name, documentation, labelname, get_stats):
+    return StatsCollector(name, documentation, labelname, get_stats)
+
+
+register_stats("llm4geo_response_cache_total", "Response cache lookups by outcome.", "event", cache.get_stats)
+register_stats("llm4geo_speculation_total", "Speculative parameter extraction by outcome.", "outcome", speculation.get_stats)
+register_stats("llm4geo_repair_total", "Invalid responses repaired locally or sent back to the LLM.", "outcome", repair.get_stats)
+register_stats("llm4geo_gazetteer_total", "go_to_location place lookups by outcome.", "outcome", gazetteer.get_stats)
+register_stats("llm4geo_router_total", "Functions chosen by local rules, the classifier or the LLM.", "route", router.get_stats)
+register_stats(
+    "llm4geo_single_flight_total", "LLM calls led or shared with concurrent identical requests.", "outcome",
+    single_flight.get_stats,
+)
+
+
+def render():
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+class UsageHandler(BaseCallbackHandler):
+    """
+    Adds up the token usage of the LLM calls made during a stage.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.usage = {"prompt": 0, "completion": 0, "cached": 0}
+
+    def on_llm_end(self, response, **kwargs):
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        details = token_usage.get("prompt_tokens_details") or {}
+        with self.lock:
+            self.usage["prompt"] += token_usage.get("prompt_tokens") or 0
+            self.usage["completion"] += token_usage.get("completion_tokens") or 0
+            self.usage["cached"] += details.get("cached_tokens") or 0
+
+
+_usage_handler = ContextVar("llm4geo_usage_handler", default=None)
+# Like get_openai_callback, LLM calls made while the variable is set report to the handler.
+register_configure_hook(_usage_handler, True)
+
+
+@contextmanager
+def resumed_request(request_id_value, stages):
+    """
+    Restores the id and stage records of a request for code that runs after the middleware has returned, such as the
+    generator of a streaming response.
+    """
+    tokens = request_id.set(request_id_value), request_stages.set(stages)
+    try:
+        yield
+    finally:
+        try:
+            request_stages.reset(tokens[1])
+            request_id.reset(tokens[0])
+        except ValueError:
+            # Closed from a different context, e.g. a generator garbage collected elsewhere.
+            pass
+
+
+@contextmanager
+def stage(name, function="", model=None):
+    """
+    Times a stage of answering a request and counts the tokens of the LLM calls made in it, made with model if given.
+    """
+    handler = UsageHandler()
+    token = _usage_handler.set(handler)
+    start = time.perf_counter()
+    try:
+        yield handler
+    finally:
+        seconds = time.perf_counter() - start
+        try:
+            _usage_handler.reset(token)
+        except ValueError:
+            # Reset from a different context, e.g. a generator resumed elsewhere.
+            _usage_handler.set(None)
+        stage_seconds.observe(seconds, stage=name, function=function)
+        for kind, count in handler.usage.items():
+            if count:
+                tokens.inc(count, stage=name, function=function, kind=kind)
+        record = {"stage": name, "function": function, "seconds": round(seconds, 4), "tokens": handler.usage}
+        if model:
+            record["model"] = model
+        stages = request_stages.get()
+        if stages is not None:
+            stages.append(record)
+        logger.debug("stage %s", json.dumps(record))
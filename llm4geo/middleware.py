@@ -0,0 +1,231 @@
+import hashlib
+import json
+import logging
+import time
+import uuid
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+
+from llm4geo import single_flight
+from llm4geo.metrics import request_id, request_seconds, request_stages, response_bytes, resumed_request
+
+logger = logging.getLogger(__name__)
+
+
+class RequestMetricsMiddleware:
+    """
+    Gives each request an id (X-Request-ID), records its latency and response size and logs a summary of its stages.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def start(self, request):
+        request.id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+        request.started = time.perf_counter()
+        return request_id.set(request.id), request_stages.set([]), request.started
+
+    def finish(self, request, response, tokens, start):
+        response["X-Request-ID"] = request.id
+        stages = request_stages.get()
+        if not response.streaming:
+            self.record(request, response, start, stages, len(response.content))
+        request_id_token, stages_token = tokens
+        request_stages.reset(stages_token)
+        request_id.reset(request_id_token)
+        if response.streaming:
+            return self.record_stream(request, response, start, stages)
+        return response
+
+    def record(self, request, response, start, stages, size):
+        seconds = time.perf_counter() - start
+        view = request.resolver_match.url_name if request.resolver_match else "unknown"
+        request_seconds.observe(seconds, view=view, method=request.method, status=response.status_code)
+        response_bytes.observe(size, view=view)
+        summary = {"view": view, "status": response.status_code, "seconds": round(seconds, 4), "bytes": size}
+        summary["stages"] = stages
+        logger.debug("request %s", json.dumps(summary))
+
+    def record_stream(self, request, response, start, stages):
+        """
+        Records a streaming response once its stream has ended or been closed, so the latency covers the whole stream.
+        """
+        streaming_content = response.streaming_content
+
+        def content():
+            size = 0
+            try:
+                for chunk in streaming_content:
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                with resumed_request(request.id, stages):
+                    self.record(request, response, start, stages, size)
+
+        async def acontent():
+            size = 0
+            try:
+                async for chunk in streaming_content:
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                with resumed_request(request.id, stages):
+                    self.record(request, response, start, stages, size)
+
+        response.streaming_content = acontent() if response.is_async else content()
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        *tokens, start = self.start(request)
+        return self.finish(request, self.get_response(request), tokens, start)
+
+    async def __acall__(self, request):
+        *tokens, start = self.start(request)
+        return self.finish(request, await self.get_response(request), tokens, start)
+
+
+class IdempotencyMiddleware:
+    """
+    Replays the response to a POST with an Idempotency-Key header that was already answered, so a client can safely
+    retry after a timeout. A retry that arrives while the first request is still running waits for its response.
+
+    Only views with idempotent = True are covered. The key is scoped to the view and the request body, and only
+    complete 2xx responses are stored.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def get_key(self, request):
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if not idempotency_key or request.method != "POST":
+            return None
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None
+        if not getattr(getattr(match.func, "view_class", None), "idempotent", False):
+            return None
+        body_hash = hashlib.sha256(request.body).hexdigest()[:32]
+        return f"idempotency:{match.url_name}:{hashlib.sha256(idempotency_key.encode()).hexdigest()[:32]}:{body_hash}"
+
+    def replay(self, stored):
+        status, content_type, content = stored
+        response = HttpResponse(content, status=status, content_type=content_type)
+        response["Idempotent-Replayed"] = "true"
+        return response
+
+    def lookup(self, key):
+        try:
+            return caches[settings.IDEMPOTENCY_STORE].get(key)
+        except Exception as e:
+            logger.warning(f"Failed to look up the idempotent response: {e}")
+            return None
+
+    def store(self, key, response, content):
+        """
+        Returns what was stored for the response, or None when it shouldn't be replayed.
+        """
+        if content is None or not 200 <= response.status_code < 300 or not getattr(response, "idempotent", True):
+            return None
+        stored = (response.status_code, response["Content-Type"], content)
+        try:
+            caches[settings.IDEMPOTENCY_STORE].set(key, stored, settings.IDEMPOTENCY_TTL)
+        except Exception as e:
+            logger.warning(f"Failed to store the idempotent response: {e}")
+        return stored
+
+    def record_stream(self, key, response, flight):
+        """
+        Stores a streaming response once the stream has ended.
+        """
+        streaming_content, chunks = response.streaming_content, []
+
+        def content():
+            stored = None
+            try:
+                for chunk in streaming_content:
+                    chunks.append(chunk)
+                    yield chunk
+                stored = self.store(key, response, b"".join(chunks))
+            finally:
+                if flight:
+                    flight.finish(stored)
+
+        async def acontent():
+            stored = None
+            try:
+                async for chunk in streaming_content:
+                    chunks.append(chunk)
+                    yield chunk
+                stored = await sync_to_async(self.store)(key, response, b"".join(chunks))
+            finally:
+                if flight:
+                    flight.finish(stored)
+
+        response.streaming_content = acontent() if response.is_async else content()
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        key = self.get_key(request)
+        if key is None:
+            return self.get_response(request)
+        stored, flight = self.lookup(key), None
+        if stored is None and settings.SINGLE_FLIGHT:
+            flight, leader = single_flight.join(key)
+            if not leader:
+                stored, flight = single_flight.wait(flight), None
+        if stored is not None:
+            return self.replay(stored)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            if flight:
+                flight.finish()
+            raise
+        if response.streaming:
+            return self.record_stream(key, response, flight)
+        stored = self.store(key, response, response.content)
+        if flight:
+            flight.finish(stored)
+        return response
+
+    async def __acall__(self, request):
+        key = self.get_key(request)
+        if key is None:
+            return await self.get_response(request)
+        stored, flight = await sync_to_async(self.lookup)(key), None
+        if stored is None and settings.SINGLE_FLIGHT:
+            flight, leader = single_flight.ajoin(key)
+            if not leader:
+                stored, flight = await single_flight.await_flight(flight), None
+        if stored is not None:
+            return self.replay(stored)
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            if flight:
+                flight.finish()
+            raise
+        if response.streaming:
+            return self.record_stream(key, response, flight)
+        stored = await sync_to_async(self.store)(key, response, response.content)
+        if flight:
+            flight.finish(stored)
+        return response
@@ -0,0 +1,47 @@
+# Generated by Django 5.1.1 on 2026-10-18 09:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm4geo', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoggedProject',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('description', models.JSONField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RequestLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(db_index=True)),
+                ('request_id', models.CharField(db_index=True, max_length=64)),
+                ('view', models.CharField(max_length=64)),
+                ('model', models.CharField(max_length=128)),
+                ('text_input', models.TextField(blank=True)),
+                ('request', models.JSONField(default=dict)),
+                ('project_hash', models.CharField(blank=True, db_index=True, max_length=64)),
+                ('response', models.JSONField(null=True)),
+                ('function_name', models.CharField(blank=True, db_index=True, max_length=64)),
+                ('status', models.PositiveSmallIntegerField(default=200)),
+                ('error', models.TextField(blank=True)),
+                ('seconds', models.FloatField(null=True)),
+                ('stages', models.JSONField(default=list)),
+                ('retries', models.PositiveIntegerField(default=0)),
+                ('prompt_tokens', models.PositiveIntegerField(default=0)),
+                ('completion_tokens', models.PositiveIntegerField(default=0)),
+                ('cached_tokens', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['created'],
+            },
+        ),
+    ]
@@ -1 +1,75 @@
+import uuid
+
 from django.db import models
+
+
+class ChatSession(models.Model):
+    """
+    A conversation kept on the server, so clients only send their new message with the session id.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    # A rolling summary of the turns before summarized_turns, written off the request path.
+    summary = models.TextField(blank=True, default="")
+    summarized_turns = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class ChatTurn(models.Model):
+    USER = "user"
+    ASSISTANT = "assistant"
+    ROLES = [(USER, "User"), (ASSISTANT, "Assistant")]
+
+    session = models.ForeignKey(ChatSession, related_name="turns", on_delete=models.CASCADE)
+    # The position of the turn in its session, starting at 0.
+    index = models.PositiveIntegerField()
+    role = models.CharField(max_length=16, choices=ROLES)
+    content = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["session", "index"]
+        constraints = [models.UniqueConstraint(fields=["session", "index"], name="unique_chat_turn_index")]
+
+    def __str__(self):
+        return f"{self.session_id} {self.index} {self.role}"
+
+
+class LoggedProject(models.Model):
+    """
+    A project description referred to by the request log, stored once per hash.
+    """
+    hash = models.CharField(max_length=64, primary_key=True)
+    description = models.JSONField()
+    created = models.DateTimeField(auto_now_add=True)
+
+
+class RequestLog(models.Model):
+    """
+    A sampled chat request and its response, written in the background by llm4geo.request_log.
+    """
+    created = models.DateTimeField(db_index=True)
+    request_id = models.CharField(max_length=64, db_index=True)
+    view = models.CharField(max_length=64)
+    model = models.CharField(max_length=128)
+    text_input = models.TextField(blank=True)
+    # The rest of the request body, without the project which is logged by project_hash.
+    request = models.JSONField(default=dict)
+    project_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    response = models.JSONField(null=True)
+    function_name = models.CharField(max_length=64, blank=True, db_index=True)
+    status = models.PositiveSmallIntegerField(default=200)
+    error = models.TextField(blank=True)
+    seconds = models.FloatField(null=True)
+    # The time and tokens of each stage, see llm4geo.metrics.stage.
+    stages = models.JSONField(default=list)
+    retries = models.PositiveIntegerField(default=0)
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    cached_tokens = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["created"]
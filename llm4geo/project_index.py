@@ -0,0 +1,91 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from llm4geo.schemas.qgis_project_description import get_project_hash
+from llm4geo.scoring import BM25, tokenize
+from llm4geo.tokens import count_tokens, message_text
+
+logger = logging.getLogger(__name__)
+
+layer_text_fields = ["name", "fields", "categories", "ranges", "rules"]
+
+
+def layer_tokens(layer):
+    values = []
+    for field in layer_text_fields:
+        value = layer.get(field) or []
+        values += value if isinstance(value, list) else [value]
+    return [token for value in values for token in tokenize(value)]
+
+
+class ProjectIndex:
+    """
+    A BM25 index over the layers of one project version along with the token count of each layer's JSON.
+    """
+
+    def __init__(self, project_description):
+        self.layers = list(project_description.get("layers") or [])
+        self.bm25 = BM25([layer_tokens(layer) for layer in self.layers])
+        self.layer_tokens = [count_tokens(json.dumps(layer, separators=(",", ":"))) for layer in self.layers]
+        self.total_tokens = sum(self.layer_tokens)
+
+    def select(self, query_tokens, budget, top_k):
+        """
+        Returns the indexes of the most relevant layers that fit within budget, in project order.
+        When nothing matches the query the layers are taken in project order instead.
+        """
+        ranked = self.bm25.top_k(query_tokens, top_k) or range(min(top_k, len(self.layers)))
+        selected, used = [], 0
+        for index in ranked:
+            if used + self.layer_tokens[index] > budget:
+                continue
+            selected.append(index)
+            used += self.layer_tokens[index]
+        return sorted(selected)
+
+
+# Indexes keyed by project hash, least recently used first.
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_project_index(project_description, project_hash=None):
+    project_hash = project_hash or get_project_hash(project_description)
+    with _indexes_lock:
+        if project_hash in _indexes:
+            _indexes.move_to_end(project_hash)
+            return _indexes[project_hash]
+    index = ProjectIndex(project_description)
+    with _indexes_lock:
+        _indexes[project_hash] = index
+        while len(_indexes) > settings.PROJECT_INDEX_CACHE_SIZE:
+            _indexes.popitem(last=False)
+    return index
+
+
+def prune_project(project_description, text, chat_history=None, budget=None, top_k=None, project_hash=None):
+    """
+    Returns the project description with only the layers relevant to the request when its layers are over budget.
+    The pruned description notes how many layers were left out so the model doesn't assume they don't exist.
+    Passing the project_hash the request was resolved with saves hashing the project again to find its index.
+    """
+    budget = budget or settings.PROJECT_TOKEN_BUDGET
+    layers = (project_description or {}).get("layers") or []
+    if not layers:
+        return project_description
+    index = get_project_index(project_description, project_hash)
+    if index.total_tokens <= budget:
+        return project_description
+    query_tokens = tokenize(" ".join([*map(message_text, chat_history or []), text]))
+    selected = index.select(query_tokens, budget, top_k or settings.PROJECT_TOP_K_LAYERS)
+    pruned = {key: value for key, value in project_description.items() if key != "layers"}
+    pruned["layers"] = [layers[i] for i in selected]
+    pruned["pruned"] = (
+        f"{len(layers) - len(selected)} of {len(layers)} layers were left out as less relevant to the request."
+    )
+    logger.debug(f"Pruned project description: {pruned['pruned']}")
+    return pruned
@@ -0,0 +1,71 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+
+from llm4geo.schemas.qgis_project_description import get_project_hash
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownProjectError(Exception):
+    """
+    Raised when a delta refers to a project version the server doesn't have, the client should resend it in full.
+    """
+
+
+def get_store():
+    return caches[settings.PROJECT_STORE]
+
+
+def store_project(project_description, project_hash=None):
+    """
+    Stores a project unless its hash is already stored, so a client resending the same project costs no write.
+    A failed store is logged rather than failing the request, a later delta against it gets an UnknownProjectError.
+    """
+    project_hash = project_hash or get_project_hash(project_description)
+    try:
+        get_store().add(project_hash, project_description, settings.PROJECT_STORE_TTL)
+    except Exception as e:
+        logger.warning(f"Failed to store project {project_hash}: {e}")
+    return project_hash
+
+
+def load_project(project_hash):
+    try:
+        return get_store().get(project_hash)
+    except Exception as e:
+        logger.warning(f"Failed to load project {project_hash}: {e}")
+        return None
+
+
+def apply_project_delta(project_description, project_delta):
+    """
+    Rebuilds a project description from a base version and the layers added, removed and changed since then.
+    Changed layers keep their position, removed layers are dropped and added layers are appended.
+    """
+    changed = {layer["id"]: layer for layer in project_delta.get("changed", [])}
+    removed = set(project_delta.get("removed", []))
+    project = {key: value for key, value in project_description.items() if key != "layers"}
+    project.update({key: value for key, value in project_delta.items() if key in ["title", "crs"]})
+    project["layers"] = [
+        changed.get(layer["id"], layer) for layer in project_description.get("layers", []) if layer["id"] not in removed
+    ]
+    project["layers"] += project_delta.get("added", [])
+    return project
+
+
+def resolve_project(project_description=None, project_delta=None):
+    """
+    Returns the full project description and its hash from either a full description or a delta.
+    """
+    if project_description is not None:
+        return project_description, store_project(project_description)
+    base_project = load_project(project_delta["base_hash"])
+    if base_project is None:
+        raise UnknownProjectError(f"Project {project_delta['base_hash']} is not known.")
+    project_description = apply_project_delta(base_project, project_delta)
+    project_hash = get_project_hash(project_description)
+    if project_delta.get("hash") and project_delta["hash"] != project_hash:
+        raise UnknownProjectError(f"Project delta from {project_delta['base_hash']} did not produce {project_delta['hash']}.")
+    return project_description, store_project(project_description, project_hash)
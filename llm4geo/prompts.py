@@ -0,0 +1,58 @@
+import logging
+
+from django.conf import settings
+from langchain_core.messages import SystemMessage
+
+from llm4geo import metrics
+from llm4geo.tokens import count_tokens, message_text
+
+logger = logging.getLogger(__name__)
+
+
+class PromptBuilder:
+    """
+    Assembles the system prompt from named sections, each included once, and keeps the prompt within a token budget.
+    """
+
+    def __init__(self, name, budget=None):
+        self.name = name
+        self.budget = budget or settings.PROMPT_TOKEN_BUDGET
+        self.sections = []
+        self.token_counts = {}
+
+    def add(self, name, text, required=True):
+        self.sections.append((name, text, required))
+        return self
+
+    def build(self, text, chat_history=None):
+        """
+        Returns the chain payload for text.  When over budget optional sections are dropped first, starting with
+        the last one added, then the oldest chat history.
+        """
+        section_counts = {name: count_tokens(section) for name, section, _ in self.sections}
+        input_count = count_tokens(text)
+        history = list(chat_history or [])
+        history_counts = [count_tokens(message_text(turn)) for turn in history]
+        sections = list(self.sections)
+
+        def total():
+            return sum(section_counts[name] for name, _, _ in sections) + input_count + sum(history_counts)
+
+        for section in reversed(self.sections):
+            if total() <= self.budget:
+                break
+            if not section[2]:
+                sections.remove(section)
+        while history and total() > self.budget:
+            history.pop(0)
+            history_counts.pop(0)
+        if total() > self.budget:
+            logger.warning(f"The {self.name} prompt is {total()} tokens which is over the budget of {self.budget}.")
+
+        self.token_counts = {name: section_counts[name] for name, _, _ in sections}
+        self.token_counts.update({"chat_history": sum(history_counts), "input": input_count, "total": total()})
+        for name, count in self.token_counts.items():
+            metrics.prompt_tokens.observe(count, prompt=self.name, section=name)
+        logger.debug(f"Prompt tokens for {self.name}: {self.token_counts}")
+        system = "\n\n".join(section for _, section, _ in sections)
+        return {"system": [SystemMessage(content=system)], "chat_history": history, "input": text}
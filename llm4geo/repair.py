@@ -0,0 +1,161 @@
+import json
+import threading
+from collections import Counter
+from copy import deepcopy
+from difflib import get_close_matches
+
+from django.conf import settings
+from jsonschema import Draft7Validator
+
+# Counts of responses fixed locally ("repaired") and ones that still needed the LLM ("fallback").
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def record(event):
+    with _stats_lock:
+        _stats[event] += 1
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _snap_to_enum(value, enum):
+    if value in enum:
+        return value
+    text_options = {str(option).lower(): option for option in enum}
+    if str(value).lower() in text_options:
+        return text_options[str(value).lower()]
+    # Prefer an option that contains the value or is contained by it, e.g. a uri missing its "type=xyz&" prefix.
+    contained = [option for option in enum if str(value).lower() in str(option).lower() or str(option).lower() in str(value).lower()]
+    if len(contained) == 1:
+        return contained[0]
+    matches = get_close_matches(str(value).lower(), list(text_options), n=1, cutoff=settings.REPAIR_ENUM_CUTOFF)
+    if matches:
+        return text_options[matches[0]]
+    return value
+
+
+def _coerce_number(value, integer):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        try:
+            value = float(value.strip())
+        except ValueError:
+            return value
+    if isinstance(value, float) and integer:
+        return int(round(value))
+    return value
+
+
+def _clamp(value, schema):
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return value
+    if "minimum" in schema:
+        value = max(value, schema["minimum"])
+    if "maximum" in schema:
+        value = min(value, schema["maximum"])
+    return value
+
+
+def _coerce_array(value):
+    if isinstance(value, str):
+        try:
+            parsed = json.loads(value)
+        except ValueError:
+            parsed = [item.strip() for item in value.strip("[]()").split(",") if item.strip()]
+        if isinstance(parsed, list):
+            return parsed
+    if isinstance(value, tuple):
+        return list(value)
+    return value
+
+
+def _select_variant(value, variants):
+    """
+    Picks the oneOf/anyOf variant whose const properties (e.g. function_name) match the value.
+    """
+    if not isinstance(value, dict):
+        return None
+    variant_consts = [
+        {name: prop["const"] for name, prop in variant.get("properties", {}).items() if "const" in prop}
+        for variant in variants
+    ]
+    for variant, consts in zip(variants, variant_consts):
+        if consts and all(value.get(name) == const for name, const in consts.items()):
+            return variant
+    # Otherwise snap the discriminator to the closest const across all variants.
+    for name in {name for consts in variant_consts for name in consts}:
+        if name not in value:
+            continue
+        snapped = _snap_to_enum(value[name], [consts[name] for consts in variant_consts if name in consts])
+        for variant, consts in zip(variants, variant_consts):
+            if consts.get(name) == snapped:
+                return variant
+    return None
+
+
+def repair_value(value, schema):
+    """
+    Returns value with mechanical mistakes fixed according to schema.
+    Anything that can't be fixed is left alone so validation still reports it.
+    """
+    for combinator in ["oneOf", "anyOf"]:
+        if combinator in schema:
+            variant = _select_variant(value, schema[combinator])
+            return repair_value(value, variant) if variant else value
+    if "const" in schema:
+        return schema["const"]
+    schema_type = schema.get("type")
+    if schema_type in ["integer", "number"]:
+        value = _clamp(_coerce_number(value, schema_type == "integer"), schema)
+    elif schema_type == "string" and isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value)
+    elif schema_type == "array":
+        value = _coerce_array(value)
+        if isinstance(value, list) and "items" in schema:
+            value = [repair_value(item, schema["items"]) for item in value]
+            if "maxItems" in schema:
+                value = value[:schema["maxItems"]]
+    elif schema_type == "object" and isinstance(value, dict):
+        value = _repair_object(value, schema)
+    if "enum" in schema and schema["enum"]:
+        value = _snap_to_enum(value, schema["enum"])
+    return value
+
+
+def _repair_object(value, schema):
+    properties = schema.get("properties", {})
+    repaired = {}
+    for name, item in value.items():
+        if name in properties:
+            repaired[name] = repair_value(item, properties[name])
+        elif schema.get("additionalProperties") is not False:
+            repaired[name] = item
+    for name in schema.get("required", []):
+        if name in repaired or name not in properties:
+            continue
+        if len(properties[name].get("enum", [])) == 1:
+            repaired[name] = properties[name]["enum"][0]
+        elif "const" in properties[name]:
+            repaired[name] = properties[name]["const"]
+        elif "default" in properties[name]:
+            repaired[name] = properties[name]["default"]
+    return repaired
+
+
+def repair(instance, schema, validator=None):
+    """
+    Tries to make instance valid against schema without calling the LLM.
+    Returns the repaired copy or None if it is still invalid.
+    """
+    validator = validator or Draft7Validator(schema)
+    repaired = repair_value(deepcopy(instance), schema)
+    if validator.is_valid(repaired):
+        record("repaired")
+        return repaired
+    record("fallback")
+    return None
@@ -0,0 +1,225 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import httpx
+from django.conf import settings
+from django.test import Client
+from django.urls import reverse
+
+from llm4geo import cache
+
+# The views recordings can be replayed against and the request fields each of them accepts.
+view_fields = {
+    "data_chat_api": ["text_input"],
+    "qgis_chat_api": ["text_input", "chat_history", "plan", "project_description"],
+    "qgis_chat_stream_api": ["text_input", "chat_history", "plan", "project_description"],
+}
+cache_hit_events = ["local_hit", "shared_hit"]
+cache_metric = re.compile(r'^llm4geo_response_cache_total\{event="(\w+)"\} ([0-9.e+]+)$', re.MULTILINE)
+
+
+def read_recordings(paths, limit=None):
+    """
+    Returns the requests in JSON lines files such as an export_request_log export, lines need at least a text_input.
+    """
+    recordings = []
+    for path in paths:
+        with open(path) as lines:
+            for line in lines:
+                if line.strip():
+                    entry = json.loads(line)
+                    if entry.get("text_input"):
+                        recordings.append(entry)
+                if limit and len(recordings) >= limit:
+                    return recordings
+    return recordings
+
+
+def get_view(recording):
+    if recording.get("view") in view_fields:
+        return recording["view"]
+    return "qgis_chat_api" if "project_description" in recording else "data_chat_api"
+
+
+def build_request(recording):
+    """
+    Returns the view to replay a recording against and the body to post, or None when the recording lacks its project.
+    Sessions aren't replayed, the recorded chat_history is sent instead.
+    """
+    view = get_view(recording)
+    if view != "data_chat_api" and recording.get("project_description") is None:
+        return None
+    return view, {field: recording[field] for field in view_fields[view] if field in recording}
+
+
+def get_choice(response):
+    """
+    What was chosen for a response: the function name, the functions of a plan's steps or a data source.
+    """
+    response = response or {}
+    if "steps" in response:
+        return "+".join(step.get("function_name", "?") for step in response["steps"])
+    return response.get("function_name") or response.get("dataSource")
+
+
+def parse_body(content_type, content):
+    """
+    Returns the response body, or its result (or error) event when it was streamed.
+    """
+    if not content_type.startswith("text/event-stream"):
+        return json.loads(content)
+    body = None
+    for event in content.decode().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in event.splitlines() if ": " in line)
+        if lines.get("event") in ["result", "error"]:
+            body = json.loads(lines["data"])
+    return body
+
+
+class InProcessTarget:
+    """
+    Posts requests to this process's API with the Django test client, one client per thread.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        hosts = [host.lstrip(".") for host in settings.ALLOWED_HOSTS if host != "*"]
+        self.host = hosts[0] if hosts else "localhost"
+
+    def post(self, view, body):
+        if not hasattr(self.local, "client"):
+            self.local.client = Client(HTTP_HOST=self.host)
+        response = self.local.client.post(reverse(view), body, content_type="application/json")
+        content = b"".join(response.streaming_content) if response.streaming else response.content
+        return response.status_code, response.get("Content-Type", ""), content
+
+    def cache_stats(self):
+        return cache.get_stats()
+
+
+class HttpTarget:
+    """
+    Posts requests to a running API.  Its cache stats are those of whichever worker answers /metrics.
+    """
+
+    def __init__(self, url, timeout=120):
+        self.url = url.rstrip("/")
+        self.client = httpx.Client(timeout=timeout)
+
+    def post(self, view, body):
+        response = self.client.post(f"{self.url}{reverse(view)}", json=body)
+        return response.status_code, response.headers.get("Content-Type", ""), response.content
+
+    def cache_stats(self):
+        try:
+            metrics = self.client.get(f"{self.url}/metrics").text
+        except httpx.HTTPError:
+            return {}
+        return {event: float(count) for event, count in cache_metric.findall(metrics)}
+
+
+def get_offsets(recordings, rate=None, original_timing=False, speed=1.0):
+    """
+    Returns when to send each recording in seconds from the start, all at once unless a rate or the original timing
+    (sped up by speed) is given.
+    """
+    if original_timing:
+        times = [datetime.fromisoformat(recording["created"]).timestamp() if recording.get("created") else None
+                 for recording in recordings]
+        start = min((created for created in times if created is not None), default=0)
+        return [(created - start) / speed if created is not None else 0 for created in times]
+    if rate:
+        return [index / rate for index in range(len(recordings))]
+    return [0] * len(recordings)
+
+
+def send(target, recording, scheduled=None):
+    """
+    Replays a recording, its latency is measured from when it was scheduled so time spent waiting to be sent counts.
+    """
+    request = build_request(recording)
+    result = {"text_input": recording["text_input"], "recorded": get_choice(recording.get("response")), "skipped": False}
+    if request is None:
+        return {**result, "skipped": True}
+    view, body = request
+    start = scheduled or time.perf_counter()
+    try:
+        status, content_type, content = target.post(view, body)
+        response = parse_body(content_type, content)
+        error = (response or {}).get("error") if status < 400 else f"{status}: {content[:200]!r}"
+    except Exception as e:
+        status, response, error = None, None, str(e)
+    return {**result, "view": view, "status": status, "seconds": time.perf_counter() - start, "error": error,
+            "replayed": get_choice(response)}
+
+
+def replay(target, recordings, rate=None, original_timing=False, speed=1.0, concurrency=8):
+    """
+    Sends the recordings to target on their schedule with up to concurrency requests in flight.
+    Returns the results in recording order and the seconds the replay took.
+    """
+    offsets = get_offsets(recordings, rate, original_timing, speed)
+    scheduled = rate or original_timing
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
+        for index in sorted(range(len(recordings)), key=offsets.__getitem__):
+            delay = start + offsets[index] - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures[index] = executor.submit(
+                send, target, recordings[index], start + offsets[index] if scheduled else None
+            )
+        results = [futures[index].result() for index in range(len(recordings))]
+    return results, time.perf_counter() - start
+
+
+def percentile(values, q):
+    """
+    The nearest rank percentile of sorted values.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+def report(results, seconds, cache_before=None, cache_after=None):
+    """
+    Summarizes a replay: latency percentiles, throughput, errors, the cache hit rate and how the choices changed.
+    """
+    sent = [result for result in results if not result["skipped"]]
+    latencies = sorted(result["seconds"] for result in sent)
+    errors = [result for result in sent if result["error"]]
+    lookups = Counter(cache_after or {})
+    lookups.subtract(cache_before or {})
+    total_lookups = sum(lookups.values())
+    compared = [result for result in sent if not result["error"] and result["recorded"] is not None]
+    changes = Counter(
+        f"{result['recorded']} -> {result['replayed']}" for result in compared if result["recorded"] != result["replayed"]
+    )
+    return {
+        "requests": len(sent),
+        "skipped": len(results) - len(sent),
+        "seconds": round(seconds, 4),
+        "throughput": round(len(sent) / seconds, 4) if seconds else None,
+        "errors": len(errors),
+        "error_rate": round(len(errors) / len(sent), 4) if sent else None,
+        "latency": {
+            "p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "p99": percentile(latencies, 99),
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+        },
+        "cache_hit_rate": (
+            round(sum(lookups[event] for event in cache_hit_events) / total_lookups, 4) if total_lookups else None
+        ),
+        "choices": {"compared": len(compared), "changed": sum(changes.values()), "changes": dict(changes.most_common())},
+        "changed_inputs": [
+            {"text_input": result["text_input"], "recorded": result["recorded"], "replayed": result["replayed"]}
+            for result in compared if result["recorded"] != result["replayed"]
+        ],
+        "error_inputs": [{"text_input": result["text_input"], "error": result["error"]} for result in errors],
+    }
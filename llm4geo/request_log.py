@@ -0,0 +1,205 @@
+import logging
+import queue
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from llm4geo import metrics
+from llm4geo.models import LoggedProject, RequestLog
+
+logger = logging.getLogger(__name__)
+
+# Request body fields that aren't logged with the request, the project is logged once per hash instead.
+project_fields = ["project_description", "project_delta"]
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+_writer = None
+_writer_lock = threading.Lock()
+# Hashes of the projects this worker has queued or written recently, so each description is only held in the queue
+# and inserted once.
+_known_projects = OrderedDict()
+_known_projects_lock = threading.Lock()
+known_projects_size = 1024
+
+
+def _record(event, count=1):
+    with _stats_lock:
+        _stats[event] += count
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+# Registered here rather than in llm4geo.metrics, which is imported by the logging config before the models are ready.
+metrics.register_stats(
+    "llm4geo_request_log_total", "Requests logged, sampled out, dropped on overflow or failed to write.", "event",
+    get_stats,
+)
+
+
+@lru_cache(maxsize=None)
+def get_queue():
+    return queue.Queue(maxsize=settings.REQUEST_LOG_QUEUE_SIZE)
+
+
+def _request_fields(request):
+    try:
+        return {key: value for key, value in request.data.items() if key not in project_fields}
+    except Exception:
+        # The body couldn't be parsed, which is the error being logged.
+        return {}
+
+
+def _total(stages, kind):
+    return sum(stage["tokens"].get(kind, 0) for stage in stages)
+
+
+def _remember_project(project_hash):
+    """
+    Returns whether project_hash is new to this worker, remembering it if so.
+    """
+    with _known_projects_lock:
+        if project_hash in _known_projects:
+            _known_projects.move_to_end(project_hash)
+            return False
+        _known_projects[project_hash] = True
+        if len(_known_projects) > known_projects_size:
+            _known_projects.popitem(last=False)
+        return True
+
+
+def _forget_projects(project_hashes):
+    with _known_projects_lock:
+        for project_hash in project_hashes:
+            _known_projects.pop(project_hash, None)
+
+
+def record(request, response=None, project_description=None, project_hash=None, error=None, status=200):
+    """
+    Queues a log entry for a chat request, returns whether it was queued.
+    Only the entry is built on the request path, it is dropped rather than waited on when the queue is full.
+    """
+    if not settings.REQUEST_LOG_ENABLED:
+        return False
+    if random.random() >= settings.REQUEST_LOG_SAMPLE_RATE:
+        _record("sampled_out")
+        return False
+    fields = _request_fields(request)
+    stages = list(metrics.request_stages.get() or [])
+    started = getattr(request, "started", None)
+    # The models the stages were answered with, a stage may have been escalated to a larger one.
+    models = sorted({stage["model"] for stage in stages if stage.get("model")})
+    entry = RequestLog(
+        created=timezone.now(),
+        request_id=getattr(request, "id", None) or metrics.request_id.get(),
+        view=request.resolver_match.url_name if request.resolver_match else "unknown",
+        model=",".join(models)[:128] or settings.OPENAI_MODEL,
+        text_input=fields.pop("text_input", ""),
+        request=fields,
+        project_hash=project_hash or "",
+        response=response,
+        function_name=(response or {}).get("function_name") or "",
+        status=status,
+        error=str(error) if error else "",
+        seconds=round(time.perf_counter() - started, 4) if started else None,
+        stages=stages,
+        retries=sum(1 for stage in stages if "retry" in stage["stage"]),
+        prompt_tokens=_total(stages, "prompt"),
+        completion_tokens=_total(stages, "completion"),
+        cached_tokens=_total(stages, "cached"),
+    )
+    project = None
+    if project_hash and project_description is not None and _remember_project(project_hash):
+        project = (project_hash, project_description)
+    try:
+        get_queue().put_nowait((entry, project))
+    except queue.Full:
+        if project:
+            _forget_projects([project_hash])
+        _record("dropped")
+        return False
+    _record("queued")
+    start_writer()
+    return True
+
+
+def write(batch):
+    """
+    Inserts a batch of queued entries, and the projects queued with them.
+    """
+    database = settings.REQUEST_LOG_DATABASE
+    projects = {project[0]: project[1] for _, project in batch if project}
+    try:
+        close_old_connections()
+        if projects:
+            LoggedProject.objects.using(database).bulk_create(
+                [LoggedProject(hash=project_hash, description=description) for project_hash, description in projects.items()],
+                ignore_conflicts=True,
+            )
+        RequestLog.objects.using(database).bulk_create([entry for entry, _ in batch])
+    except Exception as e:
+        # The next entry for these projects queues their descriptions again.
+        _forget_projects(projects)
+        _record("write_failed", len(batch))
+        logger.exception(f"Failed to write {len(batch)} request log entries: {e}")
+        return 0
+    _record("written", len(batch))
+    return len(batch)
+
+
+def drain(block=False):
+    """
+    Returns up to REQUEST_LOG_BATCH_SIZE queued entries, when block is set waiting for the first one.
+    """
+    log_queue, batch = get_queue(), []
+    try:
+        batch.append(log_queue.get() if block else log_queue.get_nowait())
+        while len(batch) < settings.REQUEST_LOG_BATCH_SIZE:
+            batch.append(log_queue.get_nowait())
+    except queue.Empty:
+        pass
+    return batch
+
+
+def flush():
+    """
+    Writes everything queued so far on the calling thread, returns the number of entries written.
+    """
+    written = 0
+    while batch := drain():
+        written += write(batch)
+    return written
+
+
+def _write_forever():
+    while True:
+        batch = drain(block=True)
+        write(batch)
+        if len(batch) < settings.REQUEST_LOG_BATCH_SIZE:
+            # Let entries collect so they are inserted together rather than one by one.
+            time.sleep(settings.REQUEST_LOG_FLUSH_INTERVAL)
+
+
+def start_writer():
+    global _writer
+    if _writer is not None and _writer.is_alive():
+        return _writer
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_write_forever, name="request-log", daemon=True)
+            _writer.start()
+    return _writer
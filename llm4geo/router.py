@@ -0,0 +1,130 @@
+import json
+import logging
+import re
+import threading
+from collections import Counter
+from copy import deepcopy
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+
+from llm4geo.gazetteer import bbox, get_gazetteer
+from llm4geo.schemas.supported_functions import get_supported_functions
+from llm4geo.scoring import NaiveBayes, tokenize
+
+logger = logging.getLogger(__name__)
+
+supported_functions = get_supported_functions()
+
+openstreetmap = {
+    "uri": "type=xyz&url=https://tile.openstreetmap.org/{z}/{x}/{y}.png",
+    "layer_name": "OpenStreetMap",
+    "provider": "wms",
+}
+
+# Commands that mean exactly one function call, matched against the whole tokenized input.
+rules = [
+    (
+        re.compile(r"(please )?(remove|delete|clear|drop) (all|every)( of)?( the)?( map)? layers?( from( the)? map)?"),
+        "remove_all_map_layers", {}, "Removing all layers from the map.",
+    ),
+    (
+        re.compile(r"(please )?(clear|reset|empty|wipe)( the| my)? map"),
+        "remove_all_map_layers", {}, "Removing all layers from the map.",
+    ),
+    (
+        re.compile(r"(please )?(add|load|show|open)( an?| the| me)? (openstreetmap|osm|open street map)"
+                   r"( basemap| base map| map| layer| tiles)?"),
+        "add_map_layer", openstreetmap, "Adding OpenStreetMap.",
+    ),
+]
+
+# Going to a place, which is routed when the rest of the input is a name in the gazetteer.
+place_command = re.compile(
+    r"(please )?(zoom|go|navigate|fly|pan|move|jump|take me)( in| back| over)?( to| on| over)?( the)? (?P<place>.+)"
+)
+
+# The chat sent with functions chosen by the classifier.
+chat_templates = {
+    "add_map_layer": "Adding the layer to the map.",
+    "add_feature_layer": "Adding the layer to the map.",
+    "color_category": "Coloring the category.",
+    "color_range": "Coloring the range.",
+    "color_rule": "Coloring the rule.",
+    "remove_all_map_layers": "Removing all layers from the map.",
+    "go_to_location": "Going to the location.",
+}
+
+# Counters for this worker, keyed by how the function was chosen: "rule", "classifier" or "llm".
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _record(event):
+    with _stats_lock:
+        _stats[event] += 1
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+@lru_cache(maxsize=4)
+def load_classifier(path):
+    """
+    Returns the classifier trained with `manage.py train_router`, loaded on first use, or None without one.
+    """
+    if not path or not Path(path).exists():
+        return None
+    try:
+        return NaiveBayes.from_dict(json.loads(Path(path).read_text()))
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Failed to load the router model {path}: {e}")
+        return None
+
+
+def get_classifier():
+    return load_classifier(str(settings.ROUTER_MODEL or ""))
+
+
+def route(text):
+    """
+    Chooses the function for unambiguous inputs without the LLM. Returns None when the LLM should choose, otherwise
+    the function_name, its parameters (None when the LLM should still provide them), the chat and the route.
+    """
+    if not settings.ROUTER_ENABLED:
+        return None
+    tokens = tokenize(text)
+    normalized = " ".join(tokens)
+    for pattern, function_name, parameters, chat in rules:
+        if pattern.fullmatch(normalized):
+            _record("rule")
+            return {"function_name": function_name, "parameters": deepcopy(parameters), "chat": chat,
+                    "route": {"source": "rule", "confidence": 1.0}}
+    match = place_command.fullmatch(normalized)
+    if match and settings.GAZETTEER_ENABLED:
+        places = get_gazetteer().exact(match["place"])
+        if places:
+            _record("rule")
+            return {"function_name": "go_to_location", "parameters": bbox(places[0]), "chat": f"Going to {places[0]['name']}.",
+                    "route": {"source": "rule", "confidence": 1.0}}
+    classifier = get_classifier()
+    if classifier is not None:
+        function_name, confidence = classifier.predict(tokens)
+        if function_name in supported_functions and confidence >= settings.ROUTER_THRESHOLD:
+            _record("classifier")
+            return {
+                "function_name": function_name,
+                "parameters": None if "properties" in supported_functions[function_name] else {},
+                "chat": chat_templates.get(function_name, f"Calling {function_name}."),
+                "route": {"source": "classifier", "confidence": round(confidence, 4)},
+            }
+    _record("llm")
+    return None
@@ -1,3 +1,7 @@
+import hashlib
+import json
+
+
 def get_qgis_project_description():
     return {
         "$schema": "http://json-schema.org/draft-07/schema#",
@@ -84,3 +88,18 @@ def get_qgis_project_description():
         },
         "required": ["title", "file_path", "crs", "layers"]
     }
+
+
+def get_project_hash(project_description):
+    return hashlib.sha256(json.dumps(project_description, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def get_project_legend():
+    """
+    A short description of the project description fields, used in prompts instead of the full JSON schema.
+    """
+    schema = get_qgis_project_description()
+    layer_properties = schema["properties"]["layers"]["items"]["properties"]
+    lines = [f"{name}: {field['description']}" for name, field in schema["properties"].items() if name != "layers"]
+    lines += [f"layers[].{name}: {field['description']}" for name, field in layer_properties.items()]
+    return "The project description fields are:\n" + "\n".join(lines)
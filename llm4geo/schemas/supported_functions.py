@@ -1,5 +1,11 @@
+from collections import OrderedDict
 from copy import deepcopy
-import json
+import threading
+
+from django.conf import settings
+from jsonschema import Draft7Validator
+
+from llm4geo.schemas.qgis_project_description import get_project_hash
 
 supported_functions = {
     "add_map_layer": {
@@ -188,7 +194,7 @@ function_name_schema = {
         "chat": {"type": "string",
                  "description": "Provide brief feedback to the user on which function you think should be called and why.  For example if the user says, 'Load osm' then you might pick the load_map_data since osm is available as a data source for that function."},
         "function_name": {"type": "string",
-                          "description": f"Choose a function name from one of the provided enumeration using this information {json.dumps(supported_functions)}. Note the available options for each of the functions and use that in consideration for the response.  For example if the user wants to load Road data, then add_feature_data would be the best response given that they want 'data' which most often means features or vector data, and there is a road layer available for that method.  Only use provided enums for function_name.  Don't make up new values for function_name.",
+                          "description": "Choose a function name from one of the provided enumeration using the supported functions listed in the instructions. Note the available options for each of the functions and use that in consideration for the response.  For example if the user wants to load Road data, then add_feature_data would be the best response given that they want 'data' which most often means features or vector data, and there is a road layer available for that method.  Only use provided enums for function_name.  Don't make up new values for function_name.",
                           "enum": [function_name for function_name in supported_functions.keys()],
                           }
     },
@@ -196,14 +202,170 @@ function_name_schema = {
 }
 
 
+def _function_call_variant(function_name, function_schema):
+    parameters = {"type": "object", "properties": {}, "additionalProperties": False}
+    parameters.update({key: value for key, value in function_schema.items() if key in ["properties", "required"]})
+    return {
+        "type": "object",
+        "title": function_name,
+        "description": function_schema["description"],
+        "properties": {
+            "chat": function_name_schema["properties"]["chat"],
+            "function_name": {"type": "string", "const": function_name},
+            "parameters": parameters,
+        },
+        "required": ["chat", "function_name", "parameters"],
+        "additionalProperties": False,
+    }
+
+
+# Used to choose a function and its parameters in a single call, function_name discriminates the oneOf.
+function_call_schema = {
+    "$schema": "http://json-schema.org/draft-07/schema#",
+    "title": "GetFunctionCall",
+    "description": function_name_schema["description"],
+    "type": "object",
+    "properties": {
+        "function_call": {
+            "oneOf": [_function_call_variant(function_name, function_schema)
+                      for function_name, function_schema in supported_functions.items()]
+        }
+    },
+    "required": ["function_call"]
+}
+
+
+def _plan_step_variant(function_name, function_schema):
+    variant = _function_call_variant(function_name, function_schema)
+    del variant["properties"]["chat"]
+    variant["required"].remove("chat")
+    return variant
+
+
+def _summarize_function(function_name, function_schema):
+    properties = function_schema.get("properties", {})
+    lines = [f"- {function_name}({', '.join(properties)}): {' '.join(function_schema['description'].split())}"]
+    for property_name, property_schema in properties.items():
+        if "enum" in property_schema:
+            lines.append(f"    {property_name}: {' '.join(property_schema.get('description', '').split())}")
+    return "\n".join(lines)
+
+
+# A compact listing of the functions for choosing a function name, the full schemas are only sent for parameters.
+function_summaries = "\n".join(
+    _summarize_function(function_name, function_schema) for function_name, function_schema in supported_functions.items()
+)
+
+
+def get_function_summaries():
+    return function_summaries
+
+
 def get_function_name_schema():
     return deepcopy(function_name_schema)
 
 
+def get_function_call_schema(project_description=None):
+    if not project_description:
+        return deepcopy(function_call_schema)
+    schema = deepcopy(function_call_schema)
+    schema["properties"]["function_call"]["oneOf"] = [
+        _function_call_variant(function_name, specialize_function_schema(function_name, project_description))
+        for function_name in supported_functions
+    ]
+    return schema
+
+
+def get_plan_schema(project_description=None):
+    """
+    The schema for an ordered list of function calls, each step validated against its function's parameters.
+    """
+    return {
+        "$schema": "http://json-schema.org/draft-07/schema#",
+        "title": "GetPlan",
+        "description": function_name_schema["description"],
+        "type": "object",
+        "properties": {
+            "chat": function_name_schema["properties"]["chat"],
+            "steps": {
+                "type": "array",
+                "description": "The function calls that carry out the users request, in the order they should run.",
+                "minItems": 1,
+                "maxItems": settings.PLAN_MAX_STEPS,
+                "items": {"oneOf": [
+                    _plan_step_variant(function_name, specialize_function_schema(function_name, project_description))
+                    for function_name in supported_functions
+                ]},
+            },
+        },
+        "required": ["chat", "steps"],
+    }
+
+
 def get_supported_functions():
     return deepcopy(supported_functions)
 
 
-def get_function_schema(function_name, project_description):
+# The project description list that each color function picks renderer labels from.
+renderer_lists = {"color_category": "categories", "color_range": "ranges", "color_rule": "rules"}
+
+
+def specialize_function_schema(function_name, project_description):
+    """
+    Restricts layer and renderer names to the ones in the users project so the model doesn't have to guess them.
+    """
+    function_schema = deepcopy(supported_functions[function_name])
+    if function_name not in renderer_lists:
+        return function_schema
+    renderer_list = renderer_lists[function_name]
+    layers = [layer for layer in (project_description or {}).get("layers") or [] if layer.get(renderer_list)]
+    if layers:
+        properties = function_schema["properties"]
+        properties["layer_name"]["enum"] = list(dict.fromkeys(layer.get("name") for layer in layers))
+        properties["renderer_name"]["enum"] = list(dict.fromkeys(
+            label for layer in layers for label in layer[renderer_list]
+        ))
+    return function_schema
+
 
-    return supported_functions[function_name]
+# (schema, validator) pairs keyed by function name and project hash, least recently used first.
+_specialized = OrderedDict()
+_specialized_lock = threading.Lock()
+
+
+def _get_specialized(key, build):
+    with _specialized_lock:
+        if key in _specialized:
+            _specialized.move_to_end(key)
+            return _specialized[key]
+    schema = build()
+    specialized = schema, Draft7Validator(schema)
+    with _specialized_lock:
+        _specialized[key] = specialized
+        while len(_specialized) > settings.SCHEMA_CACHE_SIZE:
+            _specialized.popitem(last=False)
+    return specialized
+
+
+def get_specialized_function(function_name, project_description):
+    """
+    Returns the function schema specialized for the project and its compiled validator.
+    """
+    project_hash = get_project_hash(project_description) if function_name in renderer_lists else None
+    return _get_specialized(
+        (function_name, project_hash), lambda: specialize_function_schema(function_name, project_description)
+    )
+
+
+def get_specialized_function_call(project_description):
+    return _get_specialized(
+        ("function_call", get_project_hash(project_description)), lambda: get_function_call_schema(project_description)
+    )
+
+
+def get_specialized_plan(project_description):
+    return _get_specialized(("plan", get_project_hash(project_description)), lambda: get_plan_schema(project_description))
+
+
+def get_function_schema(function_name, project_description):
+    return get_specialized_function(function_name, project_description)[0]
@@ -0,0 +1,109 @@
+import math
+import re
+from collections import Counter
+
+token_pattern = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return token_pattern.findall(str(text).lower())
+
+
+class BM25:
+    """
+    A small Okapi BM25 index over tokenized documents, cheap enough to score every request locally.
+    """
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.documents = [Counter(tokens) for tokens in documents]
+        self.lengths = [len(tokens) for tokens in documents]
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        document_frequency = Counter(token for document in self.documents for token in document)
+        count = len(self.documents)
+        self.idf = {
+            token: math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+            for token, frequency in document_frequency.items()
+        }
+
+    def score(self, query_tokens, index):
+        document = self.documents[index]
+        length_norm = 1 - self.b + self.b * self.lengths[index] / (self.average_length or 1)
+        score = 0.0
+        for token in set(query_tokens):
+            frequency = document.get(token)
+            if frequency:
+                score += self.idf[token] * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        return score
+
+    def scores(self, query_tokens):
+        return [self.score(query_tokens, index) for index in range(len(self.documents))]
+
+    def top_k(self, query_tokens, k):
+        """
+        Returns the indexes of the k best scoring documents, ignoring documents that share no tokens with the query.
+        """
+        scored = [(score, index) for index, score in enumerate(self.scores(query_tokens)) if score > 0]
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [index for _, index in scored[:k]]
+
+
+class NaiveBayes:
+    """
+    A multinomial naive Bayes text classifier with add-one smoothing, trained on (tokens, label) examples.
+    It is stored as plain counts so a trained model can be saved as JSON.
+    """
+
+    def __init__(self, label_counts=None, token_counts=None):
+        self.label_counts = Counter(label_counts or {})
+        self.token_counts = {label: Counter(counts) for label, counts in (token_counts or {}).items()}
+        self.vocabulary = set(token for counts in self.token_counts.values() for token in counts)
+        self.totals = {label: sum(counts.values()) for label, counts in self.token_counts.items()}
+
+    @classmethod
+    def train(cls, examples):
+        label_counts, token_counts = Counter(), {}
+        for tokens, label in examples:
+            label_counts[label] += 1
+            token_counts.setdefault(label, Counter()).update(tokens)
+        return cls(label_counts, token_counts)
+
+    def probabilities(self, tokens):
+        """
+        Returns the probability of each label, ignoring tokens that weren't seen in training.
+        """
+        examples = sum(self.label_counts.values())
+        if not examples:
+            return {}
+        tokens = [token for token in tokens if token in self.vocabulary]
+        log_scores = {}
+        for label, count in self.label_counts.items():
+            counts = self.token_counts.get(label, {})
+            denominator = self.totals.get(label, 0) + len(self.vocabulary)
+            log_scores[label] = math.log(count / examples) + sum(
+                math.log((counts.get(token, 0) + 1) / denominator) for token in tokens
+            )
+        highest = max(log_scores.values())
+        scores = {label: math.exp(score - highest) for label, score in log_scores.items()}
+        total = sum(scores.values())
+        return {label: score / total for label, score in scores.items()}
+
+    def predict(self, tokens):
+        """
+        Returns the likeliest label and its probability, or (None, 0.0) when none of the tokens were seen in training.
+        """
+        if not any(token in self.vocabulary for token in tokens):
+            return None, 0.0
+        probabilities = self.probabilities(tokens)
+        label = max(probabilities, key=probabilities.get)
+        return label, probabilities[label]
+
+    def to_dict(self):
+        return {"label_counts": dict(self.label_counts), "token_counts": {
+            label: dict(counts) for label, counts in self.token_counts.items()
+        }}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["label_counts"], data["token_counts"])
@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 
 
@@ -5,9 +6,47 @@ class TextInputSerializer(serializers.Serializer):
     text_input = serializers.CharField()
 
 
+class TextInputBatchSerializer(serializers.Serializer):
+    text_inputs = serializers.ListField(child=serializers.CharField(), allow_empty=False)
+    # Sending the batch_id of a batch again skips the items it already completed.
+    batch_id = serializers.CharField(required=False, max_length=64)
+
+    def validate_text_inputs(self, text_inputs):
+        if len(text_inputs) > settings.DATA_BATCH_MAX_ITEMS:
+            raise serializers.ValidationError(f"A batch can have at most {settings.DATA_BATCH_MAX_ITEMS} text inputs.")
+        return text_inputs
+
+
+class ProjectDeltaSerializer(serializers.Serializer):
+    base_hash = serializers.CharField()
+    hash = serializers.CharField(required=False)
+    title = serializers.CharField(required=False, allow_blank=True)
+    crs = serializers.CharField(required=False, allow_blank=True)
+    added = serializers.ListField(child=serializers.DictField(), required=False, default=list)
+    removed = serializers.ListField(child=serializers.CharField(), required=False, default=list)
+    changed = serializers.ListField(child=serializers.DictField(), required=False, default=list)
+
+    def validate(self, data):
+        for layer in data["added"] + data["changed"]:
+            if "id" not in layer:
+                raise serializers.ValidationError("Every added or changed layer needs an id.")
+        return data
+
+
 class QGISSerializer(serializers.Serializer):
     text_input = serializers.CharField()
-    project_description = serializers.JSONField()
+    # Either the full project description or the changes since a version the server already has.
+    project_description = serializers.JSONField(required=False)
+    project_delta = ProjectDeltaSerializer(required=False)
     chat_history = serializers.ListField(
-        child=serializers.CharField(required=False, allow_blank=True, default="")
+        child=serializers.CharField(required=False, allow_blank=True, default=""), required=False, default=list
     )
+    # Continue a conversation stored on the server, its chat history is used instead of chat_history.
+    session_id = serializers.UUIDField(required=False)
+    # Respond with an ordered list of function calls instead of a single one.
+    plan = serializers.BooleanField(required=False, default=False)
+
+    def validate(self, data):
+        if "project_description" not in data and "project_delta" not in data:
+            raise serializers.ValidationError("Either project_description or project_delta is required.")
+        return data
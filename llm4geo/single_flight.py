@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from collections import Counter
+from copy import deepcopy
+from weakref import WeakKeyDictionary
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# Counters for this worker, keyed like "leader", "coalesced", "shared_coalesced", "shared_fallback".
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+# Calls in flight in this worker by key, threads share _calls and each event loop has its own dict.
+_calls = {}
+_async_calls = WeakKeyDictionary()
+_calls_lock = threading.Lock()
+
+
+def _record(event):
+    with _stats_lock:
+        _stats[event] += 1
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+class Flight:
+    """
+    A call in flight that other requests with the same key wait on. A result of None means the leader gave up, e.g.
+    because its client disconnected, so the waiters should make the call themselves.
+    """
+
+    def __init__(self, key, calls, done, loop=None):
+        self.key = key
+        self.calls = calls
+        self.done = done
+        self.loop = loop
+        self.result = None
+        self.error = None
+
+    def finish(self, result=None, error=None):
+        self.result, self.error = result, error
+        with _calls_lock:
+            if self.calls.get(self.key) is self:
+                del self.calls[self.key]
+        if self.loop is None or _running_loop() is self.loop:
+            self.done.set()
+        else:
+            # Flights of an event loop can be finished from a thread, e.g. by a sync streaming response under ASGI.
+            self.loop.call_soon_threadsafe(self.done.set)
+
+    def get_result(self):
+        if self.error is not None:
+            raise self.error
+        return deepcopy(self.result)
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _join(key, calls, done, loop=None):
+    with _calls_lock:
+        if key in calls:
+            return calls[key], False
+        flight = calls[key] = Flight(key, calls, done, loop)
+        return flight, True
+
+
+def join(key):
+    """
+    Returns (flight, leader) for key. The leader must finish() the flight, other callers wait() on it.
+    """
+    return _join(key, _calls, threading.Event())
+
+
+def ajoin(key):
+    loop = asyncio.get_running_loop()
+    with _calls_lock:
+        calls = _async_calls.setdefault(loop, {})
+    return _join(key, calls, asyncio.Event(), loop)
+
+
+def wait(flight):
+    if not flight.done.wait(settings.SINGLE_FLIGHT_TIMEOUT):
+        return None
+    return flight.get_result()
+
+
+async def await_flight(flight):
+    try:
+        await asyncio.wait_for(flight.done.wait(), settings.SINGLE_FLIGHT_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+    return flight.get_result()
+
+
+def _lock_key(key):
+    return f"single_flight:{key}"
+
+
+def _result_key(key, token):
+    return f"single_flight:{key}:{token}"
+
+
+def _acquire(key):
+    """
+    Returns (token, None) when this worker now holds the shared lock for key, otherwise (None, the holder's token).
+    """
+    locks = caches[settings.SINGLE_FLIGHT_LOCKS]
+    token = uuid.uuid4().hex
+    if locks.add(_lock_key(key), token, settings.SINGLE_FLIGHT_TIMEOUT):
+        return token, None
+    return None, locks.get(_lock_key(key))
+
+
+def _release(key, token, result=None):
+    locks = caches[settings.SINGLE_FLIGHT_LOCKS]
+    if result is not None:
+        locks.set(_result_key(key, token), result, settings.SINGLE_FLIGHT_TIMEOUT)
+    if locks.get(_lock_key(key)) == token:
+        locks.delete(_lock_key(key))
+
+
+def _poll(key, holder):
+    """
+    Returns (done, result), the result is None when the holder released the lock without one.
+    """
+    locks = caches[settings.SINGLE_FLIGHT_LOCKS]
+    if holder is not None and locks.get(_lock_key(key)) == holder:
+        return False, None
+    return True, locks.get(_result_key(key, holder)) if holder else None
+
+
+def _shared(key, compute):
+    try:
+        token, holder = _acquire(key)
+    except Exception as e:
+        logger.warning(f"Single flight lock unavailable, calling without it: {e}")
+        return compute()
+    if token:
+        result = None
+        try:
+            result = compute()
+            return result
+        finally:
+            _release(key, token, result)
+    deadline = time.monotonic() + settings.SINGLE_FLIGHT_TIMEOUT
+    while time.monotonic() < deadline:
+        done, result = _poll(key, holder)
+        if result is not None:
+            _record("shared_coalesced")
+            return result
+        if done:
+            break
+        time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+    _record("shared_fallback")
+    return compute()
+
+
+async def _ashared(key, acompute):
+    try:
+        token, holder = await sync_to_async(_acquire)(key)
+    except Exception as e:
+        logger.warning(f"Single flight lock unavailable, calling without it: {e}")
+        return await acompute()
+    if token:
+        result = None
+        try:
+            result = await acompute()
+            return result
+        finally:
+            await sync_to_async(_release)(key, token, result)
+    deadline = time.monotonic() + settings.SINGLE_FLIGHT_TIMEOUT
+    while time.monotonic() < deadline:
+        done, result = await sync_to_async(_poll)(key, holder)
+        if result is not None:
+            _record("shared_coalesced")
+            return result
+        if done:
+            break
+        await asyncio.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+    _record("shared_fallback")
+    return await acompute()
+
+
+def do(key, compute):
+    """
+    Returns compute(), calling it once for all the concurrent callers with the same key. With SINGLE_FLIGHT_LOCKS set
+    callers in other workers wait for it too.
+    """
+    if not settings.SINGLE_FLIGHT:
+        return compute()
+    flight, leader = join(key)
+    if not leader:
+        _record("coalesced")
+        result = wait(flight)
+        return compute() if result is None else result
+    _record("leader")
+    result = None
+    try:
+        result = _shared(key, compute) if settings.SINGLE_FLIGHT_LOCKS else compute()
+    except Exception as error:
+        flight.finish(error=error)
+        raise
+    finally:
+        if not flight.done.is_set():
+            flight.finish(result)
+    return result
+
+
+async def ado(key, acompute):
+    if not settings.SINGLE_FLIGHT:
+        return await acompute()
+    flight, leader = ajoin(key)
+    if not leader:
+        _record("coalesced")
+        result = await await_flight(flight)
+        return await acompute() if result is None else result
+    _record("leader")
+    result = None
+    try:
+        result = await _ashared(key, acompute) if settings.SINGLE_FLIGHT_LOCKS else await acompute()
+    except Exception as error:
+        flight.finish(error=error)
+        raise
+    finally:
+        if not flight.done.is_set():
+            flight.finish(result)
+    return result
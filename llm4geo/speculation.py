@@ -0,0 +1,66 @@
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+
+from llm4geo.schemas.supported_functions import get_supported_functions
+from llm4geo.scoring import BM25, tokenize
+from llm4geo.tokens import message_text
+
+supported_functions = get_supported_functions()
+
+# Only functions with parameters are worth speculating on.
+parameter_functions = [name for name, schema in supported_functions.items() if "properties" in schema]
+
+
+def _function_tokens(function_name):
+    schema = supported_functions[function_name]
+    tokens = tokenize(function_name.replace("_", " ")) + tokenize(schema.get("description", ""))
+    for property_name, property_schema in schema["properties"].items():
+        tokens += tokenize(property_name.replace("_", " ")) + tokenize(property_schema.get("description", ""))
+        tokens += tokenize(" ".join(property_schema.get("enum", [])))
+    return tokens
+
+
+function_index = BM25([_function_tokens(function_name) for function_name in parameter_functions])
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def get_candidates(text, chat_history=None, top_k=None):
+    """
+    Returns the functions most likely to be chosen for the text, scored locally without calling the LLM.
+    """
+    tokens = tokenize(text)
+    if chat_history:
+        tokens += tokenize(message_text(chat_history[-1]))
+    indexes = function_index.top_k(tokens, top_k or settings.SPECULATIVE_TOP_K)
+    return [parameter_functions[index] for index in indexes]
+
+
+def record(function_name, candidates):
+    """
+    Records how the speculation turned out and returns a summary for the response.
+    """
+    needs_parameters = function_name in parameter_functions
+    hit = function_name in candidates
+    with _stats_lock:
+        if needs_parameters:
+            _stats["hit" if hit else "miss"] += 1
+        else:
+            _stats["skipped"] += 1
+        _stats["wasted"] += len(candidates) - (1 if hit else 0)
+    return {"candidates": candidates, "hit": hit}
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+@lru_cache(maxsize=None)
+def get_executor():
+    return ThreadPoolExecutor(max_workers=settings.SPECULATIVE_MAX_WORKERS, thread_name_prefix="speculation")
@@ -1,16 +1,945 @@
-from unittest.mock import MagicMock
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from io import StringIO
+from unittest.mock import MagicMock, patch
 
-from django.test import TestCase, override_settings
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import ValidationError
+from langchain_core.runnables import RunnableLambda
+
+from llm4geo import cache, conversations, llm, metrics, repair, replay, request_log, router, single_flight, \
+    speculation
+from llm4geo.benchmarks import generate_project, run
+from llm4geo.cache import response_cache_key
+from llm4geo.fake_llm import FakeChatModel, example_instance
+from llm4geo.gazetteer import bbox, get_gazetteer
+from llm4geo.management.commands.train_router import read_examples
+from llm4geo.models import ChatSession, ChatTurn, LoggedProject, RequestLog
+from llm4geo.project_index import get_project_index, prune_project
+from llm4geo.project_store import apply_project_delta, get_store, store_project
+from llm4geo.prompts import PromptBuilder
+from llm4geo.schemas.qgis_project_description import get_project_hash
+from llm4geo.scoring import NaiveBayes, tokenize
+from llm4geo.schemas.supported_functions import get_function_call_schema, get_function_name_schema, \
+    get_function_schema, get_plan_schema, get_specialized_function, get_specialized_plan, get_supported_functions
+from llm4geo.serializers import QGISSerializer
+from llm4geo.tokens import count_tokens
+from llm4geo.views.data_chat import AsyncDataChatView, DataChatView
+from llm4geo.views.data_chat_batch import AsyncDataChatBatchView
+from llm4geo.views.qgis_chat import AsyncQGISChatView, QGISChatView
+from llm4geo.views.qgis_chat_stream import AsyncQGISChatStreamView
 
 
 class TestChatExportsView(TestCase):
 
-    mocked_response = [{"example_key": "example_value"}]
-    mocked_model = MagicMock()
-    mocked_model().with_structured_output().invoke.return_value = mocked_response
+    mocked_response = {"dataSource": "osm", "fileFormat": ["gpkg"]}
+
+    @override_settings(LLM_MODEL=FakeChatModel.with_responses({"export": mocked_response}), LLM_CACHE_ENABLED=False)
+    def test_post(self):
+        response = self.client.post(reverse("data_chat_api"), {"text_input": "some_input"}, content_type="application/json")
+        self.assertEqual(response.json(), self.mocked_response)
+
+
+class TestImports(TestCase):
+
+    def test_modules_import_on_their_own(self):
+        # Circular imports only show up when a module in the cycle is imported first.
+        for module in ["llm4geo.prompts", "llm4geo.speculation", "llm4geo.project_index", "llm4geo.metrics"]:
+            result = subprocess.run(
+                [sys.executable, "-c", f"import {module}"], cwd=settings.BASE_DIR, capture_output=True, text=True,
+                env={**os.environ, "DJANGO_SETTINGS_MODULE": "project.settings"},
+            )
+            self.assertEqual(result.returncode, 0, result.stderr)
+
+
+class TestBenchmarks(TestCase):
+
+    def test_generate_project(self):
+        project = generate_project(25)
+        self.assertEqual(len(project["layers"]), 25)
+        self.assertEqual(project, generate_project(25))
+        self.assertTrue(QGISSerializer(data={"text_input": "x", "project_description": project, "chat_history": []}).is_valid())
+
+    def test_fake_model_instances_are_valid(self):
+        for schema in [get_function_call_schema(), get_plan_schema(), *get_supported_functions().values()]:
+            Draft7Validator(schema).validate(example_instance(schema))
+
+    def test_run(self):
+        results = run([10], repeat=1, min_time=0, only=["serializer", "chat_response_fake_llm"])
+        self.assertEqual(set(results), {"serializer[10]", "chat_response_fake_llm[10]"})
+
+
+class TestResponseCache(TestCase):
+
+    def setUp(self):
+        caches[settings.LLM_CACHE_LOCAL].clear()
+        caches[settings.LLM_CACHE_SHARED].clear()
+        cache.reset_stats()
+
+    def test_key_normalizes_input(self):
+        self.assertEqual(
+            cache.response_cache_key("data_chat", "Load  OSM", schema={}),
+            cache.response_cache_key("data_chat", "load osm", schema={}),
+        )
+        self.assertNotEqual(
+            cache.response_cache_key("data_chat", "load osm", ["earlier turn"], schema={}),
+            cache.response_cache_key("data_chat", "load osm", schema={}),
+        )
+
+    def test_get_or_compute(self):
+        compute = MagicMock(return_value={"dataSource": "osm"})
+        key = cache.response_cache_key("data_chat", "load osm", schema={})
+        self.assertEqual(cache.get_or_compute(key, compute), {"dataSource": "osm"})
+        self.assertEqual(cache.get_or_compute(key, compute), {"dataSource": "osm"})
+        caches[settings.LLM_CACHE_LOCAL].clear()
+        self.assertEqual(cache.get_or_compute(key, compute), {"dataSource": "osm"})
+        compute.assert_called_once()
+        self.assertEqual(cache.get_stats(), {"miss": 1, "local_hit": 1, "shared_hit": 1})
+
+    def test_shared_tier_errors_are_misses(self):
+        compute = MagicMock(return_value={"dataSource": "osm"})
+        key = cache.response_cache_key("data_chat", "load osm", schema={})
+        shared_cache = caches[settings.LLM_CACHE_SHARED]
+        with patch.object(shared_cache, "get", side_effect=DatabaseError), \
+                patch.object(shared_cache, "set", side_effect=DatabaseError):
+            self.assertEqual(cache.get_or_compute(key, compute), {"dataSource": "osm"})
+        self.assertEqual(cache.get_stats(), {"miss": 1, "shared_error": 2})
+        self.assertEqual(cache.get_cached(key), {"dataSource": "osm"})
+
+    @override_settings(LLM_CACHE_ENABLED=False)
+    def test_disabled(self):
+        compute = MagicMock(return_value={"dataSource": "osm"})
+        key = cache.response_cache_key("data_chat", "load osm", schema={})
+        cache.get_or_compute(key, compute)
+        cache.get_or_compute(key, compute)
+        self.assertEqual(compute.call_count, 2)
+
+
+class FakeModel(FakeChatModel):
+    """The fake chat model with the responses these tests expect, counting its instances."""
+    responses = {
+        "GetFunctionName": {"chat": "Adding OpenStreetMap.", "function_name": "add_map_layer"},
+        "add_map_layer": {
+            "uri": "type=xyz&url=https://tile.openstreetmap.org/{z}/{x}/{y}.png",
+            "layer_name": "OpenStreetMap",
+            "provider": "wms",
+        },
+        "export": {"dataSource": "osm", "fileFormat": ["gpkg"]},
+        "GetFunctionCall": {
+            "function_call": {"chat": "Clearing the map.", "function_name": "remove_all_map_layers", "parameters": {}}
+        },
+        "GetPlan": {"chat": "Clearing the map then zooming to Denver.", "steps": [
+            {"function_name": "remove_all_map_layers", "parameters": {}},
+            {"function_name": "go_to_location", "parameters": {"west": -105.1, "south": 39.6, "east": -104.6, "north": "39.9"}},
+        ]},
+    }
+    instances = 0
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        FakeModel.instances += 1
+
+
+class FailingModel(FakeModel):
+    """Fails for inputs mentioning "fail", and counts the inputs it was called with."""
+    calls = []
+
+    def with_structured_output(self, schema):
+        structured_output = super().with_structured_output(schema)
+
+        def respond(prompt):
+            text = prompt.to_messages()[-1].content
+            FailingModel.calls.append(text)
+            if "fail" in text:
+                raise ValueError(f"Could not answer {text}")
+            return structured_output.invoke(prompt)
+        return RunnableLambda(respond)
+
+
+@override_settings(LLM_MODEL=FakeModel, LLM_CACHE_ENABLED=False, ROUTER_ENABLED=False)
+class TestChainRegistry(TestCase):
+
+    def setUp(self):
+        llm.clear_chains()
+        FakeModel.instances = 0
+
+    def test_chain_is_reused(self):
+        self.assertIs(llm.get_chain({"title": "export"}), llm.get_chain({"title": "export"}))
+        self.assertEqual(FakeModel.instances, 1)
+
+    def test_qgis_post(self):
+        for _ in range(2):
+            response = self.client.post(
+                reverse("qgis_chat_api"),
+                {"text_input": "load osm", "project_description": {"layers": []}, "chat_history": []},
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["function_name"], "add_map_layer")
+        self.assertEqual(response.json()["parameters"]["provider"], "wms")
+        self.assertEqual(FakeModel.instances, 1)
+
+
+@override_settings(LLM_MODEL=FakeModel, LLM_CACHE_ENABLED=False)
+class TestAsyncViews(TestCase):
+
+    def setUp(self):
+        llm.clear_chains()
+
+    async def test_qgis_post(self):
+        request = AsyncRequestFactory().post(
+            "/api/chat/qgis",
+            {"text_input": "load osm", "project_description": {"layers": []}, "chat_history": []},
+            content_type="application/json",
+        )
+        response = await AsyncQGISChatView.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["parameters"]["layer_name"], "OpenStreetMap")
+
+    async def test_data_post(self):
+        request = AsyncRequestFactory().post("/api/chat/data", {"text_input": "roads"}, content_type="application/json")
+        response = await AsyncDataChatView.as_view()(request)
+        self.assertEqual(json.loads(response.content)["dataSource"], "osm")
+
+
+@override_settings(LLM_MODEL=FakeModel, LLM_CACHE_ENABLED=False, SPECULATIVE_PARAMETERS=True)
+class TestSpeculativeParameters(TestCase):
+
+    payload = {"text_input": "add an imagery background", "project_description": {"layers": []}, "chat_history": []}
+
+    def setUp(self):
+        llm.clear_chains()
+
+    def test_candidates(self):
+        self.assertEqual(speculation.get_candidates("color the residential category red", top_k=1), ["color_category"])
+
+    def test_post(self):
+        response = self.client.post(reverse("qgis_chat_api"), self.payload, content_type="application/json")
+        self.assertEqual(response.json()["parameters"]["provider"], "wms")
+        self.assertEqual(response.json()["speculation"]["hit"], True)
+
+    async def test_async_post(self):
+        request = AsyncRequestFactory().post("/api/chat/qgis", self.payload, content_type="application/json")
+        response = await AsyncQGISChatView.as_view()(request)
+        self.assertEqual(json.loads(response.content)["speculation"]["candidates"][0], "add_map_layer")
+
+
+@override_settings(LLM_MODEL=FakeModel, LLM_CACHE_ENABLED=False, FUNCTION_CALL_STRATEGY="single_call")
+class TestSingleCallStrategy(TestCase):
+
+    def setUp(self):
+        llm.clear_chains()
+
+    def test_post(self):
+        response = self.client.post(
+            reverse("qgis_chat_api"),
+            {"text_input": "clear the map", "project_description": {"layers": []}, "chat_history": []},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["function_name"], "remove_all_map_layers")
+        self.assertEqual(response.json()["parameters"], {})
+
+
+def parse_events(content):
+    events = []
+    for block in content.decode().strip().split("\n\n"):
+        event, data = block.split("\n")
+        events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return events
+
+
+@override_settings(LLM_MODEL=FakeModel, LLM_CACHE_ENABLED=False, ROUTER_ENABLED=False)
+class TestStreamingView(TestCase):
+
+    payload = {"text_input": "load osm", "project_description": {"layers": []}, "chat_history": []}
+
+    def setUp(self):
+        llm.clear_chains()
 
-    @override_settings(LLM_MODEL=mocked_model)
     def test_post(self):
-        self.assertEquals(
-            self.client.post({"text_input": "some_input"}), self.mocked_response
+        response = self.client.post(reverse("qgis_chat_stream_api"), self.payload, content_type="application/json")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = parse_events(b"".join(response.streaming_content))
+        self.assertEqual(events[0], ("chat", {"text": "Adding OpenStreetMap."}))
+        self.assertEqual(events[-1][0], "result")
+        self.assertEqual(events[-1][1]["parameters"]["provider"], "wms")
+
+    @override_settings(FUNCTION_CALL_STRATEGY="single_call")
+    async def test_async_single_call(self):
+        request = AsyncRequestFactory().post("/api/chat/qgis/stream", self.payload, content_type="application/json")
+        response = await AsyncQGISChatStreamView.as_view()(request)
+        events = parse_events(b"".join([chunk async for chunk in response.streaming_content]))
+        self.assertEqual(events, [
+            ("chat", {"text": "Clearing the map."}),
+            ("result", {"chat": "Clearing the map.", "function_name": "remove_all_map_layers", "parameters": {},
+                        "project_hash": get_project_hash({"layers": []})}),
+        ])
+
+
+@override_settings(LLM_MODEL=FakeModel, LLM_CACHE_ENABLED=False)
+class TestPlanMode(TestCase):
+
+    payload = {"text_input": "clear the map and zoom to Denver", "project_description": {"layers": []},
+               "chat_history": [], "plan": True}
+
+    def setUp(self):
+        llm.clear_chains()
+
+    def test_post(self):
+        response = self.client.post(reverse("qgis_chat_api"), self.payload, content_type="application/json")
+        steps = response.json()["steps"]
+        self.assertEqual([step["function_name"] for step in steps], ["remove_all_map_layers", "go_to_location"])
+        # Each step is validated, and here repaired, against its function's schema.
+        self.assertEqual(steps[1]["parameters"]["north"], 39.9)
+
+    def test_steps_checked_against_function_schemas(self):
+        schema, validator = get_specialized_plan({"layers": []})
+        step = {"function_name": "add_map_layer", "parameters": {"layer_name": "OSM"}}
+        self.assertFalse(validator.is_valid({"chat": "", "steps": [step]}))
+        self.assertFalse(validator.is_valid({"chat": "", "steps": []}))
+
+
+@override_settings(LLM_MODEL=FailingModel, LLM_CACHE_ENABLED=False)
+class TestDataChatBatch(TestCase):
+
+    def setUp(self):
+        llm.clear_chains()
+        FailingModel.calls = []
+
+    def post(self, text_inputs, batch_id):
+        response = self.client.post(reverse("data_chat_batch_api"), {"text_inputs": text_inputs, "batch_id": batch_id},
+                                    content_type="application/json")
+        return [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+
+    def test_ordered_deduplicated_results(self):
+        results = self.post(["roads", "fail please", "Roads ", "rivers"], "batch-1")
+        self.assertEqual([result["index"] for result in results], [0, 1, 2, 3])
+        self.assertEqual(results[2]["response"]["dataSource"], "osm")
+        self.assertIn("Could not answer", results[1]["error"])
+        self.assertEqual(sorted(FailingModel.calls), ["fail please", "rivers", "roads"])
+
+    def test_resume_from_checkpoint(self):
+        self.post(["roads", "fail please"], "batch-2")
+        FailingModel.calls = []
+        results = self.post(["roads", "fail please"], "batch-2")
+        self.assertEqual(FailingModel.calls, ["fail please"])
+        self.assertEqual(results[0]["response"]["dataSource"], "osm")
+
+    @override_settings(LLM_CACHE_ENABLED=True, LLM_CACHE_SHARED=None)
+    def test_cached_responses(self):
+        caches[settings.LLM_CACHE_LOCAL].clear()
+        self.post(["roads"], "batch-4")
+        FailingModel.calls = []
+        results = self.post(["roads", "rivers"], "batch-5")
+        self.assertEqual(FailingModel.calls, ["rivers"])
+        self.assertEqual(results[0]["response"]["dataSource"], "osm")
+
+    def test_stages_are_recorded_for_the_request(self):
+        with self.assertLogs("llm4geo.middleware", "DEBUG") as logs:
+            self.post(["roads", "rivers"], "batch-6")
+        summary = json.loads(logs.records[-1].getMessage().removeprefix("request "))
+        self.assertEqual([stage["stage"] for stage in summary["stages"]], ["data_chat", "data_chat"])
+
+    @override_settings(DATA_BATCH_CONCURRENCY=1)
+    def test_cache_is_read_as_results_are_sent(self):
+        with patch("llm4geo.views.data_chat_batch.get_cached", return_value=None) as get_cached:
+            response = self.client.post(reverse("data_chat_batch_api"), {"text_inputs": ["roads", "rivers", "lakes"]},
+                                        content_type="application/json")
+            lines = iter(response.streaming_content)
+            next(lines)
+            self.assertEqual(get_cached.call_count, 1)
+            self.assertEqual(len(list(lines)), 2)
+
+    async def test_async_ndjson(self):
+        request = AsyncRequestFactory().post(
+            "/api/chat/data/batch?batch_id=batch-3", '{"text_input": "roads"}\n"roads"\n"rivers"\n',
+            content_type="application/x-ndjson",
+        )
+        response = await AsyncDataChatBatchView.as_view()(request)
+        content = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertEqual([json.loads(line)["text_input"] for line in content.splitlines()], ["roads", "roads", "rivers"])
+        self.assertEqual(len(FailingModel.calls), 2)
+
+
+@override_settings(LLM_MODEL=FakeModel, LLM_CACHE_ENABLED=False)
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        llm.clear_chains()
+
+    def test_metrics(self):
+        response = self.client.post(
+            reverse("qgis_chat_api"),
+            {"text_input": "load osm", "project_description": {"layers": []}, "chat_history": []},
+            content_type="application/json", headers={"X-Request-ID": "abc123"},
         )
+        self.assertEqual(response["X-Request-ID"], "abc123")
+        text = self.client.get(reverse("metrics")).content.decode()
+        self.assertIn('llm4geo_stage_seconds_count{stage="function_name",function=""}', text)
+        self.assertIn('llm4geo_stage_seconds_bucket{stage="parameters",function="add_map_layer",le="+Inf"}', text)
+        self.assertIn('llm4geo_request_seconds_count{view="qgis_chat_api",method="POST",status="200"}', text)
+        self.assertIn('llm4geo_prompt_section_tokens_count{prompt="function_name",section="functions"}', text)
+        self.assertIn("# TYPE llm4geo_repair_total counter", text)
+
+    @override_settings(ROUTER_ENABLED=False)
+    def test_streaming_request_is_recorded_when_the_stream_ends(self):
+        payload = {"text_input": "load osm", "project_description": {"layers": []}, "chat_history": []}
+        with self.assertLogs("llm4geo.middleware", "DEBUG") as logs:
+            response = self.client.post(reverse("qgis_chat_stream_api"), payload, content_type="application/json")
+            self.assertEqual(logs.records, [])
+            content = b"".join(response.streaming_content)
+        summary = json.loads(logs.records[-1].getMessage().removeprefix("request "))
+        self.assertEqual(summary["bytes"], len(content))
+        self.assertEqual([stage["stage"] for stage in summary["stages"]][:2], ["function_name", "parameters"])
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("test_histogram", "A test histogram.", ["view"], buckets=(1, 10))
+        metrics.registry.remove(histogram)
+        for value in [0.5, 1, 5, 50]:
+            histogram.observe(value, view="a")
+        self.assertEqual(histogram.render().splitlines()[2:], [
+            'test_histogram_bucket{view="a",le="1"} 2',
+            'test_histogram_bucket{view="a",le="10"} 3',
+            'test_histogram_bucket{view="a",le="+Inf"} 4',
+            'test_histogram_sum{view="a"} 56.5',
+            'test_histogram_count{view="a"} 4',
+        ])
+
+
+class TestSingleFlight(TestCase):
+
+    def setUp(self):
+        single_flight.reset_stats()
+
+    def test_do(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return {"chat": "shared"}
+
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(lambda _: single_flight.do("key", compute), range(4)))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"chat": "shared"}] * 4)
+        self.assertEqual(single_flight.get_stats(), {"leader": 1, "coalesced": 3})
+
+    async def test_ado(self):
+        calls = []
+
+        async def acompute():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return {"chat": "shared"}
+
+        results = await asyncio.gather(*[single_flight.ado("key", acompute) for _ in range(4)])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"chat": "shared"}] * 4)
+
+    @override_settings(SINGLE_FLIGHT_LOCKS="default", SINGLE_FLIGHT_POLL_INTERVAL=0.01)
+    def test_shared_lock(self):
+        # Another worker holds the lock and publishes its result.
+        locks = caches["default"]
+        locks.add("single_flight:key", "other")
+        timer = threading.Timer(0.1, lambda: (
+            locks.set("single_flight:key:other", {"chat": "shared"}), locks.delete("single_flight:key")
+        ))
+        timer.start()
+        self.assertEqual(single_flight.do("key", lambda: {"chat": "own"}), {"chat": "shared"})
+        # Once the lock is released without a result the call is made here.
+        self.assertEqual(single_flight.do("key", lambda: {"chat": "own"}), {"chat": "own"})
+        self.assertEqual(single_flight.get_stats(), {"leader": 2, "shared_coalesced": 1})
+
+    @override_settings(LLM_CACHE_ENABLED=False)
+    def test_idempotency_key(self):
+        with patch.object(DataChatView, "invoke_model", return_value={"dataSource": "osm", "fileFormat": ["gpkg"]}) as invoke:
+            responses = [
+                self.client.post(reverse("data_chat_api"), {"text_input": text}, content_type="application/json",
+                                 headers={"Idempotency-Key": "request-1"})
+                for text in ["load osm", "load osm", "load landsat"]
+            ]
+        # A different body with the same key is a different request.
+        self.assertEqual(invoke.call_count, 2)
+        self.assertEqual(responses[1].json(), responses[0].json())
+        self.assertEqual(responses[1]["Idempotent-Replayed"], "true")
+        self.assertFalse(responses[2].has_header("Idempotent-Replayed"))
+
+    @override_settings(LLM_MODEL=FakeModel, LLM_CACHE_ENABLED=False)
+    def test_idempotent_stream(self):
+        llm.clear_chains()
+        payload = {"text_input": "load osm", "project_description": {"layers": []}, "chat_history": []}
+        contents = []
+        for _ in range(2):
+            response = self.client.post(reverse("qgis_chat_stream_api"), payload, content_type="application/json",
+                                        headers={"Idempotency-Key": "request-1"})
+            contents.append(b"".join(response.streaming_content) if response.streaming else response.content)
+        self.assertEqual(contents[1], contents[0])
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(response["Idempotent-Replayed"], "true")
+
+
+class TestRouter(TestCase):
+
+    def setUp(self):
+        router.reset_stats()
+
+    def test_rules(self):
+        for text in ["Remove all layers", "clear the map", "Add OpenStreetMap basemap", "please delete every layer"]:
+            routed = router.route(text)
+            self.assertEqual(routed["route"], {"source": "rule", "confidence": 1.0}, text)
+            Draft7Validator(get_supported_functions()[routed["function_name"]]).validate(routed["parameters"])
+        for text in ["remove the roads layer", "add osm buildings as features", "what is on the map"]:
+            self.assertIsNone(router.route(text), text)
+        self.assertEqual(router.get_stats(), {"rule": 4, "llm": 3})
+
+    def test_classifier(self):
+        classifier = NaiveBayes.train([
+            (tokenize("zoom to denver"), "go_to_location"), (tokenize("go to paris"), "go_to_location"),
+            (tokenize("color the rivers blue"), "color_category"), (tokenize("make roads red"), "color_category"),
+        ])
+        self.assertEqual(classifier.predict(tokenize("zoom to paris"))[0], "go_to_location")
+        self.assertEqual(classifier.predict(tokenize("unrelated words")), (None, 0.0))
+        self.assertEqual(NaiveBayes.from_dict(json.loads(json.dumps(classifier.to_dict()))).to_dict(), classifier.to_dict())
+        with patch.object(router, "get_classifier", return_value=classifier):
+            with override_settings(ROUTER_THRESHOLD=0.5):
+                routed = router.route("zoom to the trailhead")
+            self.assertEqual((routed["function_name"], routed["parameters"]), ("go_to_location", None))
+            with override_settings(ROUTER_THRESHOLD=1.0):
+                self.assertIsNone(router.route("zoom to the trailhead"))
+
+    @override_settings(LLM_CACHE_ENABLED=False)
+    def test_post_bypasses_llm(self):
+        model = MagicMock()
+        with override_settings(LLM_MODEL=model):
+            response = self.client.post(reverse("qgis_chat_api"), {
+                "text_input": "clear the map", "project_description": {"layers": []}, "chat_history": []
+            }, content_type="application/json")
+        self.assertEqual(response.json()["function_name"], "remove_all_map_layers")
+        self.assertEqual(response.json()["route"]["source"], "rule")
+        model.assert_not_called()
+
+
+class TestGazetteer(TestCase):
+
+    def setUp(self):
+        self.gazetteer = get_gazetteer()
+
+    def test_lookup(self):
+        self.assertEqual(self.gazetteer.exact("Zürich")[0]["country"], "CH")
+        self.assertEqual(self.gazetteer.lookup("Denvr")["name"], "Denver")
+        self.assertIn("San Francisco", [place["name"] for place in self.gazetteer.prefix("san f")])
+        # Countries come before regions with the same name.
+        self.assertEqual([place["kind"] for place in self.gazetteer.exact("georgia")], ["country", "region"])
+
+    def test_find(self):
+        self.assertEqual(self.gazetteer.find("zoom to denver colorado")["name"], "Denver")
+        self.assertEqual(self.gazetteer.find("take me to the state of new york")["name"], "New York State")
+        self.assertEqual(self.gazetteer.find("navigate to Sna Francisco")["name"], "San Francisco")
+        self.assertIsNone(self.gazetteer.find("zoom to the roads layer"))
+
+    def test_find_with_qualifier(self):
+        self.assertEqual(self.gazetteer.find("zoom to atlanta georgia")["name"], "Atlanta")
+        self.assertIsNone(self.gazetteer.find("zoom to portland maine"))
+        self.assertIsNone(self.gazetteer.find("zoom to paris texas"))
+
+    def test_find_abbreviation(self):
+        self.assertEqual(self.gazetteer.find("zoom to LA")["name"], "Los Angeles")
+        self.assertIsNone(self.gazetteer.find("show the roads in the act of being built"))
+        self.assertIsNone(self.gazetteer.find("zoom to la"))
+        self.assertEqual(self.gazetteer.find("zoom to the US")["name"], "United States")
+        self.assertEqual(self.gazetteer.find("show me the U.S.")["name"], "United States")
+        self.assertIsNone(self.gazetteer.find("show us the roads"))
+        self.assertEqual(self.gazetteer.lookup("the US")["name"], "United States")
+
+    @override_settings(LLM_CACHE_ENABLED=False, ROUTER_ENABLED=False)
+    def test_go_to_location_without_parameters_call(self):
+        llm.clear_chains()
+        go_to = {"GetFunctionName": {"chat": "Going to Denver.", "function_name": "go_to_location"}}
+        with override_settings(LLM_MODEL=FakeModel.with_responses(go_to)):
+            response = self.client.post(reverse("qgis_chat_api"), {
+                "text_input": "zoom in on Denver, Colorado", "project_description": {"layers": []}, "chat_history": []
+            }, content_type="application/json")
+        # The fake model would answer go_to_location with zeros, so the parameters must come from the gazetteer.
+        self.assertEqual(response.json()["parameters"], bbox(self.gazetteer.exact("denver")[0]))
+
+    def test_router(self):
+        routed = router.route("Zoom to Paris")
+        self.assertEqual((routed["function_name"], routed["chat"]), ("go_to_location", "Going to Paris."))
+        self.assertIsNone(router.route("zoom to paris and add the roads"))
+
+
+@override_settings(CHAT_SESSION_SUMMARIES=False, LLM_CACHE_ENABLED=False)
+class TestChatSessions(TestCase):
+
+    def add_turns(self, session, count):
+        for i in range(0, count, 2):
+            conversations.add_turns(session, f"request {i}", {"chat": f"response {i + 1}"})
+
+    def test_window(self):
+        session = ChatSession.objects.create()
+        self.add_turns(session, 6)
+        budget = count_tokens("request 4") + count_tokens("response 5") + count_tokens("response 3")
+        history, start = conversations.get_window(session, budget)
+        self.assertEqual(history, [("ai", "response 3"), ("human", "request 4"), ("ai", "response 5")])
+        self.assertEqual(start, 3)
+        session.summary, session.summarized_turns = "The user added roads.", 2
+        history, start = conversations.get_window(session, budget * 2)
+        self.assertEqual(history[0], ("system", "A summary of the earlier conversation:\nThe user added roads."))
+        self.assertEqual(history[1:3], [("human", "request 2"), ("ai", "response 3")])
+        self.assertEqual(start, 2)
+
+    @override_settings(CHAT_SESSION_SUMMARY_MIN_TURNS=2)
+    def test_summarize(self):
+        session = ChatSession.objects.create()
+        self.add_turns(session, 6)
+        model = FakeChatModel.with_responses({"ConversationSummary": {"summary": "The user added roads."}})
+        llm.clear_chains()
+        with override_settings(LLM_MODEL=model, CHAT_SESSION_TOKEN_BUDGET=count_tokens("request 4") * 3):
+            self.assertTrue(conversations.summarize(session.id))
+            session.refresh_from_db()
+            self.assertEqual((session.summary, session.summarized_turns), ("The user added roads.", 3))
+            # The remaining turns fit, so there is nothing more to summarize.
+            self.assertFalse(conversations.summarize(session.id))
+        llm.clear_chains()
+
+    def test_post(self):
+        payload = {"text_input": "clear the map", "project_description": {"layers": []}, "session_id": str(uuid.uuid4())}
+        for _ in range(2):
+            response = self.client.post(reverse("qgis_chat_api"), payload, content_type="application/json")
+            self.assertEqual(response.json()["session_id"], payload["session_id"])
+        turns = ChatTurn.objects.filter(session_id=payload["session_id"])
+        self.assertEqual([(turn.index, turn.role) for turn in turns], [
+            (0, "user"), (1, "assistant"), (2, "user"), (3, "assistant")
+        ])
+        self.assertEqual(turns[1].content, "Removing all layers from the map.")
+        _, history = conversations.load_conversation(payload["session_id"])
+        self.assertEqual(history[:2], [("human", "clear the map"), ("ai", "Removing all layers from the map.")])
+
+
+@override_settings(REQUEST_LOG_ENABLED=True, LLM_CACHE_ENABLED=False)
+class TestRequestLog(TestCase):
+
+    def setUp(self):
+        request_log.get_queue.cache_clear()
+        request_log.reset_stats()
+        request_log._known_projects.clear()
+        start_writer = patch.object(request_log, "start_writer")
+        start_writer.start()
+        self.addCleanup(start_writer.stop)
+
+    def test_write_and_export(self):
+        project_description = {"layers": []}
+        for _ in range(2):
+            self.client.post(reverse("qgis_chat_api"), {
+                "text_input": "clear the map", "project_description": project_description, "chat_history": []
+            }, content_type="application/json")
+        self.assertEqual(RequestLog.objects.count(), 0)
+        self.assertEqual(request_log.flush(), 2)
+        entry = RequestLog.objects.first()
+        self.assertEqual((entry.view, entry.text_input, entry.function_name), (
+            "qgis_chat_api", "clear the map", "remove_all_map_layers"
+        ))
+        self.assertEqual(entry.request, {"chat_history": []})
+        self.assertEqual(entry.project_hash, get_project_hash(project_description))
+        self.assertEqual(LoggedProject.objects.get().description, project_description)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "requests.jsonl")
+        call_command("export_request_log", output=path, projects=True, stderr=StringIO())
+        with open(path) as lines:
+            line = json.loads(lines.readline())
+        self.assertEqual(line["project_description"], project_description)
+        self.assertEqual(line["response"]["function_name"], "remove_all_map_layers")
+        # "clear the map" is answered by the router, so it isn't a training example.
+        self.assertEqual(list(read_examples([path])), [])
+
+    def test_read_examples_skips_routed_responses(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "requests.jsonl")
+        with open(path, "w") as lines:
+            response = {"chat": "", "function_name": "remove_all_map_layers", "parameters": {}}
+            routed = {**response, "route": {"source": "rule", "confidence": 1.0}}
+            for entry_response in [response, routed]:
+                lines.write(json.dumps({"text_input": "clear the map", "response": entry_response}) + "\n")
+        self.assertEqual(len(list(read_examples([path]))), 1)
+
+    def test_project_is_queued_once(self):
+        request = RequestFactory().post("/api/chat/qgis")
+        for _ in range(2):
+            request_log.record(request, {"chat": ""}, {"layers": []}, "project-hash")
+        self.assertEqual([project for _, project in request_log.drain()], [("project-hash", {"layers": []}), None])
+
+    def test_sampling_and_overflow(self):
+        request = RequestFactory().post("/api/chat/data")
+        with override_settings(REQUEST_LOG_SAMPLE_RATE=0):
+            self.assertFalse(request_log.record(request, {"dataSource": "osm"}))
+        request_log.get_queue.cache_clear()
+        with override_settings(REQUEST_LOG_QUEUE_SIZE=1):
+            self.assertTrue(request_log.record(request, {"dataSource": "osm"}))
+            self.assertFalse(request_log.record(request, {"dataSource": "osm"}))
+        self.assertEqual(request_log.get_stats(), {"sampled_out": 1, "queued": 1, "dropped": 1})
+        self.assertEqual(request_log.flush(), 1)
+        self.assertEqual(RequestLog.objects.get().view, "unknown")
+
+
+@override_settings(ROUTER_ENABLED=False, LLM_CACHE_SHARED=None)
+class TestReplay(TestCase):
+
+    recordings = [
+        {"view": "data_chat_api", "text_input": "I need data for Africa",
+         "response": {"dataSource": "osm", "fileFormat": ["gpkg"]}},
+        {"view": "qgis_chat_api", "text_input": "Start over with an empty map", "chat_history": [],
+         "project_description": {"layers": []},
+         "response": {"chat": "Removing the layers.", "function_name": "remove_all_map_layers", "parameters": {}}},
+        {"view": "data_chat_api", "text_input": "i need data for  africa"},
+        {"view": "qgis_chat_api", "text_input": "zoom to the roads", "project_hash": "unknown"},
+    ]
+
+    def setUp(self):
+        cache.reset_stats()
+        caches[settings.LLM_CACHE_LOCAL].clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "requests.jsonl")
+        with open(self.path, "w") as lines:
+            lines.writelines(json.dumps(recording) + "\n" for recording in self.recordings)
+
+    def test_replay_with_stub(self):
+        output = os.path.join(os.path.dirname(self.path), "report.json")
+        call_command("replay", self.path, stub=True, concurrency=1, output=output, stdout=StringIO())
+        with open(output) as report_file:
+            report = json.load(report_file)
+        self.assertEqual((report["requests"], report["skipped"], report["errors"]), (3, 1, 0))
+        self.assertEqual(report["choices"], {"compared": 2, "changed": 0, "changes": {}})
+        # The third request differs from the first only by case and spacing so it is answered from the cache.
+        self.assertEqual(report["cache_hit_rate"], round(1 / 3, 4))
+
+    def test_report(self):
+        results = [
+            {"text_input": str(i), "skipped": False, "seconds": i / 100, "error": None, "recorded": "a", "replayed": "a"}
+            for i in range(1, 101)
+        ]
+        results[0].update(replayed="b")
+        results[1].update(error="500: b''", replayed=None)
+        report = replay.report(results, 2.0, {"miss": 1}, {"miss": 4, "local_hit": 1})
+        self.assertEqual(report["latency"]["p50"], 0.5)
+        self.assertEqual(report["latency"]["p99"], 0.99)
+        self.assertEqual((report["throughput"], report["error_rate"], report["cache_hit_rate"]), (50.0, 0.01, 0.25))
+        self.assertEqual(report["choices"], {"compared": 99, "changed": 1, "changes": {"a -> b": 1}})
+
+
+class TieredModel(FakeChatModel):
+    """
+    Gives empty, invalid parameters unless it is the "large" model.
+    """
+
+    def with_structured_output(self, schema):
+        if self.kwargs["model"] != "large" and schema.get("title") == "go_to_location":
+            return RunnableLambda(lambda prompt: {})
+        return super().with_structured_output(schema)
+
+
+@override_settings(LLM_MODEL=TieredModel, LLM_CACHE_ENABLED=False, LLM_ESCALATION_MODEL=None)
+class TestModelTiering(TestCase):
+
+    def setUp(self):
+        llm.clear_chains()
+        self.addCleanup(llm.clear_chains)
+
+    @override_settings(LLM_STAGE_MODELS={"function_name": "small", "parameters": "medium", "parameters:go_to_location": "large"})
+    def test_get_model_name(self):
+        self.assertEqual(llm.get_model_name("function_name"), "small")
+        self.assertEqual(llm.get_model_name("parameters", "color_rule"), "medium")
+        self.assertEqual(llm.get_model_name("parameters", "go_to_location"), "large")
+        self.assertEqual(llm.get_model_name("data_chat"), settings.OPENAI_MODEL)
+        self.assertNotEqual(
+            QGISChatView().function_name_cache_key("zoom in"),
+            response_cache_key("function_name", "zoom in", schema=get_function_name_schema())
+        )
+
+    @override_settings(LLM_STAGE_MODELS={"parameters": "small"})
+    def test_escalation(self):
+        view, schema = QGISChatView(), get_supported_functions()["go_to_location"]
+        payload = {"system": [], "input": "zoom to the trailhead"}
+        with self.assertRaises(ValidationError):
+            view.invoke_with_validation("go_to_location", payload, schema)
+        token = metrics.request_stages.set([])
+        self.addCleanup(metrics.request_stages.reset, token)
+        with override_settings(LLM_ESCALATION_MODEL="large"):
+            response = view.invoke_with_validation("go_to_location", payload, schema)
+        Draft7Validator(schema).validate(response)
+        stages = [(stage["stage"], stage.get("model")) for stage in metrics.request_stages.get()]
+        self.assertEqual(stages[0], ("parameters", "small"))
+        self.assertEqual(stages[-2:], [("escalation", "large"), ("validation", None)])
+
+    @override_settings(LLM_STAGE_MODELS={"parameters": "small"}, LLM_ESCALATION_MODEL="large")
+    async def test_async_escalation(self):
+        view, schema = AsyncQGISChatView(), get_supported_functions()["go_to_location"]
+        payload = {"system": [], "input": "zoom to the trailhead"}
+        response = await llm.arun_steps(view.validation_steps("go_to_location", payload, schema))
+        Draft7Validator(schema).validate(response)
+
+    def test_steps_are_thrown_llm_errors(self):
+        def steps():
+            try:
+                yield RunnableLambda(lambda payload: 1 / 0), {}
+            except ZeroDivisionError:
+                return "handled"
+
+        self.assertEqual(llm.run_steps(steps()), "handled")
+
+
+class TestSchemaRepair(TestCase):
+
+    supported_functions = get_supported_functions()
+
+    def test_repairs_mechanical_mistakes(self):
+        response = {"uri": "https://tile.openstreetmap.org/{z}/{x}/{y}.png", "layer_name": "OSM"}
+        self.assertEqual(repair.repair(response, self.supported_functions["add_map_layer"]), {
+            "uri": "type=xyz&url=https://tile.openstreetmap.org/{z}/{x}/{y}.png", "layer_name": "OSM", "provider": "wms",
+        })
+        response = {"layer_name": "roads", "renderer_name": "Primary", "color": ["300", -4, 12.6]}
+        self.assertEqual(repair.repair(response, self.supported_functions["color_category"])["color"], [255, 0, 13])
+        response = {"west": "2.22", "south": 48.81, "east": 2.46, "north": 48.9}
+        self.assertEqual(repair.repair(response, self.supported_functions["go_to_location"])["west"], 2.22)
+
+    def test_function_call_variant(self):
+        response = {"function_call": {"chat": "", "function_name": "add_map_layers", "parameters": {
+            "uri": "type=xyz&url=https://tile.openstreetmap.org/{z}/{x}/{y}.png", "layer_name": "OSM",
+        }}}
+        repaired = repair.repair(response, get_function_call_schema())
+        self.assertEqual(repaired["function_call"]["function_name"], "add_map_layer")
+        self.assertEqual(repaired["function_call"]["parameters"]["provider"], "wms")
+        response["function_call"]["function_name"] = "add_feature_layers"
+        self.assertIsNone(repair.repair(response, get_function_call_schema()))
+
+    def test_unrepairable(self):
+        self.assertIsNone(repair.repair({"layer_name": "roads"}, self.supported_functions["color_category"]))
+
+
+class TestSchemaSpecialization(TestCase):
+
+    project_description = {"layers": [
+        {"name": "roads", "categories": ["Primary", "Secondary"], "ranges": [], "rules": []},
+        {"name": "parcels", "categories": [], "ranges": ["0 - 10"], "rules": []},
+    ]}
+
+    def test_enums_from_project(self):
+        schema = get_function_schema("color_category", self.project_description)
+        self.assertEqual(schema["properties"]["layer_name"]["enum"], ["roads"])
+        self.assertEqual(schema["properties"]["renderer_name"]["enum"], ["Primary", "Secondary"])
+        self.assertNotIn("enum", get_function_schema("color_rule", self.project_description)["properties"]["layer_name"])
+
+    def test_cached_by_project(self):
+        schema, validator = get_specialized_function("color_range", self.project_description)
+        self.assertIs(get_specialized_function("color_range", deepcopy(self.project_description))[1], validator)
+        self.assertFalse(validator.is_valid({"layer_name": "roads", "renderer_name": "0 - 10", "color": [0, 0, 0]}))
+
+
+class TestPromptBuilder(TestCase):
+
+    def test_sections_and_counts(self):
+        prompt = PromptBuilder("test", budget=10000).add("instructions", "Pick a function.").add("functions", "- a(): b")
+        payload = prompt.build("load osm", ["earlier turn"])
+        self.assertEqual(payload["system"][0].content, "Pick a function.\n\n- a(): b")
+        self.assertEqual(payload["chat_history"], ["earlier turn"])
+        self.assertEqual(set(prompt.token_counts), {"instructions", "functions", "chat_history", "input", "total"})
+
+    def test_budget(self):
+        prompt = PromptBuilder("test", budget=count_tokens("required") + count_tokens("load osm") + count_tokens("new"))
+        prompt.add("instructions", "required").add("legend", "optional " * 100, required=False)
+        payload = prompt.build("load osm", ["old " * 100, "new"])
+        self.assertEqual(payload["chat_history"], ["new"])
+        self.assertEqual(payload["system"][0].content, "required")
+
+    def test_function_name_prompt_lists_functions_once(self):
+        payload = QGISChatView().function_name_prompt("load osm")
+        self.assertEqual(payload["system"][0].content.count("add_map_layer("), 1)
+        self.assertNotIn('"uri"', json.dumps(QGISChatView.function_name_schema))
+
+
+class TestProjectPruning(TestCase):
+
+    def setUp(self):
+        self.project = {"title": "big", "crs": "EPSG:4326", "layers": [
+            {"name": f"layer {i}", "id": str(i), "fields": ["fid", "name"], "categories": [], "ranges": [], "rules": []}
+            for i in range(200)
+        ]}
+        self.project["layers"][150].update(name="rivers", fields=["fid", "discharge"])
+
+    def test_small_project_unchanged(self):
+        project = {"title": "small", "layers": self.project["layers"][:2]}
+        self.assertIs(prune_project(project, "colour the rivers"), project)
+
+    def test_prunes_to_relevant_layers(self):
+        pruned = prune_project(self.project, "colour by discharge", ["show the rivers"], budget=200, top_k=5)
+        self.assertEqual([layer["name"] for layer in pruned["layers"]][:1], ["rivers"])
+        self.assertIn(f"{200 - len(pruned['layers'])} of 200 layers", pruned["pruned"])
+        self.assertEqual(len(self.project["layers"]), 200)
+
+    def test_index_cached_by_hash(self):
+        self.assertIs(get_project_index(self.project), get_project_index(deepcopy(self.project)))
+
+    def test_reuses_project_hash(self):
+        project_hash = get_project_hash(self.project)
+        get_project_index(self.project, project_hash)
+        with patch("llm4geo.project_index.get_project_hash") as hash_project:
+            prune_project(self.project, "colour by discharge", budget=200, top_k=5, project_hash=project_hash)
+        hash_project.assert_not_called()
+
+
+@override_settings(LLM_MODEL=FakeModel, LLM_CACHE_ENABLED=False)
+class TestProjectDelta(TestCase):
+
+    project_description = {"title": "", "crs": "EPSG:4326", "layers": [
+        {"id": "roads_1", "name": "roads", "categories": []},
+        {"id": "parcels_1", "name": "parcels", "categories": []},
+    ]}
+
+    def post(self, **data):
+        return self.client.post(reverse("qgis_chat_api"), {"text_input": "load osm", "chat_history": [], **data},
+                                content_type="application/json")
+
+    def test_delta(self):
+        response = self.post(project_description=self.project_description)
+        base_hash = response.json()["project_hash"]
+        self.assertEqual(base_hash, get_project_hash(self.project_description))
+
+        delta = {"base_hash": base_hash, "removed": ["parcels_1"], "added": [{"id": "water_1", "name": "water"}],
+                 "changed": [{"id": "roads_1", "name": "roads", "categories": ["Primary"]}]}
+        expected = apply_project_delta(self.project_description, delta)
+        self.assertEqual([layer["id"] for layer in expected["layers"]], ["roads_1", "water_1"])
+        response = self.post(project_delta={**delta, "hash": get_project_hash(expected)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["project_hash"], get_project_hash(expected))
+
+    def test_stored_once(self):
+        project_hash = store_project(self.project_description)
+        store_project({"title": "replaced"}, project_hash)
+        self.assertEqual(get_store().get(project_hash), self.project_description)
+
+    def test_store_failure(self):
+        with patch.object(get_store(), "add", side_effect=DatabaseError), self.assertLogs("llm4geo.project_store"):
+            self.assertEqual(self.post(project_description=self.project_description).status_code, 200)
+
+    def test_unknown_base(self):
+        self.assertEqual(self.post(project_delta={"base_hash": "unknown"}).status_code, 409)
+        self.assertEqual(self.post().status_code, 400)
@@ -0,0 +1,34 @@
+import logging
+from functools import lru_cache
+
+import tiktoken
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # The encodings are downloaded on first use, fall back to an estimate when that isn't possible.
+        logger.warning(f"Could not load a tokenizer for {model_name}, estimating token counts: {e}")
+        return None
+
+
+def message_text(message):
+    """
+    Returns the text of a chat history message, either a string or a role-tagged (role, text) pair.
+    """
+    return message if isinstance(message, str) else message[1]
+
+
+@lru_cache(maxsize=2048)
+def count_tokens(text, model_name=None):
+    encoding = get_encoding(model_name or settings.OPENAI_MODEL)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
@@ -1,9 +1,24 @@
+from django.conf import settings
 from django.urls import path
 
-from llm4geo.views.qgis_chat import QGISChatView
-from llm4geo.views.data_chat import DataChatView
+from llm4geo.views.qgis_chat import AsyncQGISChatView, QGISChatView
+from llm4geo.views.qgis_chat_stream import AsyncQGISChatStreamView, QGISChatStreamView
+from llm4geo.views.data_chat import AsyncDataChatView, DataChatView
+from llm4geo.views.data_chat_batch import AsyncDataChatBatchView, DataChatBatchView
+from llm4geo.views.metrics import MetricsView
+
+# The async views are used when served by an ASGI server so a worker isn't blocked waiting on the LLM.
+if settings.ASYNC_VIEWS:
+    data_chat_view, data_chat_batch_view = AsyncDataChatView, AsyncDataChatBatchView
+    qgis_chat_view, qgis_chat_stream_view = AsyncQGISChatView, AsyncQGISChatStreamView
+else:
+    data_chat_view, data_chat_batch_view = DataChatView, DataChatBatchView
+    qgis_chat_view, qgis_chat_stream_view = QGISChatView, QGISChatStreamView
 
 urlpatterns = [
-    path("api/chat/data", DataChatView.as_view(), name="data_chat_api"),
-    path("api/chat/qgis", QGISChatView.as_view(), name="qgis_chat_api"),
+    path("api/chat/data", data_chat_view.as_view(), name="data_chat_api"),
+    path("api/chat/data/batch", data_chat_batch_view.as_view(), name="data_chat_batch_api"),
+    path("api/chat/qgis", qgis_chat_view.as_view(), name="qgis_chat_api"),
+    path("api/chat/qgis/stream", qgis_chat_stream_view.as_view(), name="qgis_chat_stream_api"),
+    path("metrics", MetricsView.as_view(), name="metrics"),
 ]
@@ -1,33 +1,41 @@
-from django.conf import settings
+import logging
+
+from adrf.views import APIView as AsyncAPIView
 from django.http import JsonResponse
-from langchain_community.callbacks import get_openai_callback
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.messages import SystemMessage
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from llm4geo import metrics, request_log
+from llm4geo.cache import aget_or_compute, get_or_compute, response_cache_key
+from llm4geo.llm import ainvoke, get_chain, get_model_name
 from llm4geo.serializers import TextInputSerializer
 
+logger = logging.getLogger(__name__)
+
 
 class DataChatView(APIView):
+    # Retries with the same Idempotency-Key get the stored response, see IdempotencyMiddleware.
+    idempotent = True
     system = """You are trying to help people get data.  Geospatial data comes from a variety of sources including the USGS and OpenStreetMap.  Users will want these datasets in formats which can be used in their preferred geospatial client.
     Datasource needs to be one of "usgs-transportation", "usgs-water", "osm", "landsat", "usgs-imagery", "usgs-elevation" and file format can be one or more options.  File formats should only be recommended for data types they support.  If a user wants feature data such as roads, buildings or any descriptive geographical information then a format that supports feature data should be recommended such as gpkg or shapefile, whichever supports their desired use case the best.  If the user isn't sure which format makes sense for feature data, then geopackage is typically a good recommendation.  If the user wants imagery data (or other kinds of raster data) then they likely want landsat data.  Geotiff (gtiff) or geopackage (gpkg) would be good choices for that data type. KML is a file format that supports embedded styles and works with Google Earth and ATAK.  Elevation data is only supported by gtiff.
 
     Here are some examples.
 
     Example User: I need data for Africa. 
-    Example Response: {{"dataSource": "osm", "fileFormat": ["gpkg"]}}
+    Example Response: {"dataSource": "osm", "fileFormat": ["gpkg"]}
 
     Example User: My job involves the US. 
-    Example Response: {{"dataSource": "usgs-transportation", "fileFormat": ["ESRI Shapefile"]}}
+    Example Response: {"dataSource": "usgs-transportation", "fileFormat": ["ESRI Shapefile"]}
 
     Example User: I need a imagery that will work within ArcGIS.
-    Example Response: {{"dataSource": "landsat", "fileFormat": ["gtiff"]}}
+    Example Response: {"dataSource": "landsat", "fileFormat": ["gtiff"]}
     
     Example User: I need rivers in the US that will open in QGIS.
-    Example Response: {{"dataSource": "usgs-water", "fileFormat": ["gpkg"]}}
+    Example Response: {"dataSource": "usgs-water", "fileFormat": ["gpkg"]}
     """
 
-    prompt = ChatPromptTemplate.from_messages([("system", system), ("human", "{input}")])
+    system_message = SystemMessage(content=system)
 
     json_schema = {
         "title": "export",
@@ -59,21 +67,57 @@ class DataChatView(APIView):
         "additionalProperties": False
     }
 
+    def get_cache_key(self, text):
+        return response_cache_key("data_chat", text, schema=self.json_schema, model_name=get_model_name("data_chat"))
+
     def get_response(self, text):
-        model = settings.LLM_MODEL(model=settings.OPENAI_MODEL, openai_api_key=settings.OPENAI_API_KEY)
-        structured_llm = model.with_structured_output(self.json_schema)
-        structured_llm_with_prompt = self.prompt | structured_llm
-        with get_openai_callback() as cb:
-            response = structured_llm_with_prompt.invoke(text)
-            print(response)
-            print(cb)
-        # TODO: Create a model constructor
+        return get_or_compute(self.get_cache_key(text), lambda: self.invoke_model(text))
+
+    def invoke_model(self, text):
+        model_name = get_model_name("data_chat")
+        with metrics.stage("data_chat", model=model_name):
+            response = get_chain(self.json_schema, model_name).invoke({"system": [self.system_message], "input": text})
+        logger.info(f"Data chat response: {response}")
         return response
 
+    def handle_exception(self, exc):
+        request_log.record(self.request, error=exc, status=getattr(exc, "status_code", 500))
+        return super().handle_exception(exc)
+
     def post(self, request):
-        print(request.data)
+        logger.debug(f"Data chat request: {request.data}")
+        serializer = TextInputSerializer(data=request.data)
+        if serializer.is_valid():
+            text_input = serializer.validated_data['text_input']
+            response = self.get_response(text_input)
+            request_log.record(request, response)
+            return JsonResponse(response)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncDataChatView(DataChatView, AsyncAPIView):
+    """
+    The same as DataChatView but awaits the LLM with ainvoke, so an ASGI worker can serve many requests at once.
+    """
+
+    async def aget_response(self, text):
+        return await aget_or_compute(self.get_cache_key(text), lambda: self.ainvoke_model(text))
+
+    async def ainvoke_model(self, text):
+        model_name = get_model_name("data_chat")
+        with metrics.stage("data_chat", model=model_name):
+            response = await ainvoke(
+                get_chain(self.json_schema, model_name), {"system": [self.system_message], "input": text}
+            )
+        logger.info(f"Data chat response: {response}")
+        return response
+
+    async def post(self, request):
+        logger.debug(f"Data chat request: {request.data}")
         serializer = TextInputSerializer(data=request.data)
         if serializer.is_valid():
             text_input = serializer.validated_data['text_input']
-            return JsonResponse(self.get_response(text_input))
+            response = await self.aget_response(text_input)
+            request_log.record(request, response)
+            return JsonResponse(response)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
@@ -0,0 +1,128 @@
+import asyncio
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework import status
+from rest_framework.response import Response
+
+from llm4geo.batch import get_batch_data, get_checkpoints, new_batch_id, result_line, store_checkpoint, unique_inputs
+from llm4geo.cache import get_cached, set_cached
+from llm4geo.metrics import request_id, request_stages, resumed_request
+from llm4geo.serializers import TextInputBatchSerializer
+from llm4geo.views.data_chat import AsyncDataChatView, DataChatView
+
+
+def ndjson_response(lines, batch_id):
+    return StreamingHttpResponse(
+        lines, content_type="application/x-ndjson", headers={"X-Batch-Id": batch_id, "X-Accel-Buffering": "no"}
+    )
+
+
+class DataChatBatchView(DataChatView):
+    """
+    Answers a list of text inputs, or NDJSON lines, with one NDJSON result per input in input order.
+    Duplicate inputs are sent to the LLM once and completed items are checkpointed under the batch_id. Only the LLM
+    calls run in the pool, the cache and checkpoints are read and written on the request thread so that the pool
+    threads never open database connections. The cache is read only as far ahead as keeps the pool busy, so the first
+    results are sent without waiting for the lookups of the whole batch.
+    """
+    # Batches are resumed with their batch_id instead.
+    idempotent = False
+
+    def post(self, request):
+        try:
+            serializer = TextInputBatchSerializer(data=get_batch_data(request))
+        except ValueError as e:
+            return Response({"error": f"Invalid NDJSON: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        text_inputs = serializer.validated_data['text_inputs']
+        batch_id = serializer.validated_data.get('batch_id') or new_batch_id()
+        keys, unique = unique_inputs(text_inputs)
+        # The lines are sent after the middleware has returned, so their stages are recorded in the request's context.
+        request_context = request_id.get(), request_stages.get()
+
+        def lines():
+            with resumed_request(*request_context):
+                checkpoints = get_checkpoints(batch_id, unique)
+                pending = deque(key for key in unique if key not in checkpoints)
+                responses, futures, collected = {}, {}, set()
+                executor = ThreadPoolExecutor(max_workers=settings.DATA_BATCH_CONCURRENCY)
+
+                def schedule(key):
+                    while pending and (
+                        len(futures) - len(collected) < settings.DATA_BATCH_CONCURRENCY
+                        or key not in responses
+                    ):
+                        next_key = pending.popleft()
+                        responses[next_key] = get_cached(self.get_cache_key(unique[next_key]))
+                        if responses[next_key] is None:
+                            # The context is copied so the stage metrics are recorded for this request.
+                            futures[next_key] = executor.submit(
+                                contextvars.copy_context().run, self.invoke_model, unique[next_key]
+                            )
+
+                try:
+                    for index, (key, text) in enumerate(zip(keys, text_inputs)):
+                        try:
+                            if key not in checkpoints:
+                                schedule(key)
+                                if responses[key] is None:
+                                    collected.add(key)
+                                    responses[key] = futures[key].result()
+                                    set_cached(self.get_cache_key(text), responses[key])
+                                checkpoints[key] = responses[key]
+                                store_checkpoint(batch_id, key, checkpoints[key])
+                            yield result_line(index, text, checkpoints[key])
+                        except Exception as e:
+                            yield result_line(index, text, error=str(e))
+                finally:
+                    executor.shutdown(wait=False, cancel_futures=True)
+
+        return ndjson_response(lines(), batch_id)
+
+
+class AsyncDataChatBatchView(DataChatBatchView, AsyncDataChatView):
+
+    async def post(self, request):
+        try:
+            serializer = TextInputBatchSerializer(data=await sync_to_async(get_batch_data)(request))
+        except ValueError as e:
+            return Response({"error": f"Invalid NDJSON: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        text_inputs = serializer.validated_data['text_inputs']
+        batch_id = serializer.validated_data.get('batch_id') or new_batch_id()
+        keys, unique = unique_inputs(text_inputs)
+        semaphore = asyncio.Semaphore(settings.DATA_BATCH_CONCURRENCY)
+
+        async def get_response(text):
+            async with semaphore:
+                return await self.aget_response(text)
+
+        request_context = request_id.get(), request_stages.get()
+
+        async def lines():
+            with resumed_request(*request_context):
+                checkpoints = await sync_to_async(get_checkpoints)(batch_id, unique)
+                tasks = {
+                    key: asyncio.create_task(get_response(text)) for key, text in unique.items() if key not in checkpoints
+                }
+                try:
+                    for index, (key, text) in enumerate(zip(keys, text_inputs)):
+                        try:
+                            if key not in checkpoints:
+                                checkpoints[key] = await tasks[key]
+                                await sync_to_async(store_checkpoint)(batch_id, key, checkpoints[key])
+                            yield result_line(index, text, checkpoints[key])
+                        except Exception as e:
+                            yield result_line(index, text, error=str(e))
+                finally:
+                    for task in tasks.values():
+                        task.cancel()
+
+        return ndjson_response(lines(), batch_id)
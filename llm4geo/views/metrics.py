@@ -0,0 +1,13 @@
+from django.http import HttpResponse
+from rest_framework.views import APIView
+
+from llm4geo.metrics import render
+
+
+class MetricsView(APIView):
+    """
+    The metrics of this worker in the Prometheus text format.
+    """
+
+    def get(self, request):
+        return HttpResponse(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,83 +1,470 @@
+import asyncio
+import contextvars
 import json
+import logging
 
-import jsonschema
+from adrf.views import APIView as AsyncAPIView
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.http import JsonResponse
+from jsonschema import Draft7Validator
 from jsonschema.exceptions import ValidationError
-from langchain_core.messages import SystemMessage
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.prompts import MessagesPlaceholder
+from rest_framework import status
+from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from llm4geo.schemas.qgis_project_description import get_qgis_project_description
-from llm4geo.schemas.supported_functions import get_supported_functions, get_function_schema, get_function_name_schema
+from llm4geo import metrics, request_log
+from llm4geo.cache import aget_or_compute, get_or_compute, response_cache_key
+from llm4geo.conversations import add_turns, load_conversation
+from llm4geo.gazetteer import find_location
+from llm4geo.llm import arun_steps, get_chain, get_escalation_model, get_model_name, run_steps
+from llm4geo.project_store import UnknownProjectError, resolve_project
+from llm4geo.project_index import prune_project
+from llm4geo.prompts import PromptBuilder
+from llm4geo.repair import repair
+from llm4geo.router import route
+from llm4geo.schemas.qgis_project_description import get_project_legend
+from llm4geo.schemas.supported_functions import get_supported_functions, get_function_name_schema, \
+    get_function_summaries, get_specialized_function, get_specialized_function_call, get_specialized_plan
 from llm4geo.serializers import QGISSerializer
+from llm4geo.speculation import get_candidates, get_executor, record
+
+logger = logging.getLogger(__name__)
+
+
+def cancel_candidates(candidates, function_name=None):
+    """
+    Cancels the speculative parameter extractions of every candidate but function_name and returns that one, if any.
+    """
+    for candidate, future in candidates.items():
+        if candidate != function_name:
+            future.cancel()
+    return candidates.get(function_name)
 
 
 class QGISChatView(APIView):
+    """
+    Chooses a QGIS function and its parameters for a request.
+
+    The LLM logic is written once as generators of steps that yield the LLM calls they need, see llm.run_steps, so
+    AsyncQGISChatView only differs in how it calls the LLM, the cache and the speculation workers.
+    """
+    idempotent = True
+    chat_session = None
+    project_hash = None
     supported_functions = get_supported_functions()
     function_name_schema = get_function_name_schema()
+    function_summaries = get_function_summaries()
+    project_legend = get_project_legend()
 
-    def get_function_name(self, text, chat_history=None):
-        system = f"You are a chatbot trying to help the user choose a custom function to call which will execute some actions within QGIS.  The user will give you some information and you will pick from a list of supported functions: {json.dumps(self.supported_functions)}"
-        prompt = ChatPromptTemplate.from_messages([SystemMessage(content=system), MessagesPlaceholder("chat_history"), ("human", "{input}")])
-        model = settings.LLM_MODEL(model=settings.OPENAI_MODEL, openai_api_key=settings.OPENAI_API_KEY)
-        structured_llm = model.with_structured_output(self.function_name_schema)
-        structured_llm_with_prompt = prompt | structured_llm
-        response = structured_llm_with_prompt.invoke({"chat_history": chat_history, "input": text})
+    def function_name_cache_key(self, text, chat_history=None):
+        return response_cache_key(
+            "function_name", text, chat_history, schema=self.function_name_schema, model_name=get_model_name("function_name")
+        )
+
+    def parameters_model(self, function_name):
+        """
+        The model for the parameters of function_name, or for the function_call and plan stages.
+        """
+        if function_name in ["function_call", "plan"]:
+            return get_model_name(function_name)
+        return get_model_name("parameters", function_name)
+
+    def repair_function_name(self, response):
+        if response.get('function_name') in self.supported_functions:
+            return response
+        return repair(response, self.function_name_schema) or response
+
+    def invalid_function_name_input(self, function_name):
+        logger.info(f"Got invalid function {function_name} retrying...")
+        return f"You chose the function_name {function_name} which is not in the list of available functions {list(self.supported_functions.keys())}.  Given the previous prompt"
+
+    def function_name_prompt(self, text, chat_history=None):
+        prompt = PromptBuilder("function_name")
+        prompt.add("instructions", "You are a chatbot trying to help the user choose a custom function to call which will execute some actions within QGIS.  The user will give you some information and you will pick from a list of supported functions:")
+        prompt.add("functions", self.function_summaries)
+        return prompt.build(text, chat_history)
+
+    def function_prompt(self, function_name, text, project_description, chat_history=None):
+        prompt = PromptBuilder(function_name)
+        prompt.add("instructions", f"Provide the parameters for {function_name} using the users current project to help.")
+        return self.add_project(prompt, text, project_description, chat_history).build(text, chat_history)
+
+    def function_call_prompt(self, text, project_description, chat_history=None):
+        prompt = PromptBuilder("function_call")
+        prompt.add("instructions", "You are a chatbot trying to help the user call a custom function which will execute some actions within QGIS.  Pick the function call that best suits the user and provide its parameters using the users current project to help.")
+        return self.add_project(prompt, text, project_description, chat_history).build(text, chat_history)
+
+    def plan_prompt(self, text, project_description, chat_history=None):
+        prompt = PromptBuilder("plan")
+        prompt.add("instructions", "You are a chatbot trying to help the user carry out their request within QGIS using custom functions.  Break the request into the function calls it needs, in the order they should run, and provide the parameters of each using the users current project to help.  Use a single step if one function call is enough.")
+        return self.add_project(prompt, text, project_description, chat_history).build(text, chat_history)
+
+    def add_project(self, prompt, text, project_description, chat_history=None):
+        project_description = prune_project(project_description, text, chat_history, project_hash=self.project_hash)
+        prompt.add("project", f"The users project specifically uses:\n{json.dumps(project_description, separators=(',', ':'))}")
+        return prompt.add("project_legend", self.project_legend, required=False)
+
+    def invalid_params_input(self, function_name, response, error, text, retries):
+        logger.info(f"Got invalid params {response} for function {function_name}: {error}")
+        logger.info(f"Retrying {retries} time(s).")
+        return f"You chose the params {response} which does not match the schema and gives the following error: {error}.  Given the previous prompt: '{text}' provide a response that matches the schema."
+
+    def function_name_steps(self, payload, response=None):
+        """
+        The steps for a supported function name for payload, starting from response if it was already received.
+        An unsupported name is asked for again and when the retries are used up LLM_ESCALATION_MODEL, if set, is asked.
+        """
+        model_name = get_model_name("function_name")
+        structured_llm_with_prompt = get_chain(self.function_name_schema, model_name)
+        if response is None:
+            with metrics.stage("function_name", model=model_name):
+                response = yield structured_llm_with_prompt, payload
+        response = self.repair_function_name(response)
         function_name = response['function_name']
         retries = 2
         while function_name not in self.supported_functions and retries:
-            print(f"Got invalid function {function_name} retying...")
-            text_input = f"You chose the function_name {function_name} which is not in the list of available functions {list(self.supported_functions.keys())}.  Given the previous prompt"
-            response = structured_llm_with_prompt.invoke({"chat_history": chat_history, "input": text_input})
+            text_input = self.invalid_function_name_input(function_name)
+            metrics.validation_failures.inc(stage="function_name")
+            with metrics.stage("function_name_retry", model=model_name):
+                response = self.repair_function_name((yield structured_llm_with_prompt, {**payload, "input": text_input}))
+            metrics.retries.inc(stage="function_name")
             function_name = response['function_name']
             retries -= 1
+        escalation_model = get_escalation_model(model_name)
+        if function_name not in self.supported_functions and escalation_model:
+            metrics.validation_failures.inc(stage="function_name")
+            with metrics.stage("function_name_escalation", model=escalation_model):
+                response = self.repair_function_name((yield get_chain(self.function_name_schema, escalation_model), payload))
+            metrics.escalations.inc(stage="function_name")
         return response
 
-    def get_function(self, function_name, text, project_description, chat_history=None):
-        function_schema = get_function_schema(function_name, project_description)
-        system = f"Using {function_schema} and the users current project which uses a schema of: \n\n {get_qgis_project_description()} and the users project specifically uses: \n\n {project_description} using use that description to help."
-        prompt = ChatPromptTemplate.from_messages([SystemMessage(content=system), MessagesPlaceholder("chat_history"), ("human", "{input}")])
-        model = settings.LLM_MODEL(model=settings.OPENAI_MODEL, openai_api_key=settings.OPENAI_API_KEY)
-        structured_llm = model.with_structured_output(function_schema)
-        structured_llm_with_prompt = prompt | structured_llm
+    def validation_steps(self, function_name, payload, function_schema, validator=None, response=None):
+        """
+        The steps for a response to payload that is valid for function_schema, starting from response if it was already
+        received. An invalid response is repaired or asked for again and when the retries are used up
+        LLM_ESCALATION_MODEL, if set, is asked once more.
+        """
+        validator = validator or Draft7Validator(function_schema)
+        model_name = self.parameters_model(function_name)
+        structured_llm_with_prompt = get_chain(function_schema, model_name)
         try:
-            response = structured_llm_with_prompt.invoke({"chat_history": chat_history, "input": text})
+            if response is None:
+                with metrics.stage("parameters", function_name, model_name):
+                    response = yield structured_llm_with_prompt, payload
             retries = 2
-            while retries:
+            while True:
                 try:
-                    jsonschema.validate(response, function_schema)
+                    with metrics.stage("validation", function_name):
+                        validator.validate(response)
                     break
                 except ValidationError as e:
+                    metrics.validation_failures.inc(stage="parameters", function=function_name)
+                    # Most invalid responses are mechanical mistakes that can be fixed without asking the LLM again.
+                    repaired = repair(response, function_schema, validator)
+                    if repaired is not None:
+                        response = repaired
+                        break
                     if not retries:
-                        raise e
+                        model_name = get_escalation_model(model_name)
+                        if model_name is None:
+                            raise e
+                        logger.info(f"Escalating {function_name} to {model_name}.")
+                        with metrics.stage("escalation", function_name, model_name):
+                            response = yield get_chain(function_schema, model_name), payload
+                        metrics.escalations.inc(stage="parameters", function=function_name)
+                        continue
+
+                    text_input = self.invalid_params_input(function_name, response, e, payload["input"], retries)
+                    with metrics.stage("retry", function_name, model_name):
+                        response = yield structured_llm_with_prompt, {**payload, "input": text_input}
+                    metrics.retries.inc(stage="parameters", function=function_name)
+                    retries -= 1
 
-                    print(f"Got invalid params {response} for function {function_name}: {e}")
-                    print(f"Retrying {retries} time(s).")
-                    text_input = f"You chose the params {response} which does not match {function_schema} and gives the following error: {e}.  Given the previous prompt: '{text}' provide a response that matches the schema."
-                    response = structured_llm_with_prompt.invoke({"chat_history": chat_history, "input": text_input})
-                
         except Exception as e:
-            print(f"Failed to get_function with schema {json.dumps(function_schema)}")
+            logger.exception(f"Failed to get_function with schema {json.dumps(function_schema)}")
             raise e
         return response
 
+    def invoke_with_validation(self, function_name, payload, function_schema, validator=None, response=None):
+        return run_steps(self.validation_steps(function_name, payload, function_schema, validator, response))
+
+    def get_function_name(self, text, chat_history=None):
+        key = self.function_name_cache_key(text, chat_history)
+        return get_or_compute(key, lambda: run_steps(self.function_name_steps(self.function_name_prompt(text, chat_history))))
+
+    def known_location(self, function_name, text):
+        if function_name == "go_to_location":
+            # Places in the gazetteer don't need the LLM to recall their coordinates.
+            return find_location(text)
+        return None
+
+    def function_request(self, function_name, text, project_description, chat_history=None):
+        """
+        Returns the cache key of the parameters of function_name and a function returning the steps to compute them.
+        """
+        function_schema, validator = get_specialized_function(function_name, project_description)
+        key = response_cache_key(
+            function_name, text, chat_history, project_description, function_schema, self.parameters_model(function_name)
+        )
+        return key, lambda: self.validation_steps(
+            function_name, self.function_prompt(function_name, text, project_description, chat_history), function_schema,
+            validator
+        )
+
+    def stage_request(self, stage, text, project_description, chat_history=None):
+        """
+        Returns the cache key, schema, validator and prompt of the "function_call" or "plan" stage.
+        """
+        if stage == "plan":
+            schema, validator = get_specialized_plan(project_description)
+            prompt = self.plan_prompt
+        else:
+            schema, validator = get_specialized_function_call(project_description)
+            prompt = self.function_call_prompt
+        key = response_cache_key(stage, text, chat_history, project_description, schema, get_model_name(stage))
+        return key, schema, validator, lambda: prompt(text, project_description, chat_history)
+
+    def stage_steps(self, stage, text, project_description, chat_history=None):
+        key, schema, validator, get_payload = self.stage_request(stage, text, project_description, chat_history)
+        return key, lambda: self.validation_steps(stage, get_payload(), schema, validator)
+
+    def get_function(self, function_name, text, project_description, chat_history=None):
+        location = self.known_location(function_name, text)
+        if location is not None:
+            return location
+        key, steps = self.function_request(function_name, text, project_description, chat_history)
+        return get_or_compute(key, lambda: run_steps(steps()))
+
+    def get_parameters(self, function_name, text, project_description, chat_history=None):
+        # Check if we need to get more information about the function (i.e. it needs params) or just skip that and pass it back.
+        if "properties" not in self.supported_functions[function_name]:
+            return {}
+        return self.get_function(function_name, text, project_description, chat_history)
+
+    def get_function_call(self, text, project_description, chat_history=None):
+        """
+        Chooses the function and its parameters in one LLM call using the combined oneOf schema.
+        """
+        key, steps = self.stage_steps("function_call", text, project_description, chat_history)
+        return get_or_compute(key, lambda: run_steps(steps()))['function_call']
+
+    def get_plan(self, text, project_description, chat_history=None):
+        """
+        Returns the chat and the ordered function calls ("steps") that carry out a request in one LLM call.
+        """
+        key, steps = self.stage_steps("plan", text, project_description, chat_history)
+        return get_or_compute(key, lambda: run_steps(steps()))
+
+    def get_function_speculatively(self, text, project_description, chat_history=None):
+        """
+        Starts parameter extraction for the likeliest functions while the function name is being chosen.
+        The extraction for the chosen function is kept and the others are cancelled or ignored.
+        """
+        candidates = get_candidates(text, chat_history)
+        function_futures = {
+            # The context is copied so the request id and stage metrics carry over to the speculation threads.
+            candidate: get_executor().submit(
+                contextvars.copy_context().run, self.get_function, candidate, text, project_description, chat_history
+            )
+            for candidate in candidates
+        }
+        try:
+            function_name_response = self.get_function_name(text, chat_history)
+        except Exception:
+            cancel_candidates(function_futures)
+            raise
+        function_name = function_name_response['function_name']
+        future = cancel_candidates(function_futures, function_name)
+        if future is not None:
+            function_response = future.result()
+        else:
+            function_response = self.get_parameters(function_name, text, project_description, chat_history)
+        return self.chat_response(function_name_response, function_response, speculation=record(function_name, candidates))
+
+    def get_routed_response(self, routed, text, project_description, chat_history=None):
+        """
+        Completes a response for a function chosen by the local router, only asking the LLM for missing parameters.
+        """
+        parameters = routed['parameters']
+        if parameters is None:
+            parameters = self.get_function(routed['function_name'], text, project_description, chat_history)
+        return self.chat_response(routed, parameters, route=routed['route'])
+
+    def get_strategy(self, text_input, plan=False):
+        """
+        Returns how to answer text_input, "plan", "route", "function_call", "speculative" or "function_name", and the
+        local route for "route".
+        """
+        if plan:
+            return "plan", None
+        routed = route(text_input)
+        if routed is not None:
+            return "route", routed
+        if settings.FUNCTION_CALL_STRATEGY == "single_call":
+            return "function_call", None
+        if settings.SPECULATIVE_PARAMETERS:
+            return "speculative", None
+        return "function_name", None
+
+    def chat_response(self, function_name_response, parameters, **extra):
+        return {
+            "chat": function_name_response['chat'], "function_name": function_name_response['function_name'],
+            "parameters": parameters, **extra
+        }
+
+    def get_chat_response(self, text_input, project_description, chat_history=None, plan=False):
+        strategy, routed = self.get_strategy(text_input, plan)
+        if strategy == "plan":
+            return self.get_plan(text_input, project_description, chat_history)
+        if strategy == "route":
+            return self.get_routed_response(routed, text_input, project_description, chat_history)
+        if strategy == "function_call":
+            return self.get_function_call(text_input, project_description, chat_history)
+        if strategy == "speculative":
+            return self.get_function_speculatively(text_input, project_description, chat_history)
+        function_name_response = self.get_function_name(text_input, chat_history)
+        return self.chat_response(function_name_response, self.get_parameters(
+            function_name_response['function_name'], text_input, project_description, chat_history
+        ))
+
     def post(self, request):
         serializer = QGISSerializer(data=request.data)
         if not serializer.is_valid():
-            print(serializer)
+            logger.info(f"Invalid request: {serializer.errors}")
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
         text_input = serializer.validated_data['text_input']
-        project_description = serializer.validated_data['project_description']
         chat_history = serializer.validated_data['chat_history']
-        function_name_response = self.get_function_name(text_input, chat_history)
-        function_name = function_name_response['function_name']
-        # Check if we need to get more information about the function (i.e. it needs params) or just skip that and pass it back.
+        if 'session_id' in serializer.validated_data:
+            self.chat_session, chat_history = load_conversation(serializer.validated_data['session_id'])
+        try:
+            project_description, project_hash = resolve_project(
+                serializer.validated_data.get('project_description'), serializer.validated_data.get('project_delta')
+            )
+        except UnknownProjectError as e:
+            # The client should resend the full project description.
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        self.project_hash = project_hash
+        return self.make_response(
+            text_input, project_description, chat_history, project_hash, serializer.validated_data['plan']
+        )
+
+    def finish_response(self, text_input, project_description, response, project_hash):
+        """
+        Returns the body to respond with, after storing the turns of a session and queueing the request log entry.
+        """
+        body = {**response, "project_hash": project_hash}
+        if self.chat_session is not None:
+            add_turns(self.chat_session, text_input, response)
+            body["session_id"] = str(self.chat_session.id)
+        request_log.record(self.request, body, project_description, project_hash)
+        return body
+
+    def handle_exception(self, exc):
+        request_log.record(self.request, error=exc, status=getattr(exc, "status_code", 500))
+        return super().handle_exception(exc)
+
+    def make_response(self, text_input, project_description, chat_history, project_hash, plan=False):
+        response = self.get_chat_response(text_input, project_description, chat_history, plan)
+        return JsonResponse(self.finish_response(text_input, project_description, response, project_hash))
+
+
+class AsyncQGISChatView(QGISChatView, AsyncAPIView):
+    """
+    The same as QGISChatView but awaits the LLM with ainvoke, so an ASGI worker can serve many requests at once.
+    """
+
+    async def aget_function_name(self, text, chat_history=None):
+        key = self.function_name_cache_key(text, chat_history)
+        return await aget_or_compute(
+            key, lambda: arun_steps(self.function_name_steps(self.function_name_prompt(text, chat_history)))
+        )
+
+    async def aget_function(self, function_name, text, project_description, chat_history=None):
+        location = self.known_location(function_name, text)
+        if location is not None:
+            return location
+        key, steps = self.function_request(function_name, text, project_description, chat_history)
+        return await aget_or_compute(key, lambda: arun_steps(steps()))
+
+    async def aget_parameters(self, function_name, text, project_description, chat_history=None):
         if "properties" not in self.supported_functions[function_name]:
-            function_response = {}
+            return {}
+        return await self.aget_function(function_name, text, project_description, chat_history)
+
+    async def aget_function_call(self, text, project_description, chat_history=None):
+        key, steps = self.stage_steps("function_call", text, project_description, chat_history)
+        return (await aget_or_compute(key, lambda: arun_steps(steps())))['function_call']
+
+    async def aget_plan(self, text, project_description, chat_history=None):
+        key, steps = self.stage_steps("plan", text, project_description, chat_history)
+        return await aget_or_compute(key, lambda: arun_steps(steps()))
+
+    async def aget_function_speculatively(self, text, project_description, chat_history=None):
+        candidates = get_candidates(text, chat_history)
+        function_tasks = {
+            candidate: asyncio.create_task(self.aget_function(candidate, text, project_description, chat_history))
+            for candidate in candidates
+        }
+        try:
+            function_name_response = await self.aget_function_name(text, chat_history)
+        except Exception:
+            cancel_candidates(function_tasks)
+            raise
+        function_name = function_name_response['function_name']
+        task = cancel_candidates(function_tasks, function_name)
+        if task is not None:
+            function_response = await task
         else:
-            function_response = self.get_function(function_name, text_input, project_description, chat_history)
-        return JsonResponse({"chat": function_name_response['chat'], "function_name": function_name,
-                             "parameters": function_response})
+            function_response = await self.aget_parameters(function_name, text, project_description, chat_history)
+        return self.chat_response(function_name_response, function_response, speculation=record(function_name, candidates))
+
+    async def aget_routed_response(self, routed, text, project_description, chat_history=None):
+        parameters = routed['parameters']
+        if parameters is None:
+            parameters = await self.aget_function(routed['function_name'], text, project_description, chat_history)
+        return self.chat_response(routed, parameters, route=routed['route'])
+
+    async def aget_chat_response(self, text_input, project_description, chat_history=None, plan=False):
+        strategy, routed = self.get_strategy(text_input, plan)
+        if strategy == "plan":
+            return await self.aget_plan(text_input, project_description, chat_history)
+        if strategy == "route":
+            return await self.aget_routed_response(routed, text_input, project_description, chat_history)
+        if strategy == "function_call":
+            return await self.aget_function_call(text_input, project_description, chat_history)
+        if strategy == "speculative":
+            return await self.aget_function_speculatively(text_input, project_description, chat_history)
+        function_name_response = await self.aget_function_name(text_input, chat_history)
+        return self.chat_response(function_name_response, await self.aget_parameters(
+            function_name_response['function_name'], text_input, project_description, chat_history
+        ))
+
+    async def post(self, request):
+        serializer = QGISSerializer(data=request.data)
+        if not serializer.is_valid():
+            logger.info(f"Invalid request: {serializer.errors}")
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        text_input = serializer.validated_data['text_input']
+        chat_history = serializer.validated_data['chat_history']
+        if 'session_id' in serializer.validated_data:
+            self.chat_session, chat_history = await sync_to_async(load_conversation)(
+                serializer.validated_data['session_id']
+            )
+        try:
+            project_description, project_hash = await sync_to_async(resolve_project)(
+                serializer.validated_data.get('project_description'), serializer.validated_data.get('project_delta')
+            )
+        except UnknownProjectError as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        self.project_hash = project_hash
+        return await self.amake_response(
+            text_input, project_description, chat_history, project_hash, serializer.validated_data['plan']
+        )
+
+    async def amake_response(self, text_input, project_description, chat_history, project_hash, plan=False):
+        response = await self.aget_chat_response(text_input, project_description, chat_history, plan)
+        body = await sync_to_async(self.finish_response)(text_input, project_description, response, project_hash)
+        return JsonResponse(body)
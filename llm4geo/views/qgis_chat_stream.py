@@ -0,0 +1,250 @@
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+from llm4geo import metrics, request_log, single_flight
+from llm4geo.cache import aget_cached, aset_cached, get_cached, set_cached
+from llm4geo.llm import arun_steps, astream, get_chain, get_model_name, run_steps
+from llm4geo.metrics import request_id, request_stages, resumed_request
+from llm4geo.views.qgis_chat import AsyncQGISChatView, QGISChatView
+
+logger = logging.getLogger(__name__)
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def event_stream_response(events):
+    return StreamingHttpResponse(
+        events, content_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def get_chat(response):
+    return (response or {}).get("chat") or ""
+
+
+def get_function_call_chat(response):
+    return get_chat((response or {}).get("function_call"))
+
+
+class QGISChatStreamView(QGISChatView):
+    """
+    Streams the chat text as server-sent "chat" events while the function is being chosen, followed by a "result"
+    event with the same body QGISChatView responds with.
+
+    The stream methods yield ("chat", text) for each new piece of chat text and finally ("response", response).
+    """
+
+    def stream_chat(self, chain, payload, chat_from, stage):
+        response, sent = None, ""
+        with metrics.stage(*stage):
+            for response in chain.stream(payload):
+                chat = chat_from(response)
+                if len(chat) > len(sent) and chat.startswith(sent):
+                    yield "chat", chat[len(sent):]
+                    sent = chat
+        yield "response", response
+
+    def stream_cached(self, key, chain, get_payload, chat_from, finish_steps, stage):
+        """
+        Streams a structured output response, or the chat of the cached response, then stores the finished response.
+        finish_steps(payload, response) returns the steps that check the streamed response, see QGISChatView, and the
+        stream is timed as the metrics stage with the (name, function, model) arguments of stage.
+        A request for a response that is already being streamed waits for it instead of calling the LLM again.
+        """
+        response, flight = get_cached(key), None
+        if response is None and settings.SINGLE_FLIGHT:
+            flight, leader = single_flight.join(key)
+            if not leader:
+                response, flight = single_flight.wait(flight), None
+        if response is not None:
+            if chat_from(response):
+                yield "chat", chat_from(response)
+            yield "response", response
+            return
+        try:
+            payload = get_payload()
+            for event, data in self.stream_chat(chain, payload, chat_from, stage):
+                if event == "response":
+                    response = run_steps(finish_steps(payload, data))
+                else:
+                    yield event, data
+        except Exception as error:
+            if flight:
+                flight.finish(error=error)
+            raise
+        finally:
+            if flight and not flight.done.is_set():
+                flight.finish(response)
+        set_cached(key, response)
+        yield "response", response
+
+    def stream_strategy(self, text_input, plan=False):
+        strategy, routed = self.get_strategy(text_input, plan)
+        # The parameters are only extracted once the function name has been streamed.
+        return "function_name" if strategy == "speculative" else strategy, routed
+
+    def stream_request(self, strategy, text_input, project_description, chat_history=None):
+        """
+        Returns the stream_cached arguments for the "function_name", "function_call" or "plan" strategy.
+        """
+        if strategy == "function_name":
+            model_name = get_model_name("function_name")
+            return (
+                self.function_name_cache_key(text_input, chat_history),
+                get_chain(self.function_name_schema, model_name),
+                lambda: self.function_name_prompt(text_input, chat_history),
+                get_chat,
+                self.function_name_steps,
+                ("function_name", "", model_name),
+            )
+        key, schema, validator, get_payload = self.stage_request(strategy, text_input, project_description, chat_history)
+        model_name = get_model_name(strategy)
+        return (
+            key,
+            get_chain(schema, model_name),
+            get_payload,
+            get_chat if strategy == "plan" else get_function_call_chat,
+            lambda payload, response: self.validation_steps(strategy, payload, schema, validator, response),
+            # Recorded like the first call of QGISChatView.validation_steps.
+            ("parameters", strategy, model_name),
+        )
+
+    def stream_chat_response(self, text_input, project_description, chat_history=None, plan=False):
+        strategy, routed = self.stream_strategy(text_input, plan)
+        if strategy == "route":
+            response = self.get_routed_response(routed, text_input, project_description, chat_history)
+            yield "chat", response['chat']
+            yield "response", response
+            return
+        events = self.stream_cached(*self.stream_request(strategy, text_input, project_description, chat_history))
+        for event, data in events:
+            if event == "response":
+                response = data
+            else:
+                yield event, data
+        if strategy == "function_call":
+            response = response['function_call']
+        elif strategy == "function_name":
+            response = self.chat_response(response, self.get_parameters(
+                response['function_name'], text_input, project_description, chat_history
+            ))
+        yield "response", response
+
+    def stream_failed(self, error, response, project_description, project_hash):
+        """
+        Logs a stream that failed part way and returns the "error" event to end it with.
+        """
+        logger.exception(f"Failed to stream a chat response: {error}")
+        request_log.record(self.request, project_description=project_description, project_hash=project_hash, error=error)
+        # A retry with the same Idempotency-Key should try again rather than replay the error.
+        response.idempotent = False
+        return sse_event("error", {"error": str(error)})
+
+    def make_response(self, text_input, project_description, chat_history, project_hash, plan=False):
+        # The stream is sent after the middleware has returned, so its stages are recorded in the request's context.
+        request_context = request_id.get(), request_stages.get()
+
+        def events():
+            with resumed_request(*request_context):
+                try:
+                    events = self.stream_chat_response(text_input, project_description, chat_history, plan)
+                    for event, data in events:
+                        if event == "response":
+                            body = self.finish_response(text_input, project_description, data, project_hash)
+                            yield sse_event("result", body)
+                        else:
+                            yield sse_event(event, {"text": data})
+                except Exception as e:
+                    yield self.stream_failed(e, response, project_description, project_hash)
+
+        response = event_stream_response(events())
+        return response
+
+
+class AsyncQGISChatStreamView(QGISChatStreamView, AsyncQGISChatView):
+
+    async def astream_chat(self, chain, payload, chat_from, stage):
+        response, sent = None, ""
+        with metrics.stage(*stage):
+            async for response in astream(chain, payload):
+                chat = chat_from(response)
+                if len(chat) > len(sent) and chat.startswith(sent):
+                    yield "chat", chat[len(sent):]
+                    sent = chat
+        yield "response", response
+
+    async def astream_cached(self, key, chain, get_payload, chat_from, finish_steps, stage):
+        response, flight = await aget_cached(key), None
+        if response is None and settings.SINGLE_FLIGHT:
+            flight, leader = single_flight.ajoin(key)
+            if not leader:
+                response, flight = await single_flight.await_flight(flight), None
+        if response is not None:
+            if chat_from(response):
+                yield "chat", chat_from(response)
+            yield "response", response
+            return
+        try:
+            payload = get_payload()
+            async for event, data in self.astream_chat(chain, payload, chat_from, stage):
+                if event == "response":
+                    response = await arun_steps(finish_steps(payload, data))
+                else:
+                    yield event, data
+        except Exception as error:
+            if flight:
+                flight.finish(error=error)
+            raise
+        finally:
+            if flight and not flight.done.is_set():
+                flight.finish(response)
+        await aset_cached(key, response)
+        yield "response", response
+
+    async def astream_chat_response(self, text_input, project_description, chat_history=None, plan=False):
+        strategy, routed = self.stream_strategy(text_input, plan)
+        if strategy == "route":
+            response = await self.aget_routed_response(routed, text_input, project_description, chat_history)
+            yield "chat", response['chat']
+            yield "response", response
+            return
+        events = self.astream_cached(*self.stream_request(strategy, text_input, project_description, chat_history))
+        async for event, data in events:
+            if event == "response":
+                response = data
+            else:
+                yield event, data
+        if strategy == "function_call":
+            response = response['function_call']
+        elif strategy == "function_name":
+            response = self.chat_response(response, await self.aget_parameters(
+                response['function_name'], text_input, project_description, chat_history
+            ))
+        yield "response", response
+
+    async def amake_response(self, text_input, project_description, chat_history, project_hash, plan=False):
+        request_context = request_id.get(), request_stages.get()
+
+        async def events():
+            with resumed_request(*request_context):
+                try:
+                    events = self.astream_chat_response(text_input, project_description, chat_history, plan)
+                    async for event, data in events:
+                        if event == "response":
+                            body = await sync_to_async(self.finish_response)(
+                                text_input, project_description, data, project_hash
+                            )
+                            yield sse_event("result", body)
+                        else:
+                            yield sse_event(event, {"text": data})
+                except Exception as e:
+                    yield self.stream_failed(e, response, project_description, project_hash)
+
+        response = event_stream_response(events())
+        return response
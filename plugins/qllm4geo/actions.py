@@ -3,7 +3,7 @@ from qgis.utils import iface
 
 from typing import Literal
 from typing import TypedDict
-from .utils import add_layer, color_object, convert_coordinate, log_tag
+from .utils import ActionBatch, add_layer, color_object, convert_coordinate, log_tag, refresh_canvas
 
 
 def add_map_layer(uri: str, layer_name: str, provider: str):
@@ -41,7 +41,7 @@ def go_to_location(west: float, south: float, east: float, north: float):
     zoom_rect = QgsRectangle(ll.x(), ll.y(), ur.x(), ur.y())
     canvas = iface.mapCanvas()
     canvas.setExtent(zoom_rect)
-    canvas.refresh()
+    refresh_canvas()
 
 
 function_map = {"add_map_layer": add_map_layer, "add_feature_layer": add_feature_layer,
@@ -49,7 +49,23 @@ function_map = {"add_map_layer": add_map_layer, "add_feature_layer": add_feature
                 "go_to_location": go_to_location,
                 "remove_all_map_layers": remove_all_map_layers}
 
-class ChatResponse(TypedDict):
+
+def apply_actions(actions):
+    """
+    Runs (function_name, parameters) pairs from function_map as one batch, repainting the map once at the end.
+    """
+    with ActionBatch():
+        for function_name, parameters in actions:
+            qgis_method = function_map[function_name]
+            qgis_method(**(parameters or {}))
+
+class PlanStep(TypedDict):
+    function_name: str
+    parameters: dict
+
+
+class ChatResponse(TypedDict, total=False):
     chat: str
     function_name: Literal["addMapLayer", "removeAllMapLayers"]
     parameters: dict
+    steps: list[PlanStep]
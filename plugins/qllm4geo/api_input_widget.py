@@ -4,18 +4,22 @@ from PyQt5.QtWidgets import (
     QLineEdit,
     QTextEdit,
     QPushButton,
+    QCheckBox,
     QMessageBox,
     QDockWidget,
     QWidget
 )
 from PyQt5.QtCore import Qt, QSettings
-from qgis.core import QgsMessageLog, Qgis
+from PyQt5.QtGui import QTextCursor
+from qgis.core import QgsApplication, QgsMessageLog, Qgis
 from qgis.gui import QgsMapCanvas
 
 import json
+import uuid
 import requests
-from .project import get_project_json
-from .actions import function_map, ChatResponse
+from .project import ProjectDescriber, get_project_delta, apply_project_delta, get_project_hash
+from .actions import apply_actions, ChatResponse
+from .tasks import ChatRequestTask
 from .utils import log_tag
 
 
@@ -59,6 +63,11 @@ class LLMWidget(QDockWidget):
         self.response_field.setReadOnly(True)
         self.layout.addWidget(self.response_field)
 
+        self.plan_checkbox = QCheckBox("Plan multiple steps", self)
+        self.layout.addWidget(self.plan_checkbox)
+        self.plan_checkbox.setChecked(self.settings.value("plan", False, type=bool))
+        self.plan_checkbox.toggled.connect(lambda checked: self.settings.setValue("plan", checked))
+
         self.submit_button = QPushButton("Submit", self)
         self.layout.addWidget(self.submit_button)
         self.submit_button.clicked.connect(lambda: self.handle_submit(self.input_field.toPlainText()) and self.input_field.clear())
@@ -67,9 +76,30 @@ class LLMWidget(QDockWidget):
         self.layout.addWidget(self.apply_button)
         self.apply_button.clicked.connect(self.handle_apply)
         self.apply_button.setEnabled(False)
-        self.chat_history = []
+
+        self.cancel_button = QPushButton("Cancel", self)
+        self.layout.addWidget(self.cancel_button)
+        self.cancel_button.clicked.connect(self.handle_cancel)
+        self.cancel_button.setEnabled(False)
+
+        self.new_chat_button = QPushButton("New chat", self)
+        self.layout.addWidget(self.new_chat_button)
+        self.new_chat_button.clicked.connect(self.handle_new_chat)
+        # The API keeps the conversation for this id, so each request only sends the new message.
+        self.chat_session_id = str(uuid.uuid4())
+        # The last project description the API acknowledged, so only changes to it need to be sent.
+        self.acked_project = None
+        self.project_hash = None
+        # One keep-alive session for every request, at most one request is in flight at a time.
+        self.session = requests.Session()
+        self.task = None
+        # Feature counts on database and web layers are skipped unless approximate_feature_counts is turned off.
+        self.project_describer = ProjectDescriber(
+            approximate=self.settings.value("approximate_feature_counts", True, type=bool)
+        )
 
     def closeEvent(self, event):
+        self.handle_cancel()
         super().closeEvent(event)
 
     def make_api_call(self):
@@ -85,67 +115,107 @@ class LLMWidget(QDockWidget):
         except requests.exceptions.RequestException as e:
             QMessageBox.critical(self, "API Error", f"An error occurred: {e}")
 
-    def get_api_url(self):
+    def get_api_url(self, stream=False):
         api_host = self.url_field.text().rstrip('/')
         self.settings.setValue("api_host", api_host)
-        return f"{api_host}/api/chat/qgis"
-
-    def make_request(self, user_text, chat_history=None) -> ChatResponse:
-        request = {"text_input": user_text, "project_description": get_project_json(), "chat_history": chat_history}
-
-        try:
-            response = requests.post(self.get_api_url(), json=request, timeout=30)
-            response.raise_for_status()
-            self.input_field.clear()
-            return response.json()
-
-        except requests.exceptions.RequestException as e:
-            QMessageBox.critical(self, "API Error", f"An error occurred: {e}")
+        return f"{api_host}/api/chat/qgis/stream" if stream else f"{api_host}/api/chat/qgis"
+
+    def append_chat(self, text):
+        cursor = self.response_field.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
+        self.response_field.setTextCursor(cursor)
+
+    def get_project_payload(self, project_info):
+        if self.acked_project is not None and self.project_hash:
+            project_delta = get_project_delta(self.acked_project, project_info)
+            expected_project = apply_project_delta(self.acked_project, project_delta)
+            project_delta.update({'base_hash': self.project_hash, 'hash': get_project_hash(expected_project)})
+            if len(json.dumps(project_delta)) < len(json.dumps(project_info)):
+                return {"project_delta": project_delta}, expected_project
+        return {"project_description": project_info}, project_info
+
+    def make_request(self, user_text) -> ChatRequestTask:
+        # The project is read here because the QGIS API must be used from the UI thread.
+        project_info = self.project_describer.get_project_json()
+        project_payload, sent_project = self.get_project_payload(project_info)
+        request = {"text_input": user_text, "session_id": self.chat_session_id, **project_payload}
+        if self.plan_checkbox.isChecked():
+            request["plan"] = True
+
+        task = ChatRequestTask(self.session, self.get_api_url(stream=True), request, project_info, sent_project)
+        task.chat_received.connect(self.append_chat)
+        task.response_received.connect(self.handle_response)
+        task.request_failed.connect(self.handle_failure)
+        task.taskCompleted.connect(self.request_done)
+        task.taskTerminated.connect(self.request_done)
+        QgsApplication.taskManager().addTask(task)
+        return task
+
+    def set_busy(self, busy):
+        self.submit_button.setEnabled(not busy)
+        self.new_chat_button.setEnabled(not busy)
+        self.cancel_button.setEnabled(busy)
+
+    def request_done(self):
+        self.task = None
+        self.set_busy(False)
+
+    def handle_cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.response_field.append("Cancelled.")
+
+    def handle_new_chat(self):
+        if self.task is not None:
+            return
+        self.chat_session_id = str(uuid.uuid4())
+        self.chat_response = None
+        self.apply_button.setEnabled(False)
+        self.response_field.clear()
 
     def handle_submit(self, input_text):
-        if not input_text:
+        if not input_text or self.task is not None:
             return False
         self.response_field.append("\nUser:")
-        self.chat_history.append(input_text)
         self.response_field.append(input_text)
-        response = self.make_request(input_text, self.chat_history)
-
-        if not response:
-            QgsMessageLog.logMessage("Did not receive a response.", log_tag, level=Qgis.MessageLevel.Info)
-            return False
-        self.chat_response = response
         self.response_field.append("\nChatBot:")
-        self.chat_history.append(response['chat'])
+        self.response_field.append("")
+        self.set_busy(True)
+        self.task = self.make_request(input_text)
+        return True
 
-        # Trim chat history to avoid excessive amounts of context.
-        # This could probably be parameterized and configurable by the user as an advanced setting.
-        self.chat_history = self.chat_history[:8]
+    def handle_failure(self, error):
+        QgsMessageLog.logMessage(f"Did not receive a response: {error}", log_tag, level=Qgis.MessageLevel.Info)
+        QMessageBox.critical(self, "API Error", f"An error occurred: {error}")
 
-        self.response_field.append(response['chat'])
+    def handle_response(self, response: ChatResponse):
+        self.project_hash = response.get("project_hash")
+        self.acked_project = self.task.sent_project if self.project_hash and self.task else None
+        self.chat_response = response
         self.apply_button.setEnabled(True)
         QgsMessageLog.logMessage(json.dumps(response), log_tag, level=Qgis.MessageLevel.Info)
 
-        if "parameters" in response:
+        if "steps" in response:
+            self.response_field.append(f"\n I can do that in {len(response['steps'])} step(s):")
+            for step in response['steps']:
+                self.response_field.append(f"{step['function_name']}({step['parameters']})")
+        elif "parameters" in response:
             self.response_field.append(f"\n I can do that using {response['function_name']}({response['parameters']})")
         else:
             self.response_field.append(f"I can do that now.")
         self.response_field.append(f"Click apply or submit a new chat.")
-        return True
 
     def handle_apply(self):
         try:
+            if 'steps' in self.chat_response:
+                actions = [(step['function_name'], step['parameters']) for step in self.chat_response['steps']]
+            else:
+                actions = [(self.chat_response['function_name'], self.chat_response.get('parameters'))]
             try:
-                qgis_method = function_map[self.chat_response['function_name']]
-                if qgis_method and self.chat_response['parameters']:
-                    qgis_method(**self.chat_response['parameters'])
-                else:
-                    qgis_method()
+                apply_actions(actions)
             except Exception as e:
                 self.handle_submit(f"There was an error with that last command: {e} is there a different command that can be tried?")
-            try:
-                self.canvas.refresh()
-            except Exception as e:
-                QgsMessageLog.critical(f"Layer failed to load: {e}!", log_tag, level=Qgis.MessageLevel.Critical)
         except KeyError:
             QMessageBox.critical(self, "API Error",
                                  f"Could not process chat response: {self.chat_response}, please see the logs for more information.")
@@ -21,5 +21,6 @@ class ApiPlugin:
         self.dock_widget.show()
 
     def unload(self):
+        self.dock_widget.project_describer.disconnect()
         for action in self.actions:
             self.iface.removePluginMenu(self.tr("&LLM4Geo"), action)
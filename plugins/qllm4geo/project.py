@@ -1,33 +1,140 @@
+import hashlib
+import json
+from functools import partial
+
 from qgis.core import QgsProject
 
+# Counting features on these providers can mean a full scan on the server, so it's skipped when approximating.
+expensive_providers = {'postgres', 'mssql', 'oracle', 'hana', 'WFS', 'oapif', 'arcgisfeatureserver'}
+
+# Layer signals after which the layer's description has to be rebuilt.
+layer_change_signals = ['nameChanged', 'crsChanged', 'dataChanged', 'rendererChanged', 'styleChanged', 'updatedFields']
+
+
+def get_feature_count(layer, approximate=False):
+    if not hasattr(layer, 'featureCount'):
+        return None
+    if approximate and layer.providerType() in expensive_providers:
+        return None
+    return layer.featureCount()
+
+
+def describe_layer(layer, approximate=False):
+    return {
+        'name': layer.name(),
+        'id': layer.id(),
+        'type': layer.type(),
+        'crs': layer.crs().authid(),
+        'extent': layer.extent().toString(),
+        'feature_count': get_feature_count(layer, approximate),
+        'geometry_type': layer.geometryType() if hasattr(layer, 'geometryType') else None,
+        'fields': [field.name() for field in layer.fields()] if hasattr(layer, 'fields') else [],
+        'categories': [cat.label() for cat in layer.renderer().categories()] if hasattr(layer,
+                                                                                      'renderer') and hasattr(
+            layer.renderer(), 'categories') else [],
+        'ranges': [range_obj.label() for range_obj in layer.renderer().ranges()] if hasattr(layer, 'renderer') and hasattr(
+            layer.renderer(), 'ranges') else [],
+        'rules': [rule.label() for rule in layer.renderer().rootRule().children()] if hasattr(layer, 'renderer') and hasattr(
+            layer.renderer(), 'rootRule') else [],
+
+    }
+
 
 def get_project_json():
     project = QgsProject.instance()
 
     project_info = {'title': project.title(), 'crs': project.crs().authid()}
-
-    layers = []
-    for layer in project.mapLayers().values():
-        layer_info = {
-            'name': layer.name(),
-            'id': layer.id(),
-            'type': layer.type(),
-            'crs': layer.crs().authid(),
-            'extent': layer.extent().toString(),
-            'feature_count': layer.featureCount() if hasattr(layer, 'featureCount') else None,
-            'geometry_type': layer.geometryType() if hasattr(layer, 'geometryType') else None,
-            'fields': [field.name() for field in layer.fields()] if hasattr(layer, 'fields') else [],
-            'categories': [cat.label() for cat in layer.renderer().categories()] if hasattr(layer,
-                                                                                          'renderer') and hasattr(
-                layer.renderer(), 'categories') else [],
-            'ranges': [range_obj.label() for range_obj in layer.renderer().ranges()] if hasattr(layer, 'renderer') and hasattr(
-                layer.renderer(), 'ranges') else [],
-            'rules': [rule.label() for rule in layer.renderer().rootRule().children()] if hasattr(layer, 'renderer') and hasattr(
-                layer.renderer(), 'rootRule') else [],
-
-        }
-        layers.append(layer_info)
-
-    project_info['layers'] = layers
+    project_info['layers'] = [describe_layer(layer) for layer in project.mapLayers().values()]
 
     return project_info
+
+
+class ProjectDescriber:
+    """
+    Builds the project description from per layer descriptions that are kept until the project or layer signals
+    they're out of date, so describing an unchanged project doesn't touch the layers' providers.
+    """
+
+    def __init__(self, project=None, approximate=True):
+        self.project = project or QgsProject.instance()
+        self.approximate = approximate
+        self.layers = {}
+        # The slots connected to each layer's signals, so they can be disconnected again.
+        self.connections = {}
+        self.project.layersRemoved.connect(self.remove_layers)
+        self.project.cleared.connect(self.clear)
+
+    def disconnect(self):
+        self.project.layersRemoved.disconnect(self.remove_layers)
+        self.project.cleared.disconnect(self.clear)
+        for layer_id in list(self.connections):
+            layer = self.project.mapLayer(layer_id)
+            if layer is not None:
+                self.disconnect_layer(layer)
+        self.clear()
+
+    def invalidate(self, layer_id):
+        self.layers.pop(layer_id, None)
+
+    def remove_layers(self, layer_ids):
+        for layer_id in layer_ids:
+            self.invalidate(layer_id)
+            self.connections.pop(layer_id, None)
+
+    def clear(self):
+        self.layers = {}
+        self.connections = {}
+
+    def connect_layer(self, layer):
+        slot = partial(self.invalidate, layer.id())
+        signals = [getattr(layer, signal) for signal in layer_change_signals if hasattr(layer, signal)]
+        for signal in signals:
+            signal.connect(slot)
+        self.connections[layer.id()] = (signals, slot)
+
+    def disconnect_layer(self, layer):
+        signals, slot = self.connections.pop(layer.id())
+        for signal in signals:
+            signal.disconnect(slot)
+
+    def describe_layer(self, layer):
+        if layer.id() not in self.layers:
+            if layer.id() not in self.connections:
+                self.connect_layer(layer)
+            self.layers[layer.id()] = describe_layer(layer, self.approximate)
+        return self.layers[layer.id()]
+
+    def get_project_json(self):
+        project_info = {'title': self.project.title(), 'crs': self.project.crs().authid()}
+        project_info['layers'] = [self.describe_layer(layer) for layer in self.project.mapLayers().values()]
+        return project_info
+
+
+def get_project_hash(project_info):
+    # This must match the hash the API computes (llm4geo.schemas.qgis_project_description.get_project_hash).
+    return hashlib.sha256(json.dumps(project_info, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def apply_project_delta(project_info, project_delta):
+    # The API rebuilds the project the same way, changed layers keep their position and added layers are appended.
+    changed = {layer['id']: layer for layer in project_delta.get('changed', [])}
+    removed = set(project_delta.get('removed', []))
+    project = {key: value for key, value in project_info.items() if key != 'layers'}
+    project.update({key: value for key, value in project_delta.items() if key in ['title', 'crs']})
+    project['layers'] = [changed.get(layer['id'], layer) for layer in project_info.get('layers', [])
+                         if layer['id'] not in removed]
+    project['layers'] += project_delta.get('added', [])
+    return project
+
+
+def get_project_delta(base_info, project_info):
+    base_layers = {layer['id']: layer for layer in base_info.get('layers', [])}
+    layer_ids = {layer['id'] for layer in project_info['layers']}
+    return {
+        'title': project_info['title'],
+        'crs': project_info['crs'],
+        'added': [layer for layer in project_info['layers'] if layer['id'] not in base_layers],
+        'removed': [layer_id for layer_id in base_layers if layer_id not in layer_ids],
+        'changed': [layer for layer in project_info['layers']
+                    if layer['id'] in base_layers and layer != base_layers[layer['id']]],
+    }
@@ -0,0 +1,112 @@
+import json
+import uuid
+
+import requests
+from qgis.PyQt.QtCore import pyqtSignal
+from qgis.core import QgsTask
+
+
+def iter_events(lines):
+    """
+    Yields the (event, data) pairs of a server-sent event stream with JSON data.
+    """
+    event, data = "message", []
+    for line in lines:
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+
+
+class ChatRequestTask(QgsTask):
+    """
+    Posts a chat request to the streaming API off the UI thread, the signals are delivered to the UI thread.
+    Requests that fail before any event arrives are retried with the same Idempotency-Key, so the API answers them
+    with the response to the first attempt instead of calling the LLM again.
+    """
+    chat_received = pyqtSignal(str)
+    response_received = pyqtSignal(dict)
+    request_failed = pyqtSignal(str)
+
+    def __init__(self, session, url, request, project_info, sent_project):
+        super().__init__("LLM4GEO chat request", QgsTask.CanCancel)
+        self.session = session
+        self.url = url
+        self.request = request
+        self.project_info = project_info
+        self.sent_project = sent_project
+        self.idempotency_key = uuid.uuid4().hex
+        self.retries = 2
+        # Whether any event of the current attempt arrived, after which it isn't retried.
+        self.received = False
+        self.http_response = None
+        self.chat_response = None
+        self.error = None
+
+    def post(self):
+        # Only the time between streamed events is limited, so long responses aren't cut off.
+        self.http_response = self.session.post(
+            self.url, json=self.request, stream=True, timeout=(10, 30), headers={"Idempotency-Key": self.idempotency_key}
+        )
+        return self.http_response
+
+    def run(self):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.run_once()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if self.isCanceled() or self.received or attempt == self.retries:
+                    self.error = None if self.isCanceled() else str(e)
+                    return False
+            finally:
+                if self.http_response is not None:
+                    self.http_response.close()
+        return False
+
+    def run_once(self):
+        self.received = False
+        try:
+            response = self.post()
+            if response.status_code == 409 and "project_delta" in self.request:
+                # The API doesn't have the version the delta was based on, so send the whole project.
+                self.request.pop("project_delta")
+                self.request["project_description"] = self.sent_project = self.project_info
+                response.close()
+                response = self.post()
+            response.raise_for_status()
+            for event, data in iter_events(response.iter_lines(decode_unicode=True)):
+                self.received = True
+                if self.isCanceled():
+                    return False
+                if event == "chat":
+                    self.chat_received.emit(data["text"])
+                elif event == "result":
+                    self.chat_response = data
+                    return True
+                elif event == "error":
+                    self.error = data["error"]
+                    return False
+            self.error = "The response ended without a result."
+            return False
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            raise
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if not self.isCanceled():
+                self.error = str(e)
+            return False
+
+    def cancel(self):
+        # Closing the response interrupts a blocking read of the stream.
+        if self.http_response is not None:
+            self.http_response.close()
+        super().cancel()
+
+    def finished(self, result):
+        if result:
+            self.response_received.emit(self.chat_response)
+        elif not self.isCanceled():
+            self.request_failed.emit(self.error or "The request failed.")
@@ -13,6 +13,9 @@ from typing import Literal
 
 log_tag = "LLM4GEO"
 
+# The batch actions are currently being applied in, if any.
+active_batch = None
+
 
 def add_layer(layer):
     if not layer.isValid():
@@ -34,21 +37,95 @@ def get_category_by_label(renderer: QgsCategorizedSymbolRenderer, cat_label: str
     for idx, cat in enumerate(renderer.categories()):
         if cat.label() == cat_label:
             return idx, cat
-    raise Exception(f"Category renderer {cat_label} was not found.")
+    raise Exception(f"Category {cat_label} was not found.")
 
 
 def get_rule_by_label(renderer: QgsRuleBasedRenderer, rule_label: str):
     for idx, rule in enumerate(renderer.rootRule().children()):
         if rule.label() == rule_label:
             return idx, rule
-    raise Exception(f"Category renderer {rule_label} was not found.")
+    raise Exception(f"Rule {rule_label} was not found.")
 
 
 def get_range_by_label(renderer: QgsGraduatedSymbolRenderer, range_label: str):
     for idx, range_obj in enumerate(renderer.ranges()):
         if range_obj.label() == range_label:
             return idx, range_obj
-    raise Exception(f"Category renderer {range_label} was not found.")
+    raise Exception(f"Range {range_label} was not found.")
+
+
+def get_renderer_objects(renderer, object_type):
+    if object_type == 'category':
+        return renderer.categories()
+    if object_type == 'range':
+        return renderer.ranges()
+    if object_type == 'rule':
+        return renderer.rootRule().children()
+
+
+def get_label_indexes(render_objects):
+    indexes = {}
+    for idx, render_obj in enumerate(render_objects):
+        # The first object with a label wins, like the linear lookups.
+        indexes.setdefault(render_obj.label(), idx)
+    return indexes
+
+
+class ActionBatch:
+    """
+    Applies several actions with one repaint per changed layer and a single canvas refresh at the end.
+    If an action fails the renderers of the layers changed so far are restored.
+    """
+
+    def __init__(self):
+        # Keyed by layer id, the layers are looked up again on exit as an action may have removed them.
+        self.renderers = {}
+        # The renderer objects of each (layer id, object type) and the index of each label, the renderers return a
+        # new copy of their objects on every call.
+        self.render_objects = {}
+        self.refresh_canvas = False
+
+    def __enter__(self):
+        global active_batch
+        active_batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global active_batch
+        active_batch = None
+        for layer_id, renderer in self.renderers.items():
+            layer = QgsProject.instance().mapLayer(layer_id)
+            if layer is None:
+                continue
+            if exc_type is not None:
+                layer.setRenderer(renderer)
+            layer.triggerRepaint()
+            iface.layerTreeView().refreshLayerSymbology(layer_id)
+        if self.renderers or self.refresh_canvas:
+            iface.mapCanvas().refresh()
+        return False
+
+    def change_layer(self, layer):
+        if layer.id() not in self.renderers:
+            self.renderers[layer.id()] = layer.renderer().clone()
+
+    def get_render_object(self, renderer, layer, renderer_name, object_type):
+        key = (layer.id(), object_type)
+        if key not in self.render_objects:
+            render_objects = get_renderer_objects(renderer, object_type)
+            self.render_objects[key] = render_objects, get_label_indexes(render_objects)
+        render_objects, label_indexes = self.render_objects[key]
+        if renderer_name not in label_indexes:
+            raise Exception(f"{object_type.capitalize()} {renderer_name} was not found.")
+        idx = label_indexes[renderer_name]
+        return idx, render_objects[idx]
+
+
+def refresh_canvas():
+    if active_batch is not None:
+        active_batch.refresh_canvas = True
+    else:
+        iface.mapCanvas().refresh()
 
 
 def get_renderer_updater(object_type, renderer):
@@ -65,12 +142,18 @@ def color_object(layer_name: str, renderer_name: str, color: [int, int, int],
     layer = get_layer(layer_name)
     renderer = layer.renderer()
 
-    mapped_method = {'rule': get_rule_by_label, 'category': get_category_by_label, 'range': get_range_by_label}
-    idx, render_obj = mapped_method[object_type](renderer, renderer_name)
+    if active_batch is not None:
+        active_batch.change_layer(layer)
+        idx, render_obj = active_batch.get_render_object(renderer, layer, renderer_name, object_type)
+    else:
+        mapped_method = {'rule': get_rule_by_label, 'category': get_category_by_label, 'range': get_range_by_label}
+        idx, render_obj = mapped_method[object_type](renderer, renderer_name)
 
     symbol = render_obj.symbol().clone()
     symbol.setColor(QColor(*color))
     get_renderer_updater(object_type, renderer)(idx, symbol)
+    if active_batch is not None:
+        return
     layer.triggerRepaint()
     iface.layerTreeView().refreshLayerSymbology(layer.id())
     iface.mapCanvas().refresh()
@@ -10,10 +10,13 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import json
 import os
 from pathlib import Path
 from langchain_openai import ChatOpenAI
 
+from llm4geo.fake_llm import FakeChatModel, ReplayChatModel
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -44,6 +47,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "llm4geo.middleware.RequestMetricsMiddleware",
+    "llm4geo.middleware.IdempotencyMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -55,6 +60,16 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = "project.urls"
 
+# Log lines include the id of the request they were written for, see llm4geo.middleware.
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "filters": {"request_id": {"()": "llm4geo.metrics.RequestIdFilter"}},
+    "formatters": {"request": {"format": "%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"}},
+    "handlers": {"console": {"class": "logging.StreamHandler", "filters": ["request_id"], "formatter": "request"}},
+    "loggers": {"llm4geo": {"handlers": ["console"], "level": os.getenv("LOG_LEVEL", "INFO"), "propagate": False}},
+}
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
@@ -77,12 +92,88 @@ WSGI_APPLICATION = "project.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+if os.getenv("POSTGRES_HOST"):
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.getenv("POSTGRES_DB", "llm4geo"),
+            "USER": os.getenv("POSTGRES_USER"),
+            "PASSWORD": os.getenv("POSTGRES_PASSWORD"),
+            "HOST": os.getenv("POSTGRES_HOST"),
+            "PORT": os.getenv("POSTGRES_PORT", "5432"),
+        }
     }
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": BASE_DIR / "db.sqlite3",
+        }
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# LLM responses are cached in an in-process LRU tier backed by a shared database tier.
+# The shared tier needs its table created with `python manage.py createcachetable`.
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 60 * 60 * 24))
+LLM_CACHE_LOCAL = "llm_local"
+LLM_CACHE_SHARED = "llm_shared" if os.getenv("LLM_CACHE_SHARED", "true").lower() == "true" else None
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    LLM_CACHE_LOCAL: {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "llm4geo-responses",
+        "TIMEOUT": LLM_CACHE_TTL,
+        "OPTIONS": {"MAX_ENTRIES": int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1000))},
+    },
+    "llm_shared": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "llm4geo_cache",
+        "TIMEOUT": LLM_CACHE_TTL,
+        "OPTIONS": {"MAX_ENTRIES": int(os.getenv("LLM_CACHE_SHARED_MAX_ENTRIES", 100000))},
+    },
+    # Project descriptions keyed by their hash so clients can send only what changed.
+    "projects": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "llm4geo_projects",
+        "TIMEOUT": int(os.getenv("PROJECT_STORE_TTL", 60 * 60 * 24)),
+        "OPTIONS": {"MAX_ENTRIES": int(os.getenv("PROJECT_STORE_MAX_ENTRIES", 10000))},
+    },
+    # Completed items of data chat batches so a failed batch can be resumed.
+    "batches": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "llm4geo_batches",
+        "TIMEOUT": int(os.getenv("BATCH_CHECKPOINT_TTL", 60 * 60 * 24 * 7)),
+        "OPTIONS": {"MAX_ENTRIES": int(os.getenv("BATCH_CHECKPOINT_MAX_ENTRIES", 1000000))},
+    },
+    # Responses to requests with an Idempotency-Key, replayed to retries.
+    "idempotency": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "llm4geo_idempotency",
+        "TIMEOUT": int(os.getenv("IDEMPOTENCY_TTL", 60 * 60 * 24)),
+        "OPTIONS": {"MAX_ENTRIES": int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", 100000))},
+    },
 }
+PROJECT_STORE = "projects"
+PROJECT_STORE_TTL = CACHES[PROJECT_STORE]["TIMEOUT"]
+BATCH_CHECKPOINTS = "batches"
+BATCH_CHECKPOINT_TTL = CACHES[BATCH_CHECKPOINTS]["TIMEOUT"]
+IDEMPOTENCY_STORE = "idempotency"
+IDEMPOTENCY_TTL = CACHES[IDEMPOTENCY_STORE]["TIMEOUT"]
+
+# Concurrent requests for the same LLM response (same cache key) share one in-flight call.
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "true").lower() == "true"
+# A cache alias to hold single flight locks in so other workers share the call too, e.g. "llm_shared".
+SINGLE_FLIGHT_LOCKS = os.getenv("SINGLE_FLIGHT_LOCKS") or None
+# The longest a request waits on another's call (seconds) before making the call itself.
+SINGLE_FLIGHT_TIMEOUT = int(os.getenv("SINGLE_FLIGHT_TIMEOUT", 120))
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.getenv("SINGLE_FLIGHT_POLL_INTERVAL", 0.1))
 
 
 # Password validation
@@ -127,11 +218,92 @@ STATIC_URL = "static/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 LLM_MODEL = (
-    {"openai": ChatOpenAI}[os.getenv("LLM_MODEL")]
+    {"openai": ChatOpenAI, "fake": FakeChatModel, "replay": ReplayChatModel}[os.getenv("LLM_MODEL")]
     if os.getenv("LLM_MODEL")
     else ChatOpenAI
 )
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo-0125")
 if LLM_MODEL == ChatOpenAI and not OPENAI_API_KEY:
-    raise Exception("LLM_MODEL is set to 'openai' but not OPENAI_API_KEY was provided")
\ No newline at end of file
+    raise Exception("LLM_MODEL is set to 'openai' but not OPENAI_API_KEY was provided")
+# The model for each stage, keyed by the stage, "function_name", "parameters", "function_call", "plan", "data_chat" or
+# "summary", or by "parameters:<function name>" for one function, e.g. '{"function_name": "gpt-4o-mini",
+# "data_chat": "gpt-4o-mini", "parameters:color_rule": "gpt-4o"}'.  Stages that aren't listed use OPENAI_MODEL.
+LLM_STAGE_MODELS = json.loads(os.getenv("LLM_STAGE_MODELS", "{}"))
+# The model asked once more when a stage's responses are still invalid after its retries, e.g. "gpt-4o".
+LLM_ESCALATION_MODEL = os.getenv("LLM_ESCALATION_MODEL")
+# With LLM_MODEL=replay inputs are answered from a request log export (see `manage.py replay`) after a fixed latency.
+LLM_REPLAY_RECORDINGS = os.getenv("LLM_REPLAY_RECORDINGS")
+LLM_REPLAY_LATENCY = float(os.getenv("LLM_REPLAY_LATENCY", 0))
+
+# The model client and structured output chains are built once per worker and reuse their connection pool.
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 100))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", 20))
+LLM_PREBUILD_CHAINS = os.getenv("LLM_PREBUILD_CHAINS", "true").lower() == "true"
+
+# Serve the chat endpoints with async views, use when running under ASGI (e.g. uvicorn workers).
+ASYNC_VIEWS = os.getenv("ASYNC_VIEWS", "false").lower() == "true"
+# The maximum number of in-flight LLM calls per async worker.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 100))
+
+# Extract parameters for the top k locally scored functions while the function name is chosen.
+SPECULATIVE_PARAMETERS = os.getenv("SPECULATIVE_PARAMETERS", "false").lower() == "true"
+SPECULATIVE_TOP_K = int(os.getenv("SPECULATIVE_TOP_K", 2))
+SPECULATIVE_MAX_WORKERS = int(os.getenv("SPECULATIVE_MAX_WORKERS", 16))
+
+# How similar (0-1) an invalid value must be to an enum member to be replaced by it before re-prompting the LLM.
+REPAIR_ENUM_CUTOFF = float(os.getenv("REPAIR_ENUM_CUTOFF", 0.6))
+
+# The number of project specialized function schemas and validators kept per worker.
+SCHEMA_CACHE_SIZE = int(os.getenv("SCHEMA_CACHE_SIZE", 512))
+
+# The maximum number of input tokens per prompt, older chat history and optional context are dropped to fit.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 12000))
+
+# Larger project descriptions are pruned to the PROJECT_TOP_K_LAYERS layers most relevant to the request.
+PROJECT_TOKEN_BUDGET = int(os.getenv("PROJECT_TOKEN_BUDGET", 4000))
+PROJECT_TOP_K_LAYERS = int(os.getenv("PROJECT_TOP_K_LAYERS", 50))
+PROJECT_INDEX_CACHE_SIZE = int(os.getenv("PROJECT_INDEX_CACHE_SIZE", 128))
+
+# The number of unique inputs of a data chat batch sent to the LLM at once, and the most inputs a batch may have.
+DATA_BATCH_CONCURRENCY = int(os.getenv("DATA_BATCH_CONCURRENCY", 8))
+DATA_BATCH_MAX_ITEMS = int(os.getenv("DATA_BATCH_MAX_ITEMS", 10000))
+
+# Unambiguous commands are answered by local rules, or the classifier in ROUTER_MODEL (`manage.py train_router`) when
+# it is at least ROUTER_THRESHOLD (0-1) confident, without asking the LLM to choose the function.
+ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "true").lower() == "true"
+ROUTER_THRESHOLD = float(os.getenv("ROUTER_THRESHOLD", 0.95))
+ROUTER_MODEL = os.getenv("ROUTER_MODEL", BASE_DIR / "router_model.json")
+
+# go_to_location parameters are looked up in this gazetteer of countries, regions and cities when the request names
+# a place, instead of asking the LLM for coordinates. Names at least GAZETTEER_FUZZY_CUTOFF (0-1) similar match.
+GAZETTEER_ENABLED = os.getenv("GAZETTEER_ENABLED", "true").lower() == "true"
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", BASE_DIR / "llm4geo" / "data" / "gazetteer.tsv")
+GAZETTEER_FUZZY_CUTOFF = float(os.getenv("GAZETTEER_FUZZY_CUTOFF", 0.85))
+
+# Requests with a session_id are prompted with the session's turns stored on the server: the most recent turns that
+# fit in CHAT_SESSION_TOKEN_BUDGET tokens, after a summary of the older turns that is written in the background once
+# CHAT_SESSION_SUMMARY_MIN_TURNS turns no longer fit.
+CHAT_SESSION_TOKEN_BUDGET = int(os.getenv("CHAT_SESSION_TOKEN_BUDGET", 2000))
+CHAT_SESSION_MAX_TURNS = int(os.getenv("CHAT_SESSION_MAX_TURNS", 100))
+CHAT_SESSION_SUMMARIES = os.getenv("CHAT_SESSION_SUMMARIES", "true").lower() == "true"
+CHAT_SESSION_SUMMARY_MIN_TURNS = int(os.getenv("CHAT_SESSION_SUMMARY_MIN_TURNS", 4))
+CHAT_SESSION_SUMMARY_WORKERS = int(os.getenv("CHAT_SESSION_SUMMARY_WORKERS", 2))
+
+# Chat requests and their responses are logged to the RequestLog table of REQUEST_LOG_DATABASE by a background writer
+# that inserts them in batches.  At most REQUEST_LOG_QUEUE_SIZE entries wait to be written, more are dropped (and
+# counted) so logging never slows a request down.  REQUEST_LOG_SAMPLE_RATE (0-1) is the share of requests logged.
+REQUEST_LOG_ENABLED = os.getenv("REQUEST_LOG_ENABLED", "false").lower() == "true"
+REQUEST_LOG_SAMPLE_RATE = float(os.getenv("REQUEST_LOG_SAMPLE_RATE", 1.0))
+REQUEST_LOG_QUEUE_SIZE = int(os.getenv("REQUEST_LOG_QUEUE_SIZE", 10000))
+REQUEST_LOG_BATCH_SIZE = int(os.getenv("REQUEST_LOG_BATCH_SIZE", 500))
+REQUEST_LOG_FLUSH_INTERVAL = float(os.getenv("REQUEST_LOG_FLUSH_INTERVAL", 1.0))
+REQUEST_LOG_DATABASE = os.getenv("REQUEST_LOG_DATABASE", "default")
+
+# The most function calls a plan (a request with "plan": true) may contain.
+PLAN_MAX_STEPS = int(os.getenv("PLAN_MAX_STEPS", 10))
+
+# "two_call" chooses the function name and then its parameters, "single_call" uses one combined oneOf schema.
+FUNCTION_CALL_STRATEGY = os.getenv("FUNCTION_CALL_STRATEGY", "two_call")
+if FUNCTION_CALL_STRATEGY not in ["single_call", "two_call"]:
+    raise Exception(f"FUNCTION_CALL_STRATEGY must be 'single_call' or 'two_call' not {FUNCTION_CALL_STRATEGY}")
@@ -5,5 +5,6 @@ setup(
     version="0.1",
     packages=find_packages(),
     include_package_data=True,
-    install_requires=["django", "langchain", "langchain-openai"],
+    package_data={"llm4geo": ["data/*.tsv"]},
+    install_requires=["django", "djangorestframework", "adrf", "langchain", "langchain-openai", "tiktoken"],
 )